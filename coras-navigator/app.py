@@ -1,52 +1,177 @@
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 from flask_cors import CORS
 import os
 
 from summarizer import *
 from navigator import *
+from sse import format_sse_event
+from json_stream import JSONExtractionError
+from jobs import JobManager, JobQueueFull
+from cache import LLMCache, bypass_llm_cache
+from reranker import LexicalReranker, LLMReranker
+from index_spec import IndexSpec
+from context_builder import ContextBuilder
+from pipeline import AnalysisPipeline, MissingInput, StepFailed
+from models import ModelResidency
+from ollama_pool import OllamaPool, parse_hosts
+from metrics import METRICS, request_id, new_request_id, log
+from singleflight import SingleFlight
+
+from langchain_core.globals import set_llm_cache
 
 app = Flask(__name__)
 CORS(app)
 
-summarizer = SimpleSummarizer("llama3:70b-instruct")
-assessor = SimpleRiskAssessor("llama3:70b-instruct")
+# Every agent generates with temperature=0: identical prompts can be served from the cache
+llm_cache = LLMCache(
+    directory=os.environ.get("NAVIGATOR_CACHE_DIR", "./llm-cache/"),
+    memory_entries=int(os.environ.get("NAVIGATOR_CACHE_MEMORY_ENTRIES", 256)),
+    max_bytes=int(os.environ.get("NAVIGATOR_CACHE_MAX_MB", 512)) * 1024 * 1024
+)
+set_llm_cache(llm_cache)
+
+# Every agent shares the same keep_alive and num_ctx so that Ollama keeps one loaded instance of each model
+# With OLLAMA_HOSTS, the calls of every agent are spread over several Ollama servers
+ollama_pool = OllamaPool(parse_hosts(os.environ["OLLAMA_HOSTS"])) if os.environ.get("OLLAMA_HOSTS") else None
+residency = ModelResidency(
+    keep_alive=os.environ.get("NAVIGATOR_KEEP_ALIVE", "30m"),
+    num_ctx=int(os.environ.get("NAVIGATOR_NUM_CTX", 8192)),
+    pool=ollama_pool
+)
+
+summarizer = SimpleSummarizer("llama3:70b-instruct", residency)
+assessor = SimpleRiskAssessor("llama3:70b-instruct", residency)
+RERANKERS = {
+    'embedding': lambda: None, # Default reranker of CapecRAG
+    'lexical': lambda: LexicalReranker(),
+    'llm': lambda: LLMReranker("llama3:8b", residency)
+}
+
 rag = CapecRAG(
     embedding_model="nomic-embed-text:latest", 
     directory="./vector-stores/main/", 
     complete_capec=(
-        "./rag-docs/capec-detailed.json",
-        DocumentExtension.JSON    
-    )
+        "./rag-docs/capec-detailed.sqlite",
+        DocumentExtension.SQLITE
+    ),
+    embedding_batch_size=int(os.environ.get("NAVIGATOR_EMBEDDING_BATCH_SIZE", 64)),
+    embedding_concurrency=int(os.environ.get("NAVIGATOR_EMBEDDING_CONCURRENCY", 4)),
+    reranker=RERANKERS[os.environ.get("NAVIGATOR_RERANKER", "embedding")](),
+    lexical_weight=float(os.environ.get("NAVIGATOR_LEXICAL_WEIGHT", 1.0)),
+    index_spec=IndexSpec.parse(os.environ.get("NAVIGATOR_INDEX", "flat")),
+    embeddings=residency.embeddings("nomic-embed-text:latest")
+)
+formatter = SimpleJSONFormatter("llama3:70b-instruct", residency)
+
+# The retrieved context is limited to what the context window of the risk assessor leaves (and to NAVIGATOR_CONTEXT_BUDGET tokens)
+context_builder = ContextBuilder(
+    budget=int(os.environ["NAVIGATOR_CONTEXT_BUDGET"]) if os.environ.get("NAVIGATOR_CONTEXT_BUDGET") else None,
+    num_ctx=residency.num_ctx
 )
-formatter = SimpleJSONFormatter("llama3:70b-instruct")
 
-navigator = CorasNavigator(summarizer, rag, assessor, formatter)
+# Identical concurrent calls of a stage (e.g. a shared description opened by several analysts) share one generation
+singleflight = SingleFlight(enabled=os.environ.get("NAVIGATOR_COALESCE", "true") == "true")
+
+navigator = CorasNavigator(summarizer, rag, assessor, formatter, context_builder, singleflight)
+
+RAG_FILES = [(
+    "./rag-docs/capec-abstract.txt",
+    DocumentExtension.TXT
+)]
+
+# Maximum number of analyses of a batch run at the same time
+BATCH_MAX_CONCURRENCY = int(os.environ.get("NAVIGATOR_BATCH_CONCURRENCY", 4))
+
+# Size NAVIGATOR_WORKERS to the number of generations Ollama runs in parallel (OLLAMA_NUM_PARALLEL)
+jobs = JobManager(
+    max_workers=int(os.environ.get("NAVIGATOR_WORKERS", 1)),
+    max_pending=int(os.environ.get("NAVIGATOR_MAX_PENDING_JOBS", 32)),
+    timeout=float(os.environ.get("NAVIGATOR_JOB_TIMEOUT", 1800)),
+    abandon_timeout=float(os.environ.get("NAVIGATOR_JOB_ABANDON_TIMEOUT", 120))
+)
+
+# Intermediate artifacts are kept server-side, clients refer to them with 'session-id'
+pipeline = AnalysisPipeline(navigator, jobs)
+
+# Values read when /metrics is scraped
+METRICS.register_collector(lambda: [
+    (f"navigator_llm_cache_{name}", {}, value) for name, value in llm_cache.stats().items()
+], {
+    "navigator_llm_cache_hits": "Generations served from the LLM cache",
+    "navigator_llm_cache_misses": "Generations not found in the LLM cache",
+    "navigator_llm_cache_hit_rate": "Share of the generations served from the LLM cache"
+})
+METRICS.register_collector(lambda: [
+    (f"navigator_jobs_{name}", {}, value) for name, value in jobs.stats().items()
+] + [
+    ("navigator_sessions", {}, len(pipeline.sessions)),
+    ("navigator_coalesced_in_flight", {}, len(singleflight.flights))
+], {
+    "navigator_jobs_queued": "Jobs waiting for a worker",
+    "navigator_jobs_running": "Jobs being run",
+    "navigator_sessions": "Pipeline sessions kept in memory",
+    "navigator_coalesced_in_flight": "Computations that identical calls can attach to"
+})
+if ollama_pool is not None:
+    METRICS.register_collector(lambda: [
+        (f"navigator_ollama_host_{name}", {"host": host["url"]}, float(host[name]))
+        for host in ollama_pool.stats() for name in ["healthy", "in_flight", "calls", "failures"]
+    ], {
+        "navigator_ollama_host_healthy": "Whether the Ollama server answered its last health check or call",
+        "navigator_ollama_host_in_flight": "Calls being served by the Ollama server"
+    })
+
+@app.before_request
+def set_request_id():
+    # The ID is given by the client (or a proxy) to correlate its logs with the server's
+    request_id.set(request.headers.get('X-Request-ID') or new_request_id())
+
+@app.after_request
+def add_request_id(response: Response) -> Response:
+    response.headers['X-Request-ID'] = request_id.get()
+    return response
+
+@app.errorhandler(MissingInput)
+def missing_input(error):
+    return {'error': str(error)}, 400
 
 @app.route('/coras_navigator_api/generate_summary', methods=["POST"])
 def generate_summary():
     json_data = request.get_json()
     # print(f"Received JSON: {json_data}")
+    no_cache = json_data.get('no-cache', False)
+
+    with bypass_llm_cache(no_cache):
+        summary = navigator.summarize(json_data['context-description'])
 
-    summary = navigator.summarize(json_data['context-description'])
+    session = pipeline.create_session()
+    pipeline.set_summary(session, summary, no_cache)
     return {
-        'summary': summary
+        'summary': summary,
+        'session-id': session.id
     }
 
 @app.route('/coras_navigator_api/generate_risks', methods=["POST"])
 def generate_risks():
     json_data = request.get_json()
     # print(f"Received JSON: {json_data}")
+    no_cache = json_data.get('no-cache', False)
 
-    print("Retrieve context...")
-    context = navigator.retrieve(json_data['summary'])
+    session = pipeline.get_session(json_data.get('session-id'))
+    log("Retrieve context...")
+    retrieval = pipeline.get_context(session, json_data.get('summary'), no_cache)
+    context = retrieval['retrieved-context']
     # print(f"Retrieved context: \n{context}")
 
-    print("Identifying risks...")
-    analysis = navigator.assess_risks(json_data['summary'], context)
+    log("Identifying risks...")
+    with bypass_llm_cache(no_cache):
+        analysis = navigator.assess_risks(session.summary, context)
+    pipeline.set_analysis(session, analysis, no_cache)
  
     return {
         'analysis': analysis,
-        'retrieved-context': context,
+        **retrieval,
+        'session-id': session.id
     }
 
 @app.route('/coras_navigator_api/generate_coras_model', methods=["POST"])
@@ -54,19 +179,256 @@ def generate_coras_model():
     json_data = request.get_json()
     # print(f"Received JSON: {json_data}")
 
-    print("Formatting...")
-    model = navigator.extract_json(navigator.format(json_data['risk-analysis']))
-    # print(f"Generated CORAS Model: \n{model}")
+    log("Formatting...")
+    session = pipeline.get_session(json_data.get('session-id'))
+    result = pipeline.get_coras_model(session, json_data.get('risk-analysis'), json_data.get('no-cache', False))
+    # print(f"Generated CORAS Model: \n{result['coras_model']}")
     
+    # 'formatting' tells, for each risk, whether it was converted by the rule-based parser or by the LLM
+    return result
+
+def sse_response(events) -> Response:
+    return Response(stream_with_context(events), mimetype="text/event-stream", headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/coras_navigator_api/generate_summary/stream', methods=["POST"])
+def generate_summary_stream():
+    json_data = request.get_json()
+    no_cache = json_data.get('no-cache', False)
+
+    def events():
+        summary = ""
+        for token in navigator.summarize_stream(json_data['context-description']):
+            summary += token
+            yield format_sse_event('token', {'token': token})
+
+        session = pipeline.create_session()
+        pipeline.set_summary(session, summary, no_cache)
+        yield format_sse_event('result', {
+            'summary': summary,
+            'session-id': session.id
+        })
+
+    return sse_response(events())
+
+@app.route('/coras_navigator_api/generate_risks/stream', methods=["POST"])
+def generate_risks_stream():
+    json_data = request.get_json()
+    no_cache = json_data.get('no-cache', False)
+    session = pipeline.get_session(json_data.get('session-id'))
+    # Checked before the response (and its 200 status) is started
+    if json_data.get('summary', session.summary) is None:
+        return {'error': "No summary in the session"}, 400
+
+    def events():
+        log("Retrieve context...")
+        retrieval = pipeline.get_context(session, json_data.get('summary'), no_cache)
+        context = retrieval['retrieved-context']
+        yield format_sse_event('retrieved-context', retrieval)
+
+        log("Identifying risks...")
+        analysis = ""
+        for token in navigator.assess_risks_stream(session.summary, context):
+            analysis += token
+            yield format_sse_event('token', {'token': token})
+        pipeline.set_analysis(session, analysis, no_cache)
+
+        yield format_sse_event('result', {
+            'analysis': analysis,
+            **retrieval,
+            'session-id': session.id
+        })
+
+    return sse_response(events())
+
+@app.route('/coras_navigator_api/generate_coras_model/stream', methods=["POST"])
+def generate_coras_model_stream():
+    json_data = request.get_json()
+    session = pipeline.get_session(json_data.get('session-id'))
+    analysis = json_data.get('risk-analysis', session.analysis)
+    # Checked before the response (and its 200 status) is started
+    if analysis is None:
+        return {'error': "No risk analysis in the session"}, 400
+
+    def events():
+        log("Formatting...")
+        if session.format_job is not None and session.analysis == analysis:
+            # Already formatted (or being formatted) in the background
+            try:
+                result = pipeline.get_coras_model(session, no_cache=json_data.get('no-cache', False))
+            except StepFailed as error:
+                yield format_sse_event('error', {'error': str(error)})
+                return
+        else:
+            text = ""
+            try:
+                for token in navigator.format_stream(analysis):
+                    text += token
+                    yield format_sse_event('token', {'token': token})
+                result = {
+                    'coras_model': navigator.extract_json(text)
+                }
+            except JSONExtractionError as error:
+                # The generation was stopped as soon as the output became invalid
+                result = {
+                    'coras_model': "",
+                    'error': error.to_dict()
+                }
+
+        yield format_sse_event('result', result)
+
+    return sse_response(events())
+
+@app.route('/coras_navigator_api/analyze', methods=["POST"])
+def analyze():
+    json_data = request.get_json()
+
+    def events():
+        for event, data in pipeline.run(json_data['context-description'], json_data.get('no-cache', False)):
+            yield format_sse_event(event, data)
+
+    return sse_response(events())
+
+@app.route('/coras_navigator_api/analyze_batch', methods=["POST"])
+def analyze_batch():
+    json_data = request.get_json()
+
+    descriptions = json_data['context-descriptions']
+    max_concurrency = min(int(json_data.get('max-concurrency', BATCH_MAX_CONCURRENCY)), BATCH_MAX_CONCURRENCY)
+    no_cache = json_data.get('no-cache', False)
+
+    if not json_data.get('stream', False):
+        results = [None] * len(descriptions)
+        with bypass_llm_cache(no_cache):
+            for index, result in navigator.analyze_batch(descriptions, max_concurrency):
+                results[index] = result
+        return {
+            'results': results
+        }
+
+    def events():
+        with bypass_llm_cache(no_cache):
+            for index, result in navigator.analyze_batch(descriptions, max_concurrency):
+                yield format_sse_event('result', {'index': index, **result})
+        yield format_sse_event('done', {'count': len(descriptions)})
+
+    return sse_response(events())
+
+def run_job(stage, job, json_data):
+    with bypass_llm_cache(json_data.get('no-cache', False)):
+        return JOB_STAGES[stage](job, json_data)
+
+def summarize_job(job, json_data):
     return {
-        'coras_model': model
+        'summary': job.collect(navigator.summarize_stream(json_data['context-description']))
+    }
+
+def retrieve_job(job, json_data):
+    context, report = navigator.retrieve_with_report(json_data['summary'])
+    return {
+        'retrieved-context': context,
+        'context-report': report
     }
 
+def assess_job(job, json_data):
+    context = json_data.get('retrieved-context')
+    if context is None:
+        context = navigator.retrieve(json_data['summary'])
+        job.emit('retrieved-context', {'retrieved-context': context})
+
+    return {
+        'analysis': job.collect(navigator.assess_risks_stream(json_data['summary'], context)),
+        'retrieved-context': context,
+    }
+
+def format_job(job, json_data):
+    try:
+        text = job.collect(navigator.format_stream(json_data['risk-analysis']))
+        return {
+            'coras_model': navigator.extract_json(text)
+        }
+    except JSONExtractionError as error:
+        # The reason of the failure is kept for the client, as in the streamed formatting
+        return {
+            'coras_model': "",
+            'error': error.to_dict()
+        }
+
+JOB_STAGES = {
+    'summarize': summarize_job,
+    'retrieve': retrieve_job,
+    'assess': assess_job,
+    'format': format_job
+}
+
+@app.route('/coras_navigator_api/jobs', methods=["POST"])
+def submit_job():
+    json_data = request.get_json()
+
+    stage = json_data.get('stage')
+    if stage not in JOB_STAGES:
+        return {'error': f"Unknown stage '{stage}', expected one of {list(JOB_STAGES)}"}, 400
+
+    try:
+        job = jobs.submit(stage, lambda job: run_job(stage, job, json_data))
+    except JobQueueFull as error:
+        return {'error': str(error)}, 503
+
+    return job.to_dict(), 202
+
+@app.route('/coras_navigator_api/jobs/<job_id>', methods=["GET"])
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return {'error': f"Unknown job '{job_id}'"}, 404
+
+    job.touch()
+    return job.to_dict()
+
+@app.route('/coras_navigator_api/jobs/<job_id>', methods=["DELETE"])
+def cancel_job(job_id):
+    job = jobs.cancel(job_id)
+    if job is None:
+        return {'error': f"Unknown job '{job_id}'"}, 404
+
+    return job.to_dict()
+
+@app.route('/coras_navigator_api/jobs/<job_id>/events', methods=["GET"])
+def job_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return {'error': f"Unknown job '{job_id}'"}, 404
+
+    cancel_on_disconnect = request.args.get('cancel_on_disconnect', 'true') == 'true'
+
+    def events():
+        try:
+            for event, data in job.subscribe():
+                yield format_sse_event(event, data)
+        except GeneratorExit:
+            # The client went away before the end of the job
+            if cancel_on_disconnect:
+                jobs.cancel(job.id)
+            raise
+
+    return sse_response(events())
+
+@app.route('/coras_navigator_api/models', methods=["GET"])
+def get_models():
+    # Load, prompt evaluation and generation times reported by Ollama, by model, and the state of the Ollama servers
+    return residency.stats()
+
+@app.route('/metrics', methods=["GET"])
+def get_metrics():
+    # Prometheus text exposition format
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == '__main__': 
-    rag.load_files([(
-        "./rag-docs/capec-abstract.txt",
-        DocumentExtension.TXT
-    )])
+    rag.load_files(RAG_FILES)
+    if os.environ.get("NAVIGATOR_WARM_UP", "true") == "true":
+        residency.warm_up()
    
     app.run(debug=True, port=5242)
     
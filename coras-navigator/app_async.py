@@ -0,0 +1,322 @@
+from quart import Quart, Response, request
+from quart_cors import cors
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from typing import AsyncIterator
+import asyncio
+import os
+import signal
+
+from json_stream import JSONExtractionError
+from sse import format_sse_event
+from cache import bypass_llm_cache
+from metrics import METRICS, request_id, new_request_id, log
+from pipeline import MissingInput
+
+# The same agents, RAG module, models and sessions as the synchronous server
+from app import navigator, pipeline, residency, jobs, rag, RAG_FILES, BATCH_MAX_CONCURRENCY
+
+app = Quart(__name__)
+app = cors(app)
+
+# Maximum duration of a request, and maximum time a stream may stay without a new event (in seconds)
+REQUEST_TIMEOUT = float(os.environ.get("NAVIGATOR_REQUEST_TIMEOUT", 600))
+# Time given to the requests in progress to finish when the server is stopped (in seconds)
+GRACEFUL_TIMEOUT = float(os.environ.get("NAVIGATOR_GRACEFUL_TIMEOUT", 30))
+
+# The timeouts are applied by the handlers: a streamed analysis may last longer than REQUEST_TIMEOUT as long as it progresses
+app.config['RESPONSE_TIMEOUT'] = None
+
+@app.before_request
+async def set_request_id():
+    request_id.set(request.headers.get('X-Request-ID') or new_request_id())
+
+@app.after_request
+async def add_request_id(response: Response) -> Response:
+    response.headers['X-Request-ID'] = request_id.get()
+    return response
+
+@app.errorhandler(TimeoutError)
+async def request_timeout(error):
+    return {'error': f"The request took more than {REQUEST_TIMEOUT:.0f}s"}, 504
+
+@app.errorhandler(MissingInput)
+async def missing_input(error):
+    return {'error': str(error)}, 400
+
+@app.after_serving
+async def stop_jobs():
+    jobs.shutdown()
+
+@app.route('/coras_navigator_api/generate_summary', methods=["POST"])
+async def generate_summary():
+    json_data = await request.get_json()
+    no_cache = json_data.get('no-cache', False)
+
+    async with asyncio.timeout(REQUEST_TIMEOUT):
+        with bypass_llm_cache(no_cache):
+            summary = await navigator.asummarize(json_data['context-description'])
+
+    # No background retrieval: the next step retrieves the context without holding a thread
+    session = pipeline.create_session()
+    session.summary = summary
+    return {
+        'summary': summary,
+        'session-id': session.id
+    }
+
+@app.route('/coras_navigator_api/generate_risks', methods=["POST"])
+async def generate_risks():
+    json_data = await request.get_json()
+    no_cache = json_data.get('no-cache', False)
+
+    session = get_session(json_data.get('session-id'), summary=json_data.get('summary'))
+    if session.summary is None:
+        raise MissingInput("No summary in the session")
+    async with asyncio.timeout(REQUEST_TIMEOUT):
+        log("Retrieve context...")
+        retrieval = await retrieve(session.summary)
+
+        log("Identifying risks...")
+        with bypass_llm_cache(no_cache):
+            analysis = await navigator.aassess_risks(session.summary, retrieval['retrieved-context'])
+    session.analysis = analysis
+
+    return {
+        'analysis': analysis,
+        **retrieval,
+        'session-id': session.id
+    }
+
+@app.route('/coras_navigator_api/generate_coras_model', methods=["POST"])
+async def generate_coras_model():
+    json_data = await request.get_json()
+
+    log("Formatting...")
+    session = get_session(json_data.get('session-id'), analysis=json_data.get('risk-analysis'))
+    if session.analysis is None:
+        raise MissingInput("No risk analysis in the session")
+    async with asyncio.timeout(REQUEST_TIMEOUT):
+        with bypass_llm_cache(json_data.get('no-cache', False)):
+            return await navigator.aformat_with_report(session.analysis)
+
+def sse_response(events: AsyncIterator[str]) -> Response:
+    return Response(with_deadline(events), mimetype="text/event-stream", headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+async def with_deadline(events: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Ends a stream that produced no event for REQUEST_TIMEOUT seconds with an 'error' event.
+
+    When the client disconnects, the server cancels the task reading the stream: the cancellation reaches the call to Ollama in progress, which stops generating.
+    """
+
+    try:
+        while True:
+            try:
+                async with asyncio.timeout(REQUEST_TIMEOUT):
+                    event = await anext(events)
+            except StopAsyncIteration:
+                return
+            except TimeoutError:
+                log(f"Stream stopped after {REQUEST_TIMEOUT:.0f}s without progress")
+                yield format_sse_event('error', {'error': f"No progress for {REQUEST_TIMEOUT:.0f}s"})
+                return
+            yield event
+    finally:
+        await events.aclose()
+
+@app.route('/coras_navigator_api/generate_summary/stream', methods=["POST"])
+async def generate_summary_stream():
+    json_data = await request.get_json()
+    no_cache = json_data.get('no-cache', False)
+
+    async def events():
+        with bypass_llm_cache(no_cache):
+            summary = ""
+            async for token in navigator.asummarize_stream(json_data['context-description']):
+                summary += token
+                yield format_sse_event('token', {'token': token})
+
+        session = pipeline.create_session()
+        session.summary = summary
+        yield format_sse_event('result', {
+            'summary': summary,
+            'session-id': session.id
+        })
+
+    return sse_response(events())
+
+@app.route('/coras_navigator_api/generate_risks/stream', methods=["POST"])
+async def generate_risks_stream():
+    json_data = await request.get_json()
+    no_cache = json_data.get('no-cache', False)
+    session = get_session(json_data.get('session-id'), summary=json_data.get('summary'))
+    # Checked before the response (and its 200 status) is started
+    if session.summary is None:
+        return {'error': "No summary in the session"}, 400
+
+    async def events():
+        log("Retrieve context...")
+        retrieval = await retrieve(session.summary)
+        yield format_sse_event('retrieved-context', retrieval)
+
+        log("Identifying risks...")
+        with bypass_llm_cache(no_cache):
+            analysis = ""
+            async for token in navigator.aassess_risks_stream(session.summary, retrieval['retrieved-context']):
+                analysis += token
+                yield format_sse_event('token', {'token': token})
+        session.analysis = analysis
+
+        yield format_sse_event('result', {
+            'analysis': analysis,
+            **retrieval,
+            'session-id': session.id
+        })
+
+    return sse_response(events())
+
+@app.route('/coras_navigator_api/generate_coras_model/stream', methods=["POST"])
+async def generate_coras_model_stream():
+    json_data = await request.get_json()
+    session = get_session(json_data.get('session-id'), analysis=json_data.get('risk-analysis'))
+    if session.analysis is None:
+        return {'error': "No risk analysis in the session"}, 400
+
+    async def events():
+        log("Formatting...")
+        text = ""
+        try:
+            with bypass_llm_cache(json_data.get('no-cache', False)):
+                async for token in navigator.aformat_stream(session.analysis):
+                    text += token
+                    yield format_sse_event('token', {'token': token})
+            result = {
+                'coras_model': navigator.extract_json(text)
+            }
+        except JSONExtractionError as error:
+            # The generation was stopped as soon as the output became invalid
+            result = {
+                'coras_model': "",
+                'error': error.to_dict()
+            }
+
+        yield format_sse_event('result', result)
+
+    return sse_response(events())
+
+@app.route('/coras_navigator_api/analyze', methods=["POST"])
+async def analyze():
+    json_data = await request.get_json()
+    description = json_data['context-description']
+    no_cache = json_data.get('no-cache', False)
+
+    async def events():
+        session = pipeline.create_session()
+
+        with bypass_llm_cache(no_cache):
+            summary = ""
+            async for token in navigator.asummarize_stream(description):
+                summary += token
+                yield format_sse_event('token', {'stage': 'summary', 'token': token})
+            session.summary = summary
+            yield format_sse_event('summary', {'summary': summary, 'session-id': session.id})
+
+            retrieval = await retrieve(summary)
+            yield format_sse_event('retrieved-context', retrieval)
+
+            analysis = ""
+            async for token in navigator.aassess_risks_stream(summary, retrieval['retrieved-context']):
+                analysis += token
+                yield format_sse_event('token', {'stage': 'analysis', 'token': token})
+            session.analysis = analysis
+            yield format_sse_event('analysis', {'analysis': analysis})
+
+            yield format_sse_event('result', {
+                'session-id': session.id,
+                'summary': summary,
+                **retrieval,
+                'analysis': analysis,
+                **(await navigator.aformat_with_report(analysis))
+            })
+
+    return sse_response(events())
+
+@app.route('/coras_navigator_api/analyze_batch', methods=["POST"])
+async def analyze_batch():
+    json_data = await request.get_json()
+
+    descriptions = json_data['context-descriptions']
+    max_concurrency = min(int(json_data.get('max-concurrency', BATCH_MAX_CONCURRENCY)), BATCH_MAX_CONCURRENCY)
+    no_cache = json_data.get('no-cache', False)
+
+    if not json_data.get('stream', False):
+        results = [None] * len(descriptions)
+        async with asyncio.timeout(REQUEST_TIMEOUT):
+            with bypass_llm_cache(no_cache):
+                async for index, result in navigator.aanalyze_batch(descriptions, max_concurrency):
+                    results[index] = result
+        return {
+            'results': results
+        }
+
+    async def events():
+        with bypass_llm_cache(no_cache):
+            async for index, result in navigator.aanalyze_batch(descriptions, max_concurrency):
+                yield format_sse_event('result', {'index': index, **result})
+        yield format_sse_event('done', {'count': len(descriptions)})
+
+    return sse_response(events())
+
+@app.route('/coras_navigator_api/models', methods=["GET"])
+async def get_models():
+    return residency.stats()
+
+@app.route('/metrics', methods=["GET"])
+async def get_metrics():
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+def get_session(session_id: str, summary: str = None, analysis: str = None):
+    """
+    Returns the session, with the summary or the analysis given by the client (if any).
+    """
+
+    session = pipeline.get_session(session_id)
+    if summary is not None:
+        session.summary = summary
+    if analysis is not None:
+        session.analysis = analysis
+    return session
+
+async def retrieve(summary: str) -> dict:
+    if summary is None:
+        raise MissingInput("No summary in the session")
+
+    context, report = await navigator.aretrieve_with_report(summary)
+    return {
+        'retrieved-context': context,
+        'context-report': report
+    }
+
+async def main(port: int = 5242) -> None:
+    config = Config()
+    config.bind = [f"localhost:{port}"]
+    config.graceful_timeout = GRACEFUL_TIMEOUT
+
+    # On SIGINT or SIGTERM, stop accepting connections and let the requests in progress finish (within GRACEFUL_TIMEOUT)
+    shutdown = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(sig, shutdown.set)
+
+    await serve(app, config, shutdown_trigger=shutdown.wait)
+
+if __name__ == '__main__':
+    rag.load_files(RAG_FILES)
+    if os.environ.get("NAVIGATOR_WARM_UP", "true") == "true":
+        residency.warm_up()
+
+    asyncio.run(main())
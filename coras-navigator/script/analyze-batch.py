@@ -0,0 +1,34 @@
+import argparse
+import json
+import time
+
+from app import navigator, rag, RAG_FILES, BATCH_MAX_CONCURRENCY
+
+def get_descriptions(filename: str) -> list[str]:
+    """
+    Reads the descriptions of the systems to analyze: a JSON list of strings.
+    """
+
+    with open(filename, "r") as file:
+        return json.load(file)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the whole CORAS Navigator analysis on many system descriptions concurrently.")
+    parser.add_argument("input", help="A JSON file listing the descriptions of the systems")
+    parser.add_argument("output", help="The JSON file where the results are saved (in the order of the input)")
+    parser.add_argument("--max-concurrency", type=int, default=BATCH_MAX_CONCURRENCY)
+    arguments = parser.parse_args()
+
+    descriptions = get_descriptions(arguments.input)
+    rag.load_files(RAG_FILES)
+
+    start = time.perf_counter()
+    results = [None] * len(descriptions)
+    for index, result in navigator.analyze_batch(descriptions, arguments.max_concurrency):
+        results[index] = result
+        status = "failed" if 'error' in result else "done"
+        print(f"[{time.perf_counter() - start:.1f}s] Description {index} {status}")
+
+    with open(arguments.output, "w") as file:
+        json.dump(results, file, indent=4)
+    print(f"Saved {len(results)} analyses to '{arguments.output}'")
@@ -0,0 +1,137 @@
+import argparse
+import json
+import random
+import time
+
+import faiss
+import numpy as np
+
+from rag import RAG, get_cached_embeddings
+from index_spec import IndexSpec
+
+DEFAULT_SPECS = [
+    "flat",
+    "flat:compression=sq8",
+    "hnsw:m=16,ef_search=32",
+    "hnsw:m=32,ef_search=64",
+    "hnsw:m=32,ef_search=128",
+    "ivf:nlist=64,nprobe=4",
+    "ivf:nlist=64,nprobe=16",
+    "ivf:nlist=64,nprobe=16,compression=sq8",
+    "ivf:nlist=64,nprobe=16,compression=pq,pq_m=16"
+]
+
+def get_corpus(filename: str) -> list[str]:
+    with open(filename, "r") as file:
+        return [content for content in file.read().split(";\n") if content.strip() != ""]
+
+def get_query_vectors(embeddings, corpus_vectors: np.ndarray, queries_file: str, query_count: int) -> (np.ndarray, np.ndarray):
+    """
+    Returns:
+    - The embeddings of the queries listed in queries_file (a JSON list of strings, or of {"description": text} as in the retrieval ground truth), or of a random sample of the corpus if no file is given
+    - The corpus to index, without the sampled documents: a query that is in the index is its own nearest neighbor, which every index finds, and the recall would be close to 1 for all of them
+    """
+
+    if queries_file is not None:
+        with open(queries_file, "r") as file:
+            queries = [query if isinstance(query, str) else query["description"] for query in json.load(file)]
+        return np.array([embeddings.embed_query(query) for query in queries], dtype=np.float32), corpus_vectors
+
+    random.seed(0)
+    # At least as many documents left to index as the index types need to train (e.g. the lists of ivf)
+    sample = random.sample(range(len(corpus_vectors)), min(query_count, len(corpus_vectors) // 2))
+    held_out = np.zeros(len(corpus_vectors), dtype=bool)
+    held_out[sample] = True
+    return corpus_vectors[held_out], corpus_vectors[~held_out]
+
+def search(index: faiss.Index, query_vectors: np.ndarray, k: int) -> (np.ndarray, list[float]):
+    """
+    Searches the queries one by one, as the RAG module does.
+
+    Returns:
+    - The IDs of the results of each query
+    - The latency of each query in milliseconds
+    """
+
+    results = []
+    latencies = []
+    for query_vector in query_vectors:
+        start = time.perf_counter()
+        _, ids = index.search(query_vector.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(ids[0])
+    return np.array(results), latencies
+
+def get_recall(results: np.ndarray, exact_results: np.ndarray, k: int) -> float:
+    found = sum(len(set(result) & set(exact_result)) for result, exact_result in zip(results, exact_results))
+    return found / (k * len(exact_results))
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def benchmark(specs: list[str], corpus_vectors: np.ndarray, query_vectors: np.ndarray, k: int) -> list[dict]:
+    exact_index = IndexSpec().create_index(corpus_vectors)
+    exact_index.add(corpus_vectors)
+    exact_results, _ = search(exact_index, query_vectors, k)
+
+    reports = []
+    for text in specs:
+        spec = IndexSpec.parse(text)
+
+        start = time.perf_counter()
+        index = spec.create_index(corpus_vectors)
+        index.add(corpus_vectors)
+        build_time = time.perf_counter() - start
+
+        results, latencies = search(index, query_vectors, k)
+        reports.append({
+            "spec": text,
+            "factory": spec.factory_string(len(corpus_vectors)),
+            f"recall@{k}": get_recall(results, exact_results, k),
+            "latency_p50_ms": percentile(latencies, 50),
+            "latency_p95_ms": percentile(latencies, 95),
+            "build_s": build_time,
+            "memory_bytes": faiss.serialize_index(index).nbytes
+        })
+    return reports
+
+def print_reports(reports: list[dict], k: int) -> None:
+    print(f"{'spec':<50} {'recall@' + str(k):>9} {'p50 ms':>8} {'p95 ms':>8} {'build s':>8} {'memory':>10}")
+    for report in reports:
+        print(f"{report['spec']:<50} {report[f'recall@{k}']:>9.3f} {report['latency_p50_ms']:>8.3f} {report['latency_p95_ms']:>8.3f} {report['build_s']:>8.2f} {report['memory_bytes'] / 1024:>8.0f}KB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the recall, latency and memory of FAISS index types against the exact (flat) index on the RAG corpus.")
+    parser.add_argument("--corpus", default="./rag-docs/capec-abstract.txt", help="The corpus file, with documents separated by ';\\n'")
+    parser.add_argument("--embedding-model", default="nomic-embed-text:latest")
+    parser.add_argument("--embedding-cache", default=f"./vector-stores/main/{RAG.EMBEDDING_CACHE_FOLDER}", help="The embedding cache of the vector store, so that the corpus is not embedded again")
+    parser.add_argument("--queries", default=None, help="A JSON list of queries, e.g. ./script/retrieval-ground-truth.json (default: a sample of the corpus, held out of the indexed documents)")
+    parser.add_argument("--query-count", type=int, default=200)
+    parser.add_argument("--replicate", type=int, default=1, help="Replicate the corpus (with noise) to simulate a larger one")
+    parser.add_argument("-k", type=int, default=6)
+    parser.add_argument("--spec", action="append", help="Index spec to benchmark (repeatable, default: a predefined set)")
+    parser.add_argument("--output", default=None, help="Save the reports to a JSON file")
+    arguments = parser.parse_args()
+
+    embeddings = get_cached_embeddings(arguments.embedding_model, arguments.embedding_cache)
+    corpus = get_corpus(arguments.corpus)
+    print(f"Embedding {len(corpus)} documents (cached embeddings are reused)...")
+    corpus_vectors = np.array(embeddings.embed_documents(corpus), dtype=np.float32)
+
+    query_vectors, corpus_vectors = get_query_vectors(embeddings, corpus_vectors, arguments.queries, arguments.query_count)
+    if arguments.queries is None:
+        print(f"Holding out {len(query_vectors)} documents of the corpus as queries")
+
+    if arguments.replicate > 1:
+        generator = np.random.default_rng(0)
+        copies = [corpus_vectors + generator.normal(0, 0.01, corpus_vectors.shape).astype(np.float32) for _ in range(arguments.replicate - 1)]
+        corpus_vectors = np.concatenate([corpus_vectors] + copies)
+
+    reports = benchmark(arguments.spec or DEFAULT_SPECS, corpus_vectors, query_vectors, arguments.k)
+    print_reports(reports, arguments.k)
+
+    if arguments.output is not None:
+        with open(arguments.output, "w") as file:
+            json.dump(reports, file, indent=4)
+        print(f"Saved reports to '{arguments.output}'")
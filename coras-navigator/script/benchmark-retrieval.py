@@ -0,0 +1,233 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import faiss
+from langchain_core.embeddings import Embeddings
+from langchain_ollama import OllamaEmbeddings
+
+from rag import RAG, CapecRAG, DocumentExtension, get_capec_id_from_text
+from reranker import EmbeddingReranker, LexicalReranker, LLMReranker
+from index_spec import IndexSpec
+from metrics import span
+from stub_ollama import get_stub_embedding
+
+RERANKERS = ["embedding", "lexical", "llm"]
+
+class StubEmbeddings(Embeddings):
+    """
+    Deterministic embeddings of the words of a text (see stub_ollama), to benchmark retrieval without an Ollama server.
+
+    Attributes:
+    - size:    Size of the embeddings
+    - latency: Time in seconds of each request, to simulate the embedding model
+    """
+
+    def __init__(self, size: int = 256, latency: float = 0.0):
+        self.size = size
+        self.latency = latency
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.latency)
+        return [get_stub_embedding(text, self.size) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+class TimedEmbeddings(Embeddings):
+    """
+    Runs every request to the embeddings in an "embed" span, so that the time spent embedding can be told apart from the vector search and the reranking.
+    """
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        with span("embed"):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        with span("embed"):
+            return self.embeddings.embed_query(text)
+
+def get_ground_truth(filename: str) -> list[dict]:
+    """
+    Reads the labeled queries: a JSON list of {"description": text, "capec_ids": [expected CAPEC IDs]}.
+    """
+
+    with open(filename, "r") as file:
+        return json.load(file)
+
+def write_fixture_corpus(fixtures_file: str, directory: str) -> (str, str):
+    """
+    Writes the CAPEC entries of the benchmark fixtures as the abstract (TXT) and detailed (SQLite) RAG documents.
+
+    Returns:
+    - The abstract file and the detailed file
+    """
+
+    with open(fixtures_file, "r") as file:
+        capec = json.load(file)["capec"]
+
+    corpus = os.path.join(directory, "capec-abstract.txt")
+    with open(corpus, "w") as file:
+        for text in capec.values():
+            lines = text.splitlines()
+            file.write(f"{lines[0]}: {lines[1].split(': ', 1)[1]}: {lines[2].split(': ', 1)[1]};\n")
+
+    details = os.path.join(directory, "capec-detailed.sqlite")
+    connection = sqlite3.connect(details)
+    connection.execute("CREATE TABLE capec (id TEXT PRIMARY KEY, text TEXT NOT NULL)")
+    connection.executemany("INSERT INTO capec (id, text) VALUES (?, ?)", capec.items())
+    connection.commit()
+    connection.close()
+    return corpus, details
+
+def get_reranker(name: str, rag: CapecRAG, model: str):
+    if name == "lexical":
+        return LexicalReranker()
+    if name == "llm":
+        return LLMReranker(model)
+    return EmbeddingReranker(rag.embeddings)
+
+def get_exclusive_duration(root, stage: str) -> float:
+    """
+    Returns the time spent in the spans of a stage, without the embedding requests made within them.
+    """
+
+    spans = root.find(stage)
+    return sum(stage_span.duration for stage_span in spans) - sum(embed.duration for stage_span in spans for embed in stage_span.find("embed"))
+
+def run_query(rag: CapecRAG, query: dict, k: int, top_k: int) -> dict:
+    with span("benchmark-query") as root:
+        results = rag.search(query["description"], k, top_k)
+
+    retrieved = [get_capec_id_from_text(result) for result in results]
+    candidates = [document.metadata.get("capec_id") for document in rag.retrieve_documents(query["description"], k)]
+    expected = set(query["capec_ids"])
+    ranks = [rank for rank, capec_id in enumerate(retrieved, start=1) if capec_id in expected]
+    return {
+        "description": query["description"],
+        "expected": query["capec_ids"],
+        "retrieved": retrieved,
+        "recall": len(expected & set(retrieved)) / len(expected),
+        "candidate_recall": len(expected & set(candidates)) / len(expected),
+        "reciprocal_rank": 1 / ranks[0] if len(ranks) > 0 else 0.0,
+        "total_ms": root.duration * 1000,
+        "embed_ms": sum(embed.duration for embed in root.find("embed")) * 1000,
+        "vector_search_ms": get_exclusive_duration(root, "vector-search") * 1000,
+        "rerank_ms": get_exclusive_duration(root, "rerank") * 1000
+    }
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def benchmark(rag: CapecRAG, queries: list[dict], reranker: str, k: int, top_k: int, lexical_weight: float, llm_model: str) -> dict:
+    rag.reranker = get_reranker(reranker, rag, llm_model)
+    rag.lexical_weight = lexical_weight
+
+    # The first query pays for loading the index pages and the cold caches
+    run_query(rag, queries[0], k, top_k)
+    results = [run_query(rag, query, k, top_k) for query in queries]
+
+    def mean(key: str) -> float:
+        return sum(result[key] for result in results) / len(results)
+
+    return {
+        "reranker": reranker,
+        "k": k,
+        "top_k": top_k,
+        "lexical_weight": lexical_weight,
+        f"recall@{top_k}": mean("recall"),
+        f"candidate_recall@{k}": mean("candidate_recall"),
+        "mrr": mean("reciprocal_rank"),
+        "latency_p50_ms": percentile([result["total_ms"] for result in results], 50),
+        "latency_p95_ms": percentile([result["total_ms"] for result in results], 95),
+        "embed_mean_ms": mean("embed_ms"),
+        "vector_search_mean_ms": mean("vector_search_ms"),
+        "rerank_mean_ms": mean("rerank_ms"),
+        "queries": results
+    }
+
+def print_reports(reports: list[dict]) -> None:
+    print(f"{'reranker':<10} {'k':>3} {'lexical':>7} {'recall':>7} {'cand.':>7} {'MRR':>6} {'p50 ms':>8} {'p95 ms':>8} {'embed':>7} {'search':>7} {'rerank':>7}")
+    for report in reports:
+        recall = report[f"recall@{report['top_k']}"]
+        candidate_recall = report[f"candidate_recall@{report['k']}"]
+        print(f"{report['reranker']:<10} {report['k']:>3} {report['lexical_weight']:>7.2f} {recall:>7.3f} {candidate_recall:>7.3f} {report['mrr']:>6.3f} {report['latency_p50_ms']:>8.2f} {report['latency_p95_ms']:>8.2f} {report['embed_mean_ms']:>7.2f} {report['vector_search_mean_ms']:>7.2f} {report['rerank_mean_ms']:>7.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the quality (recall, MRR) and the latency of the retrieval of CAPEC entries on a labeled set of system descriptions.")
+    parser.add_argument("--ground-truth", default="./script/retrieval-ground-truth.json", help="A JSON list of {\"description\", \"capec_ids\"}")
+    parser.add_argument("--corpus", default="./rag-docs/capec-abstract.txt", help="The abstracts of the CAPEC entries, separated by ';\\n'")
+    parser.add_argument("--details", default="./rag-docs/capec-detailed.sqlite", help="The detailed CAPEC entries (SQLite)")
+    parser.add_argument("--fixtures", default=None, help="Use the CAPEC entries of a benchmark fixtures file instead of --corpus and --details (e.g. ./script/benchmark-fixtures.json)")
+    parser.add_argument("--embeddings", choices=["stub", "ollama"], default="stub", help="Stub embeddings (offline) or the Ollama embedding model")
+    parser.add_argument("--embedding-model", default="nomic-embed-text:latest")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="Time in seconds of each request to the stub embeddings")
+    parser.add_argument("--directory", default=None, help="The folder of the vector store and its embedding cache (default: a temporary folder)")
+    parser.add_argument("--index", default="flat", help="Type of FAISS index, as NAVIGATOR_INDEX")
+    parser.add_argument("-k", type=int, action="append", help="Number of candidates retrieved before reranking (repeatable, default: 6)")
+    parser.add_argument("--top-k", type=int, default=3, help="Number of entries kept after reranking")
+    parser.add_argument("--reranker", action="append", choices=RERANKERS, help="Reranker (repeatable, default: embedding)")
+    parser.add_argument("--llm-model", default="llama3:8b", help="The model of the llm reranker")
+    parser.add_argument("--lexical-weight", type=float, action="append", help="Weight of the lexical index (repeatable, default: 1.0)")
+    parser.add_argument("--verbose", action="store_true", help="Show the logs of the RAG module")
+    parser.add_argument("--output", default=None, help="Save the reports, with the results of each query, to a JSON file")
+    arguments = parser.parse_args()
+
+    queries = get_ground_truth(arguments.ground_truth)
+    workspace = tempfile.mkdtemp(prefix="navigator-retrieval-")
+    directory = os.path.join(arguments.directory if arguments.directory is not None else workspace, "")
+    corpus, details = (arguments.corpus, arguments.details) if arguments.fixtures is None else write_fixture_corpus(arguments.fixtures, workspace)
+
+    if arguments.embeddings == "stub":
+        embeddings = StubEmbeddings(latency=arguments.embedding_latency)
+    else:
+        embeddings = OllamaEmbeddings(model=arguments.embedding_model)
+    embedding_model = arguments.embedding_model if arguments.embeddings == "ollama" else "stub"
+
+    logs = io.StringIO()
+    with contextlib.redirect_stdout(sys.stdout if arguments.verbose else logs):
+        rag = CapecRAG(
+            embedding_model=embedding_model,
+            directory=directory,
+            complete_capec=(details, DocumentExtension.SQLITE),
+            index_spec=IndexSpec.parse(arguments.index),
+            embeddings=TimedEmbeddings(embeddings)
+        )
+        start = time.perf_counter()
+        rag.load_files([(corpus, DocumentExtension.TXT)])
+        load_time = time.perf_counter() - start
+
+        reports = []
+        for reranker in arguments.reranker or ["embedding"]:
+            for k in arguments.k or [6]:
+                for lexical_weight in arguments.lexical_weight or [1.0]:
+                    reports.append(benchmark(rag, queries, reranker, k, arguments.top_k, lexical_weight, arguments.llm_model))
+
+    index = {
+        "spec": arguments.index,
+        "documents": rag.vector_store.index.ntotal,
+        "load_s": load_time,
+        "memory_bytes": faiss.serialize_index(rag.vector_store.index).nbytes,
+        "lexical_index_bytes": os.path.getsize(f"{directory}{RAG.LEXICAL_INDEX}")
+    }
+    print(f"Index '{index['spec']}': {index['documents']} documents, {index['memory_bytes'] / 1024:.0f}KB (lexical index: {index['lexical_index_bytes'] / 1024:.0f}KB), loaded in {index['load_s']:.2f}s")
+    print(f"{len(queries)} queries, recall of the {arguments.top_k} entries kept ('cand.': of the k candidates before reranking), mean latencies in ms")
+    print_reports(reports)
+
+    if arguments.output is not None:
+        with open(arguments.output, "w") as file:
+            json.dump({"embeddings": embedding_model, "index": index, "reports": reports}, file, indent=4)
+        print(f"Saved reports to '{arguments.output}'")
+
+    shutil.rmtree(workspace, ignore_errors=True)
@@ -0,0 +1,304 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable
+
+NAVIGATOR_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path[:0] = [os.path.join(NAVIGATOR_DIR, "src"), NAVIGATOR_DIR]
+
+from stub_ollama import StubOllama
+
+# The models of app.py, listed by the stub servers
+STUB_MODELS = ["llama3:70b-instruct", "llama3:8b", "nomic-embed-text:latest"]
+
+TARGETS = ["navigator", "api"]
+
+def get_fixtures(filename: str) -> dict:
+    """
+    Reads the fixtures of the benchmark: the system descriptions, the CAPEC entries of the RAG corpus and the canned outputs of the stub Ollama servers ([pattern, output] pairs).
+    """
+
+    with open(filename, "r") as file:
+        return json.load(file)
+
+def create_workspace(fixtures: dict) -> str:
+    """
+    Creates a working directory with the RAG documents of the fixtures, laid out as app.py expects them.
+    """
+
+    directory = tempfile.mkdtemp(prefix="navigator-benchmark-")
+    os.makedirs(os.path.join(directory, "rag-docs"))
+    os.makedirs(os.path.join(directory, "vector-stores", "main"))
+
+    with open(os.path.join(directory, "rag-docs", "capec-abstract.txt"), "w") as file:
+        for text in fixtures["capec"].values():
+            lines = text.splitlines()
+            name = lines[1].split(": ", 1)[1]
+            description = lines[2].split(": ", 1)[1]
+            file.write(f"{lines[0]}: {name}: {description};\n")
+
+    connection = sqlite3.connect(os.path.join(directory, "rag-docs", "capec-detailed.sqlite"))
+    connection.execute("CREATE TABLE capec (id TEXT PRIMARY KEY, text TEXT NOT NULL)")
+    connection.executemany("INSERT INTO capec (id, text) VALUES (?, ?)", fixtures["capec"].items())
+    connection.commit()
+    connection.close()
+    return directory
+
+def start_stubs(fixtures: dict, arguments) -> list[StubOllama]:
+    return [StubOllama(
+        responses=[tuple(response) for response in fixtures["responses"]],
+        latency=arguments.latency,
+        tokens_per_second=arguments.tokens_per_second,
+        prompt_tokens_per_second=arguments.prompt_tokens_per_second,
+        load_duration=arguments.load_duration,
+        max_parallel=arguments.stub_parallel,
+        models=STUB_MODELS
+    ).start() for _ in range(arguments.hosts)]
+
+def import_app(workspace: str, stubs: list[StubOllama]):
+    """
+    Imports app.py against the stub servers, with the RAG documents and caches of the workspace.
+    """
+
+    os.environ["OLLAMA_HOST"] = stubs[0].url
+    if len(stubs) > 1:
+        os.environ["OLLAMA_HOSTS"] = ",".join(stub.url for stub in stubs)
+    else:
+        os.environ.pop("OLLAMA_HOSTS", None)
+    os.environ["NAVIGATOR_CACHE_DIR"] = os.path.join(workspace, "llm-cache/")
+    os.chdir(workspace)
+
+    import app
+    app.rag.load_files(app.RAG_FILES)
+    return app
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def run_load(name: str, work: Callable[[int], object], requests: int, concurrency: int, measure_memory: bool) -> (dict, list):
+    """
+    Runs work(i) for i in range(requests), with at most concurrency calls at the same time.
+
+    Returns:
+    - The report: latency percentiles, throughput, errors and the peak of memory allocated during the run
+    - The results of the calls (None for failed calls)
+    """
+
+    def timed(i: int):
+        start = time.perf_counter()
+        try:
+            return work(i), None
+        except Exception as error:
+            return None, error
+        finally:
+            latencies[i] = time.perf_counter() - start
+
+    latencies = [None] * requests
+    if measure_memory:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(timed, range(requests)))
+    wall = time.perf_counter() - start
+
+    errors = [str(error) for _, error in outcomes if error is not None]
+    succeeded = [latency * 1000 for latency, (_, error) in zip(latencies, outcomes) if error is None]
+    report = {
+        "target": name,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": len(errors),
+        "latency_p50_ms": percentile(succeeded, 50) if len(succeeded) > 0 else None,
+        "latency_p95_ms": percentile(succeeded, 95) if len(succeeded) > 0 else None,
+        "latency_p99_ms": percentile(succeeded, 99) if len(succeeded) > 0 else None,
+        "latency_mean_ms": sum(succeeded) / len(succeeded) if len(succeeded) > 0 else None,
+        "throughput_rps": len(succeeded) / wall,
+        "wall_s": wall,
+        "memory_peak_bytes": tracemalloc.get_traced_memory()[1] - baseline if measure_memory else None
+    }
+    if len(errors) > 0:
+        report["first_error"] = errors[0]
+    return report, [result for result, _ in outcomes]
+
+def benchmark_navigator(app, descriptions: list[str], requests: int, concurrency: int, measure_memory: bool) -> list[dict]:
+    """
+    Measures each method of the navigator on its own, each stage taking the outputs of the previous one, then the whole analysis.
+    """
+
+    navigator = app.navigator
+
+    def no_cache(call):
+        def work(i):
+            with app.bypass_llm_cache(True):
+                return call(i)
+        return work
+
+    reports = []
+    report, summaries = run_load("navigator.summarize", no_cache(lambda i: navigator.summarize(descriptions[i % len(descriptions)])), requests, concurrency, measure_memory)
+    reports.append(report)
+    summaries = [summary or "" for summary in summaries]
+
+    report, contexts = run_load("navigator.retrieve", no_cache(lambda i: navigator.retrieve(summaries[i])), requests, concurrency, measure_memory)
+    reports.append(report)
+    contexts = [context or "" for context in contexts]
+
+    report, analyses = run_load("navigator.assess_risks", no_cache(lambda i: navigator.assess_risks(summaries[i], contexts[i])), requests, concurrency, measure_memory)
+    reports.append(report)
+    analyses = [analysis or "" for analysis in analyses]
+
+    report, _ = run_load("navigator.format", no_cache(lambda i: navigator.format_with_report(analyses[i])), requests, concurrency, measure_memory)
+    reports.append(report)
+
+    report, _ = run_load("navigator.analyze", no_cache(lambda i: navigator.analyze(descriptions[i % len(descriptions)])), requests, concurrency, measure_memory)
+    reports.append(report)
+    return reports
+
+def benchmark_api(app, descriptions: list[str], requests: int, concurrency: int, measure_memory: bool) -> list[dict]:
+    """
+    Measures the endpoints as a client sees them: the three steps of a session (each step may wait for the work prefetched by the previous one), then the whole analysis streamed by 'analyze'.
+    """
+
+    client = app.app.test_client()
+
+    def post(path: str, body: dict) -> dict:
+        response = client.post(f"/coras_navigator_api/{path}", json={**body, 'no-cache': True})
+        if response.status_code != 200:
+            raise Exception(f"{path}: HTTP {response.status_code}")
+        return response.get_json() if response.is_json else response.get_data(as_text=True)
+
+    reports = []
+    report, sessions = run_load("api.generate_summary", lambda i: post("generate_summary", {'context-description': descriptions[i % len(descriptions)]})['session-id'], requests, concurrency, measure_memory)
+    reports.append(report)
+
+    report, _ = run_load("api.generate_risks", lambda i: post("generate_risks", {'session-id': sessions[i]}), requests, concurrency, measure_memory)
+    reports.append(report)
+
+    report, _ = run_load("api.generate_coras_model", lambda i: post("generate_coras_model", {'session-id': sessions[i]}), requests, concurrency, measure_memory)
+    reports.append(report)
+
+    def analyze(i: int) -> str:
+        events = post("analyze", {'context-description': descriptions[i % len(descriptions)]})
+        if "event: result" not in events:
+            raise Exception("analyze: no result event")
+        return events
+
+    report, _ = run_load("api.analyze", analyze, requests, concurrency, measure_memory)
+    reports.append(report)
+    return reports
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=NAVIGATOR_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_reports(reports: list[dict]) -> None:
+    print(f"{'target':<28} {'conc':>4} {'err':>4} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>7} {'memory':>10}")
+    for report in reports:
+        latencies = [f"{report[key]:>9.1f}" if report[key] is not None else f"{'-':>9}" for key in ["latency_p50_ms", "latency_p95_ms", "latency_p99_ms"]]
+        memory = f"{report['memory_peak_bytes'] / 1024:>8.0f}KB" if report["memory_peak_bytes"] is not None else f"{'-':>10}"
+        print(f"{report['target']:<28} {report['concurrency']:>4} {report['errors']:>4} {' '.join(latencies)} {report['throughput_rps']:>7.2f} {memory}")
+
+def compare(reports: list[dict], baseline: list[dict], max_regression: float) -> list[str]:
+    """
+    Compares the reports with the reports of a previous run, by target and concurrency.
+
+    Returns:
+    - The regressions beyond max_regression (relative increase of the p95 latency or decrease of the throughput)
+    """
+
+    previous = {(report["target"], report["concurrency"]): report for report in baseline}
+    regressions = []
+    print(f"\n{'target':<28} {'conc':>4} {'p95 before':>11} {'p95 after':>10} {'req/s before':>13} {'req/s after':>12}")
+    for report in reports:
+        before = previous.get((report["target"], report["concurrency"]))
+        if before is None or before["latency_p95_ms"] is None or report["latency_p95_ms"] is None:
+            continue
+
+        print(f"{report['target']:<28} {report['concurrency']:>4} {before['latency_p95_ms']:>11.1f} {report['latency_p95_ms']:>10.1f} {before['throughput_rps']:>13.2f} {report['throughput_rps']:>12.2f}")
+        if report["latency_p95_ms"] > before["latency_p95_ms"] * (1 + max_regression):
+            regressions.append(f"{report['target']} (concurrency {report['concurrency']}): p95 latency {before['latency_p95_ms']:.1f}ms -> {report['latency_p95_ms']:.1f}ms")
+        if report["throughput_rps"] < before["throughput_rps"] * (1 - max_regression):
+            regressions.append(f"{report['target']} (concurrency {report['concurrency']}): throughput {before['throughput_rps']:.2f} -> {report['throughput_rps']:.2f} req/s")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the latency, throughput and memory of the navigator and its API end to end, against stub Ollama servers (no GPU or network needed).")
+    parser.add_argument("--fixtures", default=os.path.join(NAVIGATOR_DIR, "script", "benchmark-fixtures.json"), help="Descriptions, CAPEC entries and canned outputs of the models")
+    parser.add_argument("--target", action="append", choices=TARGETS, help="What to benchmark (repeatable, default: everything)")
+    parser.add_argument("--concurrency", default="1,4", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=8, help="Number of requests per target and concurrency level")
+    parser.add_argument("--latency", type=float, default=0.05, help="Time in seconds before the first token of a generation")
+    parser.add_argument("--tokens-per-second", type=float, default=400.0, help="Generation speed of the stub servers")
+    parser.add_argument("--prompt-tokens-per-second", type=float, default=None, help="Prompt evaluation speed of the stub servers (default: the length of the prompt is ignored)")
+    parser.add_argument("--load-duration", type=float, default=0.0, help="Time in seconds to load a model on its first call")
+    parser.add_argument("--stub-parallel", type=int, default=4, help="Number of requests each stub server serves at the same time (as OLLAMA_NUM_PARALLEL)")
+    parser.add_argument("--hosts", type=int, default=1, help="Number of stub servers (more than one uses OLLAMA_HOSTS)")
+    parser.add_argument("--no-memory", action="store_true", help="Do not trace memory allocations (tracing slows Python down)")
+    parser.add_argument("--verbose", action="store_true", help="Show the logs of the navigator")
+    parser.add_argument("--output", default=None, help="Save the results to a JSON file")
+    parser.add_argument("--compare", default=None, help="The JSON results of a previous run to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="With --compare, fail if a p95 latency grows or a throughput drops by more than this ratio")
+    arguments = parser.parse_args()
+
+    output = os.path.abspath(arguments.output) if arguments.output is not None else None
+    baseline = os.path.abspath(arguments.compare) if arguments.compare is not None else None
+    fixtures = get_fixtures(arguments.fixtures)
+    stubs = start_stubs(fixtures, arguments)
+    workspace = create_workspace(fixtures)
+
+    logs = io.StringIO()
+    with contextlib.redirect_stdout(sys.stdout if arguments.verbose else logs):
+        app = import_app(workspace, stubs)
+
+    targets = {'navigator': benchmark_navigator, 'api': benchmark_api}
+    measure_memory = not arguments.no_memory
+    if measure_memory:
+        tracemalloc.start()
+
+    reports = []
+    for concurrency in [int(level) for level in arguments.concurrency.split(",")]:
+        for target in arguments.target or TARGETS:
+            print(f"Benchmarking {target} (concurrency: {concurrency})...")
+            with contextlib.redirect_stdout(sys.stdout if arguments.verbose else logs):
+                reports += targets[target](app, fixtures["descriptions"], arguments.requests, concurrency, measure_memory)
+
+    app.jobs.shutdown()
+    for stub in stubs:
+        stub.stop()
+    shutil.rmtree(workspace, ignore_errors=True)
+
+    print_reports(reports)
+    results = {
+        "commit": get_commit(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "config": {key: value for key, value in vars(arguments).items() if key not in ["output", "compare", "verbose"]},
+        "stub": [stub.stats() for stub in stubs],
+        "reports": reports
+    }
+
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=4)
+        print(f"Saved results to '{output}'")
+
+    if baseline is not None:
+        with open(baseline, "r") as file:
+            regressions = compare(reports, json.load(file)["reports"], arguments.max_regression)
+        if len(regressions) > 0:
+            print("\nRegressions:\n" + "\n".join(f"- {regression}" for regression in regressions))
+            sys.exit(1)
@@ -1,56 +1,228 @@
-import requests
-import zipfile
-import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import argparse
+import hashlib
 import json
+import os
+import shutil
+import threading
+import time
+import zipfile
 
 TEMP_DIR = "./coras-navigator/.temp/"
 RAG_DOCS_DIR = "./coras-navigator/rag-docs/"
+SOURCES_FILE = "./coras-navigator/resource/rag-sources.json"
+
+# The validators (ETag, Last-Modified) and checksums of the downloaded sources, in RAG_DOCS_DIR
+MANIFEST = ".download-manifest.json"
+
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = 60
+
+class DownloadStatus:
+    DOWNLOADED = "downloaded"
+    UNCHANGED = "unchanged"
+    FAILED = "failed"
+
+class SourceDownloader:
+    """
+    Downloads the zipped RAG sources concurrently and extracts them into place. A source is only downloaded again when it changed upstream (conditional request on its ETag or Last-Modified) or when its extracted file does not match its recorded checksum; an interrupted download is resumed (HTTP Range).
+
+    Attributes:
+    - docs_dir:    The folder of the extracted files and of the manifest
+    - temp_dir:    The folder of the (partial) zip files
+    - max_workers: Number of sources downloaded at the same time
+    - manifest:    The validators and checksums of the downloaded sources, by URL
+    """
+
+    def __init__(self, docs_dir: str = RAG_DOCS_DIR, temp_dir: str = TEMP_DIR, max_workers: int = 4):
+        self.docs_dir = docs_dir
+        self.temp_dir = temp_dir
+        self.max_workers = max_workers
+        self.manifest = get_json_from_file(os.path.join(docs_dir, MANIFEST)) if os.path.exists(os.path.join(docs_dir, MANIFEST)) else {}
+        self.__lock = threading.Lock()
+
+    def download_all(self, sources: list[dict], force: bool = False) -> dict[str, str]:
+        """
+        Downloads the sources (entries of rag-sources.json).
+
+        Parameters:
+        - force: Download every source, even if it did not change
+
+        Returns:
+        - The DownloadStatus of each source, by final filename
+        """
+
+        os.makedirs(self.docs_dir, exist_ok=True)
+        os.makedirs(self.temp_dir, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            statuses = list(executor.map(lambda source: self.__download_safely(source, force), sources))
+        return {source['final_filename']: status for source, status in zip(sources, statuses)}
+
+    def download(self, source: dict, force: bool = False) -> str:
+        """
+        Downloads a source if needed and extracts it into place.
+
+        Returns:
+        - The DownloadStatus of the source
+        """
+
+        final_path = os.path.join(self.docs_dir, source['final_filename'])
+        zip_path = os.path.join(self.temp_dir, source['zip_filename'])
+        entry = self.manifest.get(source['url'], {})
+
+        # The validators are only trusted if the extracted file is still the one they describe
+        headers = {}
+        if not force and os.path.exists(final_path) and entry.get("sha256") == get_file_hash(final_path):
+            if entry.get("etag") is not None:
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified") is not None:
+                headers["If-Modified-Since"] = entry["last_modified"]
 
-def create_temp_directory():
-    if not os.path.exists(TEMP_DIR):
-        os.mkdir(TEMP_DIR)
-        print(f"Created directory '{TEMP_DIR}'")
+        start = time.perf_counter()
+        response = self.__fetch(source['url'], zip_path, headers)
+        if response is None:
+            print(f"{source['final_filename']} is up to date.")
+            return DownloadStatus.UNCHANGED
+
+        try:
+            file_hash = extract(zip_path, source['original_filename'], final_path)
+        except zipfile.BadZipFile:
+            # A corrupted (or stale) partial download: start again from scratch
+            os.remove(zip_path)
+            response = self.__fetch(source['url'], zip_path, {})
+            file_hash = extract(zip_path, source['original_filename'], final_path)
+
+        with self.__lock:
+            self.manifest[source['url']] = {
+                "final_filename": source['final_filename'],
+                "etag": response.get("etag"),
+                "last_modified": response.get("last_modified"),
+                "zip_sha256": get_file_hash(zip_path),
+                "sha256": file_hash,
+                "size": os.path.getsize(final_path)
+            }
+            self.__save_manifest()
+        os.remove(zip_path)
+
+        print(f"Downloaded {source['final_filename']} ({os.path.getsize(final_path) / 1024 / 1024:.1f}MB) in {time.perf_counter() - start:.1f}s")
+        return DownloadStatus.DOWNLOADED
+
+    def __download_safely(self, source: dict, force: bool) -> str:
+        try:
+            return self.download(source, force)
+        except Exception as error:
+            print(f"Failed to download {source['final_filename']} from {source['url']}: {error}")
+            return DownloadStatus.FAILED
+
+    def __fetch(self, url: str, zip_path: str, headers: dict) -> dict:
+        """
+        Downloads url to zip_path, resuming a partial download.
+
+        Returns:
+        - The validators of the response ('etag', 'last_modified'), or None if the source did not change (304)
+        """
+
+        partial_path = f"{zip_path}.part"
+        validators_path = f"{zip_path}.part.json"
+        headers = dict(headers)
+
+        # Resume only if the source is still the one the partial download comes from (If-Range)
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        if offset > 0 and os.path.exists(validators_path):
+            saved = get_json_from_file(validators_path)
+            validator = saved.get("etag") or saved.get("last_modified")
+            if validator is not None:
+                headers["Range"] = f"bytes={offset}-"
+                headers["If-Range"] = validator
+
+        try:
+            response = urlopen(Request(url, headers=headers), timeout=TIMEOUT)
+        except HTTPError as error:
+            if error.code == 304:
+                return None
+            if error.code == 416:
+                # The partial download is complete or invalid: start again
+                os.remove(partial_path)
+                return self.__fetch(url, zip_path, {key: value for key, value in headers.items() if key not in ["Range", "If-Range"]})
+            raise
+
+        with response:
+            validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified")
+            }
+            resumed = response.status == 206
+            if not resumed:
+                with open(validators_path, "w") as file:
+                    json.dump(validators, file)
+            else:
+                print(f"Resuming {os.path.basename(zip_path)} from {offset / 1024 / 1024:.1f}MB...")
+
+            with open(partial_path, "ab" if resumed else "wb") as file:
+                shutil.copyfileobj(response, file, CHUNK_SIZE)
+
+        expected_size = response.headers.get("Content-Length")
+        if expected_size is not None and os.path.getsize(partial_path) != (offset if resumed else 0) + int(expected_size):
+            raise Exception(f"Incomplete download of {url}")
+
+        os.replace(partial_path, zip_path)
+        os.remove(validators_path)
+        return validators
+
+    def __save_manifest(self) -> None:
+        path = os.path.join(self.docs_dir, MANIFEST)
+        with open(f"{path}.tmp", "w") as file:
+            json.dump(self.manifest, file, indent=4)
+        os.replace(f"{path}.tmp", path)
 
 def get_json_from_file(filepath: str):
     with open(filepath, 'r') as file:
         data = json.load(file)
     return data
 
-def download(url: str, save_path: str, chunk_size=128):
-    print(f"Downloading {save_path} from {url}...")
-    r = requests.get(url, stream=True)
-    with open(save_path, 'wb') as fd:
-        for chunk in r.iter_content(chunk_size=chunk_size):
-            fd.write(chunk)
-
-def extract(filepath: str, extract_directory: str):
-    print(f"Extracting  {filepath} to {extract_directory}...")
-    with zipfile.ZipFile(filepath, "r") as zip_file:
-        zip_file.extractall(extract_directory)
-
-def delete(filepath: str):
-    print(f"Deleting    {filepath}...")
-    os.remove(filepath)
-
-def rename(filename: str, new_filename: str):
-    print(f"Renaming    {filename} to {new_filename}...")
-    os.rename(filename, new_filename)
-
-def download_rag_docs():
-    json = get_json_from_file("./coras-navigator/resource/rag-sources.json")
-    
-    for source in json["zip_sources"]: 
-        if os.path.exists(f"{RAG_DOCS_DIR}{source['final_filename']}"):
-            print(f"File {RAG_DOCS_DIR}{source['final_filename']} already exists.\n***") 
-            continue       
- 
-        download(source['url'], f"{TEMP_DIR}{source['zip_filename']}")
-        extract(f"{TEMP_DIR}{source['zip_filename']}", RAG_DOCS_DIR)
-        delete(f"{TEMP_DIR}{source['zip_filename']}")
-        rename(f"{RAG_DOCS_DIR}{source['original_filename']}", f"{RAG_DOCS_DIR}{source['final_filename']}")
-        print("***")
+def get_file_hash(filepath: str) -> str:
+    with open(filepath, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+def extract(zip_path: str, member: str, final_path: str) -> str:
+    """
+    Extracts a file of a zip straight to its final path (replaced atomically). The CRC of the file is checked while it is read.
+
+    Returns:
+    - The SHA-256 of the extracted file
+    """
+
+    digest = hashlib.sha256()
+    try:
+        with zipfile.ZipFile(zip_path, "r") as zip_file, zip_file.open(member) as file_in, open(f"{final_path}.tmp", "wb") as file_out:
+            while chunk := file_in.read(CHUNK_SIZE):
+                digest.update(chunk)
+                file_out.write(chunk)
+        os.replace(f"{final_path}.tmp", final_path)
+    finally:
+        if os.path.exists(f"{final_path}.tmp"):
+            os.remove(f"{final_path}.tmp")
+    return digest.hexdigest()
+
+def download_rag_docs(sources_file: str = SOURCES_FILE, docs_dir: str = RAG_DOCS_DIR, temp_dir: str = TEMP_DIR, max_workers: int = 4, force: bool = False) -> dict[str, str]:
+    sources = get_json_from_file(sources_file)["zip_sources"]
+    statuses = SourceDownloader(docs_dir, temp_dir, max_workers).download_all(sources, force)
+
+    counts = {status: list(statuses.values()).count(status) for status in [DownloadStatus.DOWNLOADED, DownloadStatus.UNCHANGED, DownloadStatus.FAILED]}
+    print(f"{counts[DownloadStatus.DOWNLOADED]} downloaded, {counts[DownloadStatus.UNCHANGED]} unchanged, {counts[DownloadStatus.FAILED]} failed")
+    return statuses
 
 if __name__ == "__main__":
-    create_temp_directory()
-    download_rag_docs()
+    parser = argparse.ArgumentParser(description="Downloads the CAPEC and CWE files listed in rag-sources.json, when they changed upstream.")
+    parser.add_argument("--sources", default=SOURCES_FILE)
+    parser.add_argument("--directory", default=RAG_DOCS_DIR, help="The folder of the extracted files")
+    parser.add_argument("--workers", type=int, default=4, help="Number of files downloaded at the same time")
+    parser.add_argument("--force", action="store_true", help="Download every file, even if it did not change")
+    arguments = parser.parse_args()
 
+    statuses = download_rag_docs(arguments.sources, arguments.directory, TEMP_DIR, arguments.workers, arguments.force)
+    if DownloadStatus.FAILED in statuses.values():
+        exit(1)
@@ -1,5 +1,12 @@
+from contextlib import contextmanager
+from typing import Iterator
+import argparse
 import csv
+import hashlib
 import json
+import os
+import sqlite3
+import time
 
 class Capec:
     ID = 0
@@ -50,6 +57,74 @@ class CWE:
 
 NAVIGATOR_DIR = "./coras-navigator/"
 
+CAPEC_FILE = "capec-mechanisms-of-attack.csv"
+CWE_FILES = [
+    "cwe-software-development.csv",
+    "cwe-hardware-design.csv",
+    "cwe-research-concepts.csv"
+]
+ABSTRACT_FILE = "capec-abstract.txt"
+DETAILED_FILE = "capec-detailed.json"
+SQLITE_FILE = "capec-detailed.sqlite"
+
+# The hashes of the inputs of the last build, and the entries read from each CWE file
+MANIFEST = ".format-manifest.json"
+CACHE_DIR = ".format-cache/"
+# Changes when the outputs are written differently, so that they are rebuilt even if the inputs did not change
+FORMAT_VERSION = 2
+
+SQLITE_BATCH_SIZE = 500
+
+class Timings:
+    """
+    The time spent in each step of the build.
+    """
+
+    def __init__(self):
+        self.steps = {}
+
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = self.steps.get(name, 0.0) + time.perf_counter() - start
+
+    def report(self) -> str:
+        lines = [f"{name:<24} {seconds:>8.3f}s" for name, seconds in self.steps.items()]
+        lines.append(f"{'total':<24} {sum(self.steps.values()):>8.3f}s")
+        return "\n".join(lines)
+
+@contextmanager
+def atomic_open(filename: str, mode: str = "w"):
+    """
+    Opens a temporary file which replaces filename once it is completely written (readers never see a partial file).
+    """
+
+    temp_filename = f"{filename}.tmp"
+    try:
+        with open(temp_filename, mode, encoding=None if "b" in mode else "utf-8") as file:
+            yield file
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+def get_file_hash(filename: str) -> str:
+    with open(filename, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+def read_csv_rows(filename: str) -> Iterator[list[str]]:
+    """
+    Yields the rows of a CSV file, without its header.
+    """
+
+    with open(filename, "r", encoding="utf-8", newline="") as file:
+        reader = csv.reader(file)
+        next(reader, None)
+        yield from reader
+
 def format_capec_document_row(row, ids) -> str:
     mitigations = list(filter(lambda x: x != '', row[Capec.MITIGATIONS].split("::")))
 
@@ -58,87 +133,203 @@ def format_capec_document_row(row, ids) -> str:
         text += f"- {mitigation}\n"
     return (f"{text};\n", ids)
 
-def format_cwe_document_row(row, cwe_ids) -> str:
+def format_cwe_document_row(row, cwe_ids: set) -> str:
     if row[CWE.ID] in cwe_ids:
         return ("", cwe_ids)
 
-    cwe_ids.append(row[CWE.ID])
+    cwe_ids.add(row[CWE.ID])
     if row[CWE.WEAKNESS_ABSTRACTION] == "Variant":
         return ("", cwe_ids)
 
     return (f"CWE-{row[CWE.ID]}: {row[CWE.NAME]}: {row[CWE.DESCRIPTION]};\n", cwe_ids)
 
 def format_csv_documents(filenames_in: list[str], filename_out: str, format_row) -> None:
-    row_ids = []
+    row_ids = set()
 
-    with open(filename_out, "w") as file_out:
+    with atomic_open(filename_out) as file_out:
         for filename_in in filenames_in:
-            with open(filename_in, "r") as file_in:
-                reader = csv.reader(file_in)
-                title = reader.__next__()
-                for row in reader:
-                    text, row_ids = format_row(row, row_ids)
-                    file_out.write(text)
+            for row in read_csv_rows(filename_in):
+                text, row_ids = format_row(row, row_ids)
+                file_out.write(text)
+
+def get_cwe_entries(filename: str) -> dict[str, str]:
+    """
+    Reads the CWE entries of a file (the first row of an ID wins), by ID.
+    """
+
+    entries = {}
+    for row in read_csv_rows(filename):
+        if row[CWE.ID] not in entries:
+            entries[row[CWE.ID]] = f"CWE-{row[CWE.ID]}: {row[CWE.NAME]}: {row[CWE.DESCRIPTION]}"
+    return entries
+
+def get_cwe_dict(cwe_files: list[str], hashes: dict[str, str] = {}, cache_dir: str = None):
+    """
+    Reads the CWE entries of several files (a file listed first wins for an ID shared by several files).
 
-def get_cwe_dict(cwe_files: list[str]):
-    read_cwe_ids = []
-    cwe_dict = {}    
+    Parameters:
+    - cwe_files: The CWE files
+    - hashes:    The hash of each file, to reuse the entries read from an unchanged file
+    - cache_dir: The folder where the entries read from each file are kept (None to disable)
+    """
 
+    cwe_dict = {}
     for filename in cwe_files:
-        with open(filename, "r") as file:
-            reader = csv.reader(file)
-            title = reader.__next__()
-            for row in reader:
-                if row[CWE.ID] in read_cwe_ids:
-                    continue
-                
-                read_cwe_ids.append(row[CWE.ID])
-                cwe_dict[row[CWE.ID]] = f"CWE-{row[CWE.ID]}: {row[CWE.NAME]}: {row[CWE.DESCRIPTION]}"
-    
+        entries = None
+        cache_file = os.path.join(cache_dir, f"{os.path.basename(filename)}.json") if cache_dir is not None else None
+        if cache_file is not None and filename in hashes and os.path.exists(cache_file):
+            with open(cache_file, "r", encoding="utf-8") as file:
+                cached = json.load(file)
+            if cached.get("sha256") == hashes[filename]:
+                entries = cached["entries"]
+
+        if entries is None:
+            entries = get_cwe_entries(filename)
+            if cache_file is not None and filename in hashes:
+                os.makedirs(cache_dir, exist_ok=True)
+                with atomic_open(cache_file) as file:
+                    json.dump({"sha256": hashes[filename], "entries": entries}, file, separators=(",", ":"))
+        else:
+            print(f"'{filename}' unchanged, reusing its entries.")
+
+        for cwe_id, text in entries.items():
+            cwe_dict.setdefault(cwe_id, text)
+
     print(f"Saved {len(cwe_dict)} CWE entires.")
     return cwe_dict
 
-def construct_capec_detailed(filename_in: str, filename_out_abstract: str, filename_out_detailed: str, cwe_dict) -> None:
+def get_capec_entries(filename_in: str, cwe_dict: dict[str, str], unknown_cwes: set = None) -> Iterator[tuple[str, str, str]]:
+    """
+    Yields the (ID, abstract text, detailed text) of each CAPEC entry, one row at a time.
+
+    Parameters:
+    - unknown_cwes: Receives the related weaknesses missing from cwe_dict (they are listed by ID only)
+    """
+
+    for row in read_csv_rows(filename_in):
+        mitigations = "".join(f"- {mitigation}\n" for mitigation in row[Capec.MITIGATIONS].split("::") if mitigation != "")
+        cwes = ""
+        for cwe in filter(lambda x: x != '', row[Capec.RELATED_WEAKNESSES].split("::")):
+            if cwe not in cwe_dict and unknown_cwes is not None:
+                unknown_cwes.add(cwe)
+            cwes += f"- {cwe_dict.get(cwe, f'CWE-{cwe}')}\n"
+
+        text_abstract = f"[CAPEC-{row[Capec.ID]}]: {row[Capec.NAME]}: {row[Capec.DESCRIPTION]};\n"
+        text_detailed = f"[CAPEC-{row[Capec.ID]}]\n**Attack pattern**: {row[Capec.NAME]}\n**Description**: {row[Capec.DESCRIPTION]}\n**Vulnerabilities**:\n{cwes}**Mitigations**:\n{mitigations}"
+        yield row[Capec.ID], text_abstract, text_detailed
+
+@contextmanager
+def create_capec_sqlite(filename_out: str):
+    """
+    Creates the SQLite store of the detailed entries in a temporary file, which replaces filename_out once it is completely written.
+
+    Returns:
+    - The connection, in a transaction
+    """
+
+    temp_filename = f"{filename_out}.tmp"
+    if os.path.exists(temp_filename):
+        os.remove(temp_filename)
+
+    connection = sqlite3.connect(temp_filename)
+    try:
+        # A failed build is simply started again: no journal needed
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("CREATE TABLE capec (id TEXT PRIMARY KEY, text TEXT NOT NULL) WITHOUT ROWID")
+        yield connection
+        connection.commit()
+        connection.close()
+        os.replace(temp_filename, filename_out)
+    finally:
+        connection.close()
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+def construct_capec_detailed(filename_in: str, filename_out_abstract: str, filename_out_detailed: str, filename_out_sqlite: str, cwe_dict) -> None:
+    """
+    Writes the abstract (TXT), detailed (compact JSON) and indexed detailed (SQLite) CAPEC documents in one pass over the CAPEC file, without holding the entries in memory.
+    """
+
     count = 0
-    capec_dict = {}
-
-    with open(filename_in, "r") as file_in, open(filename_out_abstract, "w") as file_out, open(filename_out_detailed, "w") as json_file:
-        reader = csv.reader(file_in)
-        title = reader.__next__()
-        for row in reader:
-            mitigation_list = list(filter(lambda x: x != '', row[Capec.MITIGATIONS].split("::")))
-            mitigations = ""
-            cwe_list = list(filter(lambda x: x != '', row[Capec.RELATED_WEAKNESSES].split("::")))
-            cwes = ""
-            
-            text_abstract = f"[CAPEC-{row[Capec.ID]}]: {row[Capec.NAME]}: {row[Capec.DESCRIPTION]};\n"
-            file_out.write(text_abstract)
+    batch = []
+    unknown_cwes = set()
 
-            for mitigation in mitigation_list:
-                mitigations += f"- {mitigation}\n"
-            for cwe in cwe_list:
-                cwes += f"- {cwe_dict[cwe]}\n"
+    with atomic_open(filename_out_abstract) as file_out, atomic_open(filename_out_detailed) as json_file, create_capec_sqlite(filename_out_sqlite) as connection:
+        json_file.write("{")
+        for capec_id, text_abstract, text_detailed in get_capec_entries(filename_in, cwe_dict, unknown_cwes):
+            file_out.write(text_abstract)
+            json_file.write(f"{',' if count > 0 else ''}{json.dumps(capec_id)}:{json.dumps(text_detailed)}")
 
-            text_detailed = f"[CAPEC-{row[Capec.ID]}]\n**Attack pattern**: {row[Capec.NAME]}\n**Description**: {row[Capec.DESCRIPTION]}\n**Vulnerabilities**:\n{cwes}**Mitigations**:\n{mitigations}"
-            capec_dict[row[Capec.ID]] = text_detailed
+            batch.append((capec_id, text_detailed))
+            if len(batch) >= SQLITE_BATCH_SIZE:
+                connection.executemany("INSERT INTO capec (id, text) VALUES (?, ?)", batch)
+                batch = []
             count += 1
+        connection.executemany("INSERT INTO capec (id, text) VALUES (?, ?)", batch)
+        json_file.write("}")
+
+    if len(unknown_cwes) > 0:
+        print(f"{len(unknown_cwes)} related weaknesses are not in the CWE files: {', '.join(sorted(unknown_cwes))}")
+    print(f"Saved {count} CAPEC entries (abstract) to '{filename_out_abstract}'.")
+    print(f"Saved {count} CAPEC entries (detailed) to '{filename_out_detailed}'.")
+    print(f"Saved {count} CAPEC entries (detailed) to '{filename_out_sqlite}'.")
+
+def read_manifest(filename: str) -> dict:
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+def format_rag_docs(directory: str, force: bool = False) -> dict:
+    """
+    Builds the RAG documents from the CAPEC and CWE files of directory, unless neither the inputs nor the format changed since the last build.
+
+    Returns:
+    - The report of the build: whether it was skipped, and the time spent in each step
+    """
 
-        json.dump(capec_dict, json_file, indent=4) 
-        print(f"Saved {count} CAPEC entries (abstract) to '{filename_out_abstract}'.")
-        print(f"Saved {count} CAPEC entries (detailed) to '{filename_out_detailed}'.")
+    timings = Timings()
+    inputs = [os.path.join(directory, CAPEC_FILE)] + [os.path.join(directory, filename) for filename in CWE_FILES]
+    outputs = [os.path.join(directory, filename) for filename in [ABSTRACT_FILE, DETAILED_FILE, SQLITE_FILE]]
+    manifest_file = os.path.join(directory, MANIFEST)
+
+    with timings.step("hash inputs"):
+        hashes = {filename: get_file_hash(filename) for filename in inputs}
+    manifest = {
+        "version": FORMAT_VERSION,
+        "inputs": {os.path.basename(filename): file_hash for filename, file_hash in hashes.items()}
+    }
+
+    skipped = not force and read_manifest(manifest_file) == manifest and all(os.path.exists(filename) for filename in outputs)
+    if skipped:
+        print("RAG docs are up to date.")
+    else:
+        with timings.step("read CWE"):
+            cwe_dict = get_cwe_dict(inputs[1:], hashes, os.path.join(directory, CACHE_DIR))
+        with timings.step("build CAPEC"):
+            construct_capec_detailed(inputs[0], *outputs, cwe_dict)
+        # Written last: an interrupted build is done again
+        with atomic_open(manifest_file) as file:
+            json.dump(manifest, file, indent=4)
+
+    print(timings.report())
+    return {
+        "skipped": skipped,
+        "timings": timings.steps
+    }
 
 if __name__ == "__main__":
-    cwe_dict = get_cwe_dict([
-        f"{NAVIGATOR_DIR}rag-docs/cwe-software-development.csv",
-        f"{NAVIGATOR_DIR}rag-docs/cwe-hardware-design.csv",
-        f"{NAVIGATOR_DIR}rag-docs/cwe-research-concepts.csv"
-    ])
-    construct_capec_detailed(
-        f"{NAVIGATOR_DIR}rag-docs/capec-mechanisms-of-attack.csv",
-        f"{NAVIGATOR_DIR}rag-docs/capec-abstract.txt",
-        f"{NAVIGATOR_DIR}rag-docs/capec-detailed.json",
-        cwe_dict
-    )
+    parser = argparse.ArgumentParser(description="Builds the RAG documents (abstract and detailed CAPEC entries) from the downloaded CAPEC and CWE files.")
+    parser.add_argument("--directory", default=f"{NAVIGATOR_DIR}rag-docs/", help="The folder of the downloaded files and of the RAG documents")
+    parser.add_argument("--force", action="store_true", help="Build the documents even if the inputs did not change")
+    parser.add_argument("--report", default=None, help="Save the report of the build (JSON)")
+    arguments = parser.parse_args()
+
+    report = format_rag_docs(arguments.directory, arguments.force)
+    if arguments.report is not None:
+        with open(arguments.report, "w") as file:
+            json.dump(report, file, indent=4)
 
     # format_csv_documents([
     #         f"{NAVIGATOR_DIR}rag-docs/capec-mechanisms-of-attack.csv"
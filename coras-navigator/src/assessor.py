@@ -2,6 +2,10 @@ from langchain_ollama import ChatOllama
 from langchain_core.messages import AIMessage
 from langchain_core.prompts import ChatPromptTemplate
 
+from functools import cached_property
+from typing import AsyncIterator, Iterator
+import asyncio
+
 class RiskAssessor:
     """
     Agent responsible of generating the textual risk analysis.
@@ -12,11 +16,14 @@ class RiskAssessor:
 
     llm = None
 
-    def __init__(self, model: str):
-        self.llm = ChatOllama(
-            model=model,
-            temperature=0
-        )
+    def __init__(self, model: str, residency: "ModelResidency" = None):
+        if residency is not None:
+            self.llm = residency.chat_model(model)
+        else:
+            self.llm = ChatOllama(
+                model=model,
+                temperature=0
+            )
 
     def assess(self, description: str, context: str) -> str:
         """
@@ -32,6 +39,34 @@ class RiskAssessor:
 
         raise Exception("Invalid class: RiskAssessor::assess() not implemented")
 
+    def assess_stream(self, description: str, context: str) -> Iterator[str]:
+        """
+        Performs the risk analysis, yielding the result as it is generated. By default, the whole result is yielded at once.
+
+        Parameters:
+        - description: A description of the target of analysis
+        - context:     Some context (retrieved with RAG)
+
+        Returns:
+        - An iterator over chunks of the risk analysis
+        """
+
+        yield self.assess(description, context)
+
+    async def aassess(self, description: str, context: str) -> str:
+        """
+        Performs the risk analysis without blocking the event loop. By default, assess() is run in a thread.
+        """
+
+        return await asyncio.to_thread(self.assess, description, context)
+
+    async def aassess_stream(self, description: str, context: str) -> AsyncIterator[str]:
+        """
+        Performs the risk analysis without blocking the event loop, yielding the result as it is generated. By default, the whole result is yielded at once.
+        """
+
+        yield await self.aassess(description, context)
+
 class SimpleRiskAssessor(RiskAssessor):
     system_prompt = """
 You are an expert in cybersecurity risk assessment. From the description of a system (delimited by ###) and provided context (delimited by <context></context>), you perform a cybersecurity risk assessment of the system.
@@ -40,16 +75,42 @@ Then, from this high-level analysis, specify for each risk the following items:
 """
 
     def assess(self, description: str, context: str) -> str:
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", self.system_prompt),
-            ("human", "Analyze the following system:\n###\n{description}\n###\n<context>\n{context}\n</context>\n\nWhen citing vulnerabilities, you must tell if they are retrieved from the context or not.")
-        ])
+        result = self.__chain.invoke({
+            "description": description,
+            "context": context
+        })
+
+        return result.content
+
+    def assess_stream(self, description: str, context: str) -> Iterator[str]:
+        for chunk in self.__chain.stream({
+            "description": description,
+            "context": context
+        }):
+            yield chunk.content
 
-        chain = prompt | self.llm
-        result = chain.invoke({
+    async def aassess(self, description: str, context: str) -> str:
+        result = await self.__chain.ainvoke({
             "description": description,
             "context": context
         })
 
         return result.content
 
+    async def aassess_stream(self, description: str, context: str) -> AsyncIterator[str]:
+        async for chunk in self.__chain.astream({
+            "description": description,
+            "context": context
+        }):
+            yield chunk.content
+
+    @cached_property
+    def __chain(self):
+        # The static system prompt comes first so that Ollama reuses its evaluation across requests
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", self.system_prompt),
+            ("human", "Analyze the following system:\n###\n{description}\n###\n<context>\n{context}\n</context>\n\nWhen citing vulnerabilities, you must tell if they are retrieved from the context or not.")
+        ])
+
+        return prompt | self.llm
+
@@ -0,0 +1,105 @@
+from reranker import tokenize
+
+from collections import Counter
+import json
+import math
+import os
+
+class BM25Index:
+    """
+    An inverted index scoring documents with Okapi BM25. It complements embeddings on exact technical terms (protocol names, CWE numbers...).
+
+    Attributes:
+    - k1:             Term frequency saturation
+    - b:              Document length normalization
+    - postings:       For each term, the frequency of the term in each document containing it
+    - document_lengths: Number of terms of each document
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.document_lengths = {}
+
+    @staticmethod
+    def build(documents: dict[str, str], k1: float = 1.5, b: float = 0.75):
+        """
+        Indexes documents.
+
+        Parameters:
+        - documents: The text of the documents, by ID
+        """
+
+        index = BM25Index(k1, b)
+        for document_id, text in documents.items():
+            terms = tokenize(text)
+            index.document_lengths[document_id] = len(terms)
+            for term, frequency in Counter(terms).items():
+                index.postings.setdefault(term, {})[document_id] = frequency
+        return index
+
+    def search(self, query: str, k: int) -> list[tuple[str, float]]:
+        """
+        Returns the k documents with the best score for the query, as (ID, score) pairs, the best first.
+        """
+
+        if len(self.document_lengths) == 0:
+            return []
+
+        document_count = len(self.document_lengths)
+        average_length = sum(self.document_lengths.values()) / document_count
+
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+
+            idf = math.log(1 + (document_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for document_id, frequency in postings.items():
+                length_ratio = self.document_lengths[document_id] / average_length if average_length > 0 else 0
+                scores[document_id] = scores.get(document_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + self.k1 * (1 - self.b + self.b * length_ratio))
+
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def save(self, file_path: str) -> None:
+        temporary_path = f"{file_path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump({
+                "k1": self.k1,
+                "b": self.b,
+                "document_lengths": self.document_lengths,
+                "postings": self.postings
+            }, file, separators=(",", ":"))
+        os.replace(temporary_path, file_path)
+
+    @staticmethod
+    def load(file_path: str):
+        with open(file_path, "r") as file:
+            data = json.load(file)
+
+        index = BM25Index(data["k1"], data["b"])
+        index.document_lengths = data["document_lengths"]
+        index.postings = data["postings"]
+        return index
+
+def reciprocal_rank_fusion(rankings: list[list[str]], weights: list[float], k: int = 60) -> list[str]:
+    """
+    Merges rankings of document IDs with (weighted) reciprocal rank fusion: a document scores weight / (k + rank) for each ranking it appears in.
+
+    Parameters:
+    - rankings: Lists of IDs, the best first
+    - weights:  The weight of each ranking
+    - k:        Dampens the advantage of the top ranks
+
+    Returns:
+    - The IDs of all the ranked documents, the best first
+    """
+
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, document_id in enumerate(ranking):
+            scores[document_id] = scores.get(document_id, 0.0) + weight / (k + rank + 1)
+
+    return sorted(scores, key=lambda document_id: scores[document_id], reverse=True)
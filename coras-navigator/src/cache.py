@@ -0,0 +1,167 @@
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.load import dumps, loads
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from hashlib import sha256
+import os
+import threading
+
+_bypass = ContextVar("llm_cache_bypass", default=False)
+
+@contextmanager
+def bypass_llm_cache(enabled: bool = True):
+    """
+    Disables the LLM cache for the calls made within the context (in the current thread), e.g. when the user explicitly asks to regenerate an answer.
+
+    Parameters:
+    - enabled: Whether the cache is actually bypassed
+    """
+
+    token = _bypass.set(enabled)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+def is_llm_cache_bypassed() -> bool:
+    return _bypass.get()
+
+class LLMCache(BaseCache):
+    """
+    A two-tier cache of LLM generations, keyed by the model and its generation parameters (llm_string) and the rendered prompt. Only relevant for deterministic calls (temperature=0).
+
+    Attributes:
+    - directory:      The folder of the on-disk tier
+    - memory_entries: Maximum number of generations kept in memory (least recently used are evicted)
+    - max_bytes:      Maximum size of the on-disk tier (least recently used are evicted)
+    - hits:           Number of lookups served from memory or disk
+    - misses:         Number of lookups that required a generation
+    """
+
+    def __init__(self, directory: str, memory_entries: int = 256, max_bytes: int = 512 * 1024 * 1024):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+
+        self.__lock = threading.Lock()
+        self.__memory = OrderedDict()
+        self.__disk = self.__index_directory()
+
+    def lookup(self, prompt: str, llm_string: str) -> RETURN_VAL_TYPE:
+        if _bypass.get():
+            return None
+
+        key = get_cache_key(prompt, llm_string)
+        with self.__lock:
+            if key in self.__memory:
+                self.__memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return self.__memory[key]
+
+            if key in self.__disk:
+                generations = self.__read(key)
+                if generations is not None:
+                    self.__remember(key, generations)
+                    self.hits += 1
+                    return generations
+
+            self.misses += 1
+            return None
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        if _bypass.get():
+            return
+
+        key = get_cache_key(prompt, llm_string)
+        with self.__lock:
+            self.__remember(key, return_val)
+            self.__write(key, return_val)
+
+    def clear(self, **kwargs) -> None:
+        with self.__lock:
+            self.__memory.clear()
+            for key in list(self.__disk):
+                self.__remove(key)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'memory_hits': self.memory_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+            'memory_entries': len(self.__memory),
+            'disk_entries': len(self.__disk),
+            'disk_bytes': sum(self.__disk.values())
+        }
+
+    def __remember(self, key: str, generations: RETURN_VAL_TYPE) -> None:
+        self.__memory[key] = generations
+        self.__memory.move_to_end(key)
+        while len(self.__memory) > self.memory_entries:
+            self.__memory.popitem(last=False)
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def __index_directory(self) -> OrderedDict:
+        """
+        Lists the entries of the on-disk tier, from the least to the most recently used.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            stat = os.stat(os.path.join(self.directory, filename))
+            entries.append((stat.st_mtime, filename[:-len(".json")], stat.st_size))
+
+        return OrderedDict((key, size) for (_, key, size) in sorted(entries))
+
+    def __read(self, key: str) -> RETURN_VAL_TYPE:
+        try:
+            with open(self.__path(key), "r") as file:
+                generations = loads(file.read())
+            os.utime(self.__path(key))
+        except (OSError, ValueError):
+            # Evicted by another process or corrupted
+            self.__disk.pop(key, None)
+            return None
+
+        self.__disk.move_to_end(key)
+        return generations
+
+    def __write(self, key: str, generations: RETURN_VAL_TYPE) -> None:
+        content = dumps(list(generations))
+        temporary_path = f"{self.__path(key)}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as file:
+            file.write(content)
+        os.replace(temporary_path, self.__path(key))
+
+        self.__disk[key] = os.path.getsize(self.__path(key))
+        self.__disk.move_to_end(key)
+        self.__evict()
+
+    def __evict(self) -> None:
+        size = sum(self.__disk.values())
+        while size > self.max_bytes and len(self.__disk) > 1:
+            key = next(iter(self.__disk))
+            size -= self.__disk[key]
+            self.__remove(key)
+
+    def __remove(self, key: str) -> None:
+        self.__disk.pop(key, None)
+        try:
+            os.remove(self.__path(key))
+        except FileNotFoundError:
+            pass
+
+def get_cache_key(prompt: str, llm_string: str) -> str:
+    return sha256(f"{llm_string}\0{prompt}".encode("utf-8")).hexdigest()
@@ -0,0 +1,159 @@
+from reranker import tokenize
+
+from typing import Callable
+import math
+import re
+
+class CapecEntry:
+    """
+    A detailed CAPEC entry, as written by format-rag-docs.py, split into its header (ID, attack pattern and description) and the items of its "Vulnerabilities" and "Mitigations" sections.
+
+    Attributes:
+    - text:            The entry, verbatim
+    - capec_id:        The ID of the entry (None if it has no "[CAPEC-N]" heading)
+    - header:          The text before the sections
+    - vulnerabilities: The items of the "Vulnerabilities" section (e.g. "- CWE-89: ...")
+    - mitigations:     The items of the "Mitigations" section
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        capec_id = re.search(r"\[CAPEC-(\d+)\]", text)
+        self.capec_id = capec_id.group(1) if capec_id is not None else None
+
+        sections = re.split(r"^\*\*(Vulnerabilities|Mitigations)\*\*:[ \t]*\n?", text, flags=re.MULTILINE)
+        self.header = sections[0].rstrip("\n")
+        items = {"Vulnerabilities": [], "Mitigations": []}
+        for name, content in zip(sections[1::2], sections[2::2]):
+            items[name] = [line for line in content.splitlines() if line.strip() != ""]
+        self.vulnerabilities = items["Vulnerabilities"]
+        self.mitigations = items["Mitigations"]
+
+    def render(self, vulnerabilities: list[str], mitigations: list[str]) -> str:
+        """
+        Writes the entry back with only the given items (the entry is returned verbatim if nothing was cut).
+        """
+
+        if len(vulnerabilities) == len(self.vulnerabilities) and len(mitigations) == len(self.mitigations):
+            return self.text
+
+        text = self.header + "\n"
+        if len(vulnerabilities) > 0:
+            text += "**Vulnerabilities**:\n" + "".join(f"{item}\n" for item in vulnerabilities)
+        if len(mitigations) > 0:
+            text += "**Mitigations**:\n" + "".join(f"{item}\n" for item in mitigations)
+        return text
+
+class ContextBuilder:
+    """
+    Assembles the retrieved CAPEC entries into the context of the risk assessor within a token budget. The header of each entry is kept first, in order of relevance of the entries; the remaining budget is then filled with the vulnerabilities and mitigations that relate best to the query. What did not fit is reported.
+
+    Attributes:
+    - budget:         Maximum number of tokens of the context (None for no limit)
+    - num_ctx:        The context window of the model (None if unknown). The context is also limited to what the window leaves after the rest of the prompt and the answer.
+    - answer_tokens:  Number of tokens of the window kept for the answer
+    - count_tokens:   Counts the tokens of a text
+    """
+
+    def __init__(self, budget: int = None, num_ctx: int = None, answer_tokens: int = 2048, count_tokens: Callable[[str], int] = None):
+        self.budget = budget
+        self.num_ctx = num_ctx
+        self.answer_tokens = answer_tokens
+        self.count_tokens = count_tokens if count_tokens is not None else estimate_tokens
+
+    def get_budget(self, prompt: str = "") -> int:
+        """
+        Returns the number of tokens available for the context, given the rest of the prompt (None for no limit).
+        """
+
+        budgets = []
+        if self.budget is not None:
+            budgets.append(self.budget)
+        if self.num_ctx is not None:
+            budgets.append(self.num_ctx - self.answer_tokens - self.count_tokens(prompt))
+        return max(0, min(budgets)) if len(budgets) > 0 else None
+
+    def build(self, query: str, entries: list[str], prompt: str = "") -> tuple[str, dict]:
+        """
+        Parameters:
+        - query:   The text used for retrieval, to rank the items of the entries
+        - entries: The retrieved entries, in order of relevance
+        - prompt:  The rest of the prompt (system prompt, description...), which shares the context window
+
+        Returns:
+        - The context
+        - The report: the budget, the tokens used, and for each entry whether it was kept and how many of its items were kept
+        """
+
+        budget = self.get_budget(prompt)
+        parsed = [CapecEntry(entry) for entry in entries]
+        used = 0
+
+        # Headers first, in order of relevance: an entry whose header does not fit is dropped
+        kept = []
+        for entry in parsed:
+            # The entries are separated by an empty line
+            tokens = self.count_tokens(entry.header + "\n\n")
+            if budget is None or used + tokens <= budget:
+                kept.append(entry)
+                used += tokens
+
+        # Then the items, the most relevant first
+        query_terms = set(tokenize(query))
+        items = []
+        for rank, entry in enumerate(kept):
+            for section in ["vulnerabilities", "mitigations"]:
+                for position, item in enumerate(getattr(entry, section)):
+                    items.append((get_item_score(query_terms, item, rank), entry, section, position, item))
+        # Section titles are counted with the first item of each section
+        counted_sections = set()
+        selected = set()
+        for score, entry, section, position, item in sorted(items, key=lambda item: item[0], reverse=True):
+            tokens = self.count_tokens(f"{item}\n")
+            if (id(entry), section) not in counted_sections:
+                tokens += self.count_tokens("**Vulnerabilities**:\n" if section == "vulnerabilities" else "**Mitigations**:\n")
+            if budget is None or used + tokens <= budget:
+                selected.add((id(entry), section, position))
+                counted_sections.add((id(entry), section))
+                used += tokens
+
+        texts = []
+        report_entries = []
+        for entry in parsed:
+            if entry not in kept:
+                report_entries.append({"capec_id": entry.capec_id, "kept": False})
+                continue
+
+            vulnerabilities = [item for position, item in enumerate(entry.vulnerabilities) if (id(entry), "vulnerabilities", position) in selected]
+            mitigations = [item for position, item in enumerate(entry.mitigations) if (id(entry), "mitigations", position) in selected]
+            texts.append(entry.render(vulnerabilities, mitigations))
+            report_entries.append({
+                "capec_id": entry.capec_id,
+                "kept": True,
+                "vulnerabilities": f"{len(vulnerabilities)}/{len(entry.vulnerabilities)}",
+                "mitigations": f"{len(mitigations)}/{len(entry.mitigations)}"
+            })
+
+        context = "".join(f"{text}\n" for text in texts)
+        return context, {
+            "budget": budget,
+            "tokens": self.count_tokens(context),
+            "cut": len(kept) < len(parsed) or len(selected) < len(items),
+            "entries": report_entries
+        }
+
+def get_item_score(query_terms: set[str], item: str, rank: int) -> float:
+    """
+    Scores an item of an entry: the share of its terms found in the query, weighted by the rank of its entry. An item that relates to the query comes before the unrelated items of a more relevant entry.
+    """
+
+    terms = set(tokenize(item))
+    overlap = len(terms & query_terms) / len(terms) if len(terms) > 0 else 0.0
+    return (overlap + 0.25) / (1 + rank)
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens of a text for Llama 3 models (about 4 characters per token in English), slightly overestimated so that the context window is not exceeded.
+    """
+
+    return math.ceil(len(text) / 3.5)
@@ -0,0 +1,155 @@
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+import faiss
+
+import json
+import os
+import sqlite3
+import threading
+
+class SQLiteDocstore(Docstore, AddableMixin):
+    """
+    A docstore backed by a SQLite file: documents are read by ID when needed instead of being unpickled in memory. Each thread uses its own connection.
+
+    Attributes:
+    - path:      The SQLite file
+    - read_only: Whether the file is opened read-only
+    """
+
+    def __init__(self, path: str, read_only: bool = True):
+        self.path = path
+        self.read_only = read_only
+        self.__local = threading.local()
+
+    def search(self, search: str):
+        row = self.__connection().execute("SELECT page_content, metadata FROM documents WHERE id = ?", (search,)).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+
+        page_content, metadata = row
+        return Document(page_content=page_content, metadata=json.loads(metadata))
+
+    def add(self, texts: dict[str, Document]) -> None:
+        connection = self.__connection()
+        connection.executemany(
+            "INSERT OR REPLACE INTO documents (id, page_content, metadata) VALUES (?, ?, ?)",
+            [(document_id, document.page_content, json.dumps(document.metadata)) for document_id, document in texts.items()]
+        )
+        connection.commit()
+
+    def delete(self, ids: list) -> None:
+        connection = self.__connection()
+        connection.executemany("DELETE FROM documents WHERE id = ?", [(document_id,) for document_id in ids])
+        connection.commit()
+
+    def get_documents(self) -> dict[str, Document]:
+        rows = self.__connection().execute("SELECT id, page_content, metadata FROM documents").fetchall()
+        return {document_id: Document(page_content=page_content, metadata=json.loads(metadata)) for document_id, page_content, metadata in rows}
+
+    def get_index_to_docstore_id(self) -> dict[int, str]:
+        rows = self.__connection().execute("SELECT position, id FROM positions").fetchall()
+        return {position: document_id for position, document_id in rows}
+
+    def __connection(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            if self.read_only:
+                connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            else:
+                connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.__local.connection = connection
+        return connection
+
+class CapecDetailStore:
+    """
+    The detailed CAPEC entries, stored in a SQLite file by format-rag-docs.py and read by ID when needed.
+
+    Attributes:
+    - path: The SQLite file
+    """
+
+    def __init__(self, path: str):
+        if not os.path.exists(path):
+            raise Exception(f"CAPEC detail store '{path}' not found")
+
+        self.path = path
+        self.__local = threading.local()
+
+    def get(self, capec_ids: list[str]) -> dict[str, str]:
+        """
+        Returns the detailed entries with the given IDs (unknown IDs are ignored), by ID.
+        """
+
+        if len(capec_ids) == 0:
+            return {}
+
+        placeholders = ", ".join(["?"] * len(capec_ids))
+        rows = self.__connection().execute(f"SELECT id, text FROM capec WHERE id IN ({placeholders})", list(capec_ids)).fetchall()
+        return {capec_id: text for capec_id, text in rows}
+
+    def __connection(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            self.__local.connection = connection
+        return connection
+
+def save_faiss(vector_store: FAISS, folder: str) -> None:
+    """
+    Saves a FAISS vector store without pickle: the raw FAISS index in 'index.faiss' and the documents in 'docstore.sqlite'. Files are replaced atomically.
+
+    Parameters:
+    - vector_store: The vector store to save
+    - folder:       The folder where the vector store is saved
+    """
+
+    os.makedirs(folder, exist_ok=True)
+
+    index_path = os.path.join(folder, "index.faiss")
+    faiss.write_index(vector_store.index, f"{index_path}.tmp")
+
+    docstore_path = os.path.join(folder, "docstore.sqlite")
+    if os.path.exists(f"{docstore_path}.tmp"):
+        os.remove(f"{docstore_path}.tmp")
+    connection = sqlite3.connect(f"{docstore_path}.tmp")
+    connection.execute("CREATE TABLE documents (id TEXT PRIMARY KEY, page_content TEXT NOT NULL, metadata TEXT NOT NULL)")
+    connection.execute("CREATE TABLE positions (position INTEGER PRIMARY KEY, id TEXT NOT NULL)")
+    for position, document_id in vector_store.index_to_docstore_id.items():
+        document = vector_store.docstore.search(document_id)
+        connection.execute("INSERT INTO documents (id, page_content, metadata) VALUES (?, ?, ?)", (document_id, document.page_content, json.dumps(document.metadata)))
+        connection.execute("INSERT INTO positions (position, id) VALUES (?, ?)", (position, document_id))
+    connection.commit()
+    connection.close()
+
+    os.replace(f"{index_path}.tmp", index_path)
+    os.replace(f"{docstore_path}.tmp", docstore_path)
+
+def load_faiss(folder: str, embeddings: Embeddings, read_only: bool = True) -> FAISS:
+    """
+    Loads a FAISS vector store saved with save_faiss. In read-only mode, the index is memory-mapped so that processes serving the same vector store share one page-cached copy. Otherwise, the index and the documents are loaded in memory: the saved files are left untouched (and keep matching each other) until save_faiss replaces both.
+
+    Parameters:
+    - folder:     The folder where the vector store is saved
+    - embeddings: The embeddings used for queries
+    - read_only:  False to load a vector store that will be updated
+    """
+
+    index_path = os.path.join(folder, "index.faiss")
+    if read_only:
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    else:
+        index = faiss.read_index(index_path)
+
+    saved_docstore = SQLiteDocstore(os.path.join(folder, "docstore.sqlite"))
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=saved_docstore if read_only else InMemoryDocstore(saved_docstore.get_documents()),
+        index_to_docstore_id=saved_docstore.get_index_to_docstore_id()
+    )
+
+def is_faiss_saved(folder: str) -> bool:
+    return os.path.exists(os.path.join(folder, "index.faiss")) and os.path.exists(os.path.join(folder, "docstore.sqlite"))
@@ -1,8 +1,20 @@
+from langchain_core.globals import get_llm_cache
+from langchain_core.load import dumps
 from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration
 from langchain_ollama import ChatOllama
 from langchain_core.prompts import ChatPromptTemplate, FewShotChatMessagePromptTemplate
+from langchain_core.runnables import RunnableLambda
 
 import json
+import re
+from functools import cached_property
+from typing import AsyncIterator, Iterator
+import asyncio
+
+from cache import is_llm_cache_bypassed
+from risk_parser import parse_risk, get_asset_id
+from json_stream import JSONStreamValidator, JSONExtractionError, ExtractionErrorReason, validate_stream, avalidate_stream
 
 class Formatter:
     """
@@ -14,11 +26,14 @@ class Formatter:
 
     llm = None
 
-    def __init__(self, model: str):
-        self.llm = ChatOllama(
-            model=model,
-            temperature=0
-        )
+    def __init__(self, model: str, residency: "ModelResidency" = None):
+        if residency is not None:
+            self.llm = residency.chat_model(model)
+        else:
+            self.llm = ChatOllama(
+                model=model,
+                temperature=0
+            )
 
     def format(self, text: str) -> str:
         """
@@ -33,6 +48,47 @@ class Formatter:
 
         raise Exception("Invalid class: Formatter::format() not implemented")
 
+    def format_stream(self, text: str) -> Iterator[str]:
+        """
+        Formats text into the desired format, yielding the result as it is generated. By default, the whole result is yielded at once.
+
+        Parameters:
+        - text: The text to format
+
+        Returns:
+        - An iterator over chunks of the JSON object (as a string)
+        """
+
+        yield self.format(text)
+
+    def format_with_report(self, text: str) -> tuple[str, list[dict]]:
+        """
+        Formats text into the desired format, reporting how each risk was formatted. By default, the whole text is formatted by the LLM.
+
+        Parameters:
+        - text: The text to format
+
+        Returns:
+        - The JSON object as a string
+        - The list of {"risk": number of the risk (None for the whole text), "path": "parser" or "llm"}
+        """
+
+        return self.format(text), [{"risk": None, "path": "llm"}]
+
+    async def aformat_with_report(self, text: str) -> tuple[str, list[dict]]:
+        """
+        Formats text into the desired format without blocking the event loop, reporting how each risk was formatted. By default, format_with_report() is run in a thread.
+        """
+
+        return await asyncio.to_thread(self.format_with_report, text)
+
+    async def aformat_stream(self, text: str) -> AsyncIterator[str]:
+        """
+        Formats text into the desired format without blocking the event loop, yielding the result as it is generated. By default, the whole result is yielded at once.
+        """
+
+        yield (await self.aformat_with_report(text))[0]
+
 class SimpleJSONFormatter(Formatter):
     """
     A formatter with the JSON schema used as a simplified representation of CORAS models.
@@ -41,8 +97,13 @@ class SimpleJSONFormatter(Formatter):
     - system_prompt: Instructions for the LLM to strictly follow the desired format
     - json_schema: The JSON schema which the LLM is restricted to
     - examples: Examples of desired output used for few-shot prompting
+    - max_concurrency: Maximum number of risks formatted at the same time
+    - max_retries: Number of times a risk is formatted again when the output of the LLM is invalid
     """
 
+    max_concurrency = 4
+    max_retries = 1
+
     system_prompt = """You are a helpul assistant that formats multiple risks and scenarios into a single JSON file. Include in the JSON every risk that is provided. You must include the listed vulnerabilities into edges of the JSON. The JSON format you must follow is:
 {{ 
     "vertices": [{{ 
@@ -224,6 +285,256 @@ The rules you must follow to generate the JSON file are:
     ]
  
     def format(self, text: str) -> str:
+        return self.format_with_report(text)[0]
+
+    def format_with_report(self, text: str) -> tuple[str, list[dict]]:
+        risks, graphs, unparsed = self.__parse(text)
+
+        # Remaining risks are formatted concurrently, so that the duration depends on the longest risk rather than on their number
+        results = []
+        if len(unparsed) > 0:
+            results = RunnableLambda(self.__generate).batch(
+                [risk for (_, risk) in unparsed],
+                config={"max_concurrency": self.max_concurrency},
+                return_exceptions=True
+            )
+        return self.__merge(risks, graphs, unparsed, results)
+
+    async def aformat_with_report(self, text: str) -> tuple[str, list[dict]]:
+        risks, graphs, unparsed = self.__parse(text)
+
+        slots = asyncio.Semaphore(self.max_concurrency)
+        async def generate(risk: str) -> dict:
+            async with slots:
+                return await self.__agenerate(risk)
+
+        results = await asyncio.gather(*(generate(risk) for (_, risk) in unparsed), return_exceptions=True)
+        return self.__merge(risks, graphs, unparsed, results)
+
+    def __parse(self, text: str) -> tuple[list[tuple[str, str]], dict, list[tuple[str, str]]]:
+        """
+        Converts the well-formed risks with the rule-based parser, the LLM only formats the others.
+
+        Returns:
+        - The risks, as (number, text) pairs (a single risk numbered None if the text has no "Risk N" heading)
+        - The graphs of the parsed risks, by number (None for the risks left to the LLM)
+        - The risks left to the LLM
+        """
+
+        risks = split_risks(text)
+        if len(risks) == 0:
+            risks = [(None, text)]
+        graphs = {number: parse_risk(number, risk) if number is not None else None for number, risk in risks}
+        unparsed = [(number, risk) for number, risk in risks if graphs[number] is None]
+        return risks, graphs, unparsed
+
+    def __merge(self, risks: list[tuple[str, str]], graphs: dict, unparsed: list[tuple[str, str]], results: list) -> tuple[str, list[dict]]:
+        """
+        Merges the graphs of the parsed risks with the results of the LLM (graphs or exceptions, in the order of unparsed) and reports how each risk was formatted.
+        """
+
+        errors = {}
+        for (number, _), result in zip(unparsed, results):
+            if isinstance(result, JSONExtractionError):
+                # The other risks are kept, the failure is reported
+                errors[number] = result.to_dict()
+                graphs[number] = {"vertices": [], "edges": []}
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                graphs[number] = result
+
+        if risks[0][0] is None:
+            result_dict = graphs[None]
+        else:
+            result_dict = merge_coras_graphs([(number, graphs[number]) for number, _ in risks])
+
+        report = []
+        for number, risk in risks:
+            path = {"risk": number, "path": "llm" if (number, risk) in unparsed else "parser"}
+            if number in errors:
+                path["error"] = errors[number]
+            report.append(path)
+
+        # Return the JSON as a string
+        return json.dumps(result_dict), report
+
+    def format_stream(self, text: str) -> Iterator[str]:
+        # Nothing to generate if the parser handles every risk
+        risks = split_risks(text)
+        graphs = [(number, parse_risk(number, risk)) for number, risk in risks]
+        if len(graphs) > 0 and all(graph is not None for _, graph in graphs):
+            yield json.dumps(merge_coras_graphs(graphs))
+            return
+
+        cache_key = self.__get_cache_key(text)
+        cached = self.__lookup(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        # The generation is stopped as soon as the output cannot become a valid CORAS model
+        stream = self.__chain.stream({"input": text, "feedback": ""})
+        output = ""
+        try:
+            for chunk in validate_stream((chunk.content for chunk in stream), self.json_schema):
+                output += chunk
+                yield chunk
+        finally:
+            stream.close()
+        self.__update(cache_key, output)
+
+    async def aformat_stream(self, text: str) -> AsyncIterator[str]:
+        risks = split_risks(text)
+        graphs = [(number, parse_risk(number, risk)) for number, risk in risks]
+        if len(graphs) > 0 and all(graph is not None for _, graph in graphs):
+            yield json.dumps(merge_coras_graphs(graphs))
+            return
+
+        cache_key = self.__get_cache_key(text)
+        cached = await self.__alookup(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        # Closing the stream cancels the request to Ollama
+        stream = self.__chain.astream({"input": text, "feedback": ""})
+        output = ""
+        try:
+            async for chunk in avalidate_stream((chunk.content async for chunk in stream), self.json_schema):
+                output += chunk
+                yield chunk
+        finally:
+            await stream.aclose()
+        await self.__aupdate(cache_key, output)
+
+    def __generate(self, text: str) -> dict:
+        """
+        Formats text with the LLM, validating the output while it is generated. A broken output stops the generation right away: a truncated output is repaired, otherwise the text is formatted again with the error as feedback.
+        """
+
+        cache_key = self.__get_cache_key(text)
+        cached = self.__lookup(cache_key)
+        if cached is not None:
+            return json.loads(cached)
+
+        result = self.__generate_validated(text)
+        self.__update(cache_key, json.dumps(result))
+        return result
+
+    def __generate_validated(self, text: str) -> dict:
+        feedback = ""
+        for attempt in range(1 + self.max_retries):
+            validator = JSONStreamValidator(self.json_schema)
+            stream = self.__chain.stream({"input": text, "feedback": feedback})
+            try:
+                for chunk in stream:
+                    if validator.feed(chunk.content):
+                        break
+                return validator.close()
+            except JSONExtractionError as error:
+                result, feedback = self.__recover(validator, error, attempt)
+                if result is not None:
+                    return result
+            finally:
+                stream.close()
+
+    async def __agenerate(self, text: str) -> dict:
+        """
+        Same as __generate, without blocking the event loop.
+        """
+
+        cache_key = self.__get_cache_key(text)
+        cached = await self.__alookup(cache_key)
+        if cached is not None:
+            return json.loads(cached)
+
+        result = await self.__agenerate_validated(text)
+        await self.__aupdate(cache_key, json.dumps(result))
+        return result
+
+    async def __agenerate_validated(self, text: str) -> dict:
+        feedback = ""
+        for attempt in range(1 + self.max_retries):
+            validator = JSONStreamValidator(self.json_schema)
+            stream = self.__chain.astream({"input": text, "feedback": feedback})
+            try:
+                async for chunk in stream:
+                    if validator.feed(chunk.content):
+                        break
+                return validator.close()
+            except JSONExtractionError as error:
+                result, feedback = self.__recover(validator, error, attempt)
+                if result is not None:
+                    return result
+            finally:
+                await stream.aclose()
+
+    def __recover(self, validator: JSONStreamValidator, error: JSONExtractionError, attempt: int) -> tuple[dict, str]:
+        """
+        Handles an invalid output of __generate and __agenerate: a truncated output is repaired, otherwise the text is formatted again with the error as feedback.
+
+        Returns:
+        - The repaired object (None if the output could not be repaired)
+        - The feedback given to the next attempt
+
+        Raises:
+        - The error of the output if no attempt is left
+        """
+
+        if error.reason == ExtractionErrorReason.TRUNCATED:
+            try:
+                return validator.repair(), None
+            except JSONExtractionError:
+                pass
+        if attempt == self.max_retries:
+            raise error
+        return None, f"\n\nYour previous answer was rejected ({error}). Strictly follow the JSON format."
+
+    def __get_cache_key(self, text: str) -> tuple[str, str]:
+        """
+        Returns the (prompt, llm_string) under which the formatting of text is cached, or None if the LLM cache is disabled or bypassed. The generations are streamed to be validated as they come, which LangChain does not cache: they are looked up and stored here, once valid.
+        """
+
+        if get_llm_cache() is None or is_llm_cache_bypassed():
+            return None
+
+        prompt = dumps(self.__prompt.invoke({"input": text, "feedback": ""}).to_messages())
+        return prompt, self.__llm_string
+
+    def __lookup(self, cache_key: tuple[str, str]) -> str:
+        if cache_key is None:
+            return None
+        generations = get_llm_cache().lookup(*cache_key)
+        return generations[0].text if generations else None
+
+    async def __alookup(self, cache_key: tuple[str, str]) -> str:
+        if cache_key is None:
+            return None
+        generations = await get_llm_cache().alookup(*cache_key)
+        return generations[0].text if generations else None
+
+    def __update(self, cache_key: tuple[str, str], output: str) -> None:
+        if cache_key is not None:
+            get_llm_cache().update(*cache_key, [ChatGeneration(message=AIMessage(content=output))])
+
+    async def __aupdate(self, cache_key: tuple[str, str], output: str) -> None:
+        if cache_key is not None:
+            await get_llm_cache().aupdate(*cache_key, [ChatGeneration(message=AIMessage(content=output))])
+
+    @cached_property
+    def __llm_string(self) -> str:
+        # The model and the schema its output is constrained to (the temperature is always 0)
+        return json.dumps({"model": getattr(self.llm, "model", None), "format": self.json_schema}, sort_keys=True)
+
+    @cached_property
+    def __chain(self):
+        # Constrain the raw generation to the schema so that it can be streamed as text
+        return self.__prompt | self.llm.bind(format=self.json_schema)
+
+    @cached_property
+    def __prompt(self) -> ChatPromptTemplate:
+        # The static system prompt, examples and instructions come before the risks so that Ollama reuses their evaluation across requests
         # Few shot prompting
         example_prompt = ChatPromptTemplate.from_messages([
             ("human", "{input}"),
@@ -235,7 +546,7 @@ The rules you must follow to generate the JSON file are:
         )
     
         # Actual prompt
-        prompt = ChatPromptTemplate.from_messages([
+        return ChatPromptTemplate.from_messages([
             ("system", self.system_prompt),
             few_shot_prompt,
             ("human", """Format the following risk descriptions (delimited by <risks></risks>) strictly following the previous given instructions. Don't forget to list vulnerabilities! A vulnerability must be linked to one and only one edge.
@@ -244,16 +555,71 @@ The rules you must follow to generate the JSON file are:
 {input}
 </risks>
 
-Remember to list all the cited risks and not just one. Remember to also put the vulnerabilities into the JSON. A vulnerability must be linked to one and only one edge.""")
+Remember to list all the cited risks and not just one. Remember to also put the vulnerabilities into the JSON. A vulnerability must be linked to one and only one edge.{feedback}""")
         ])
 
-        structured_llm = self.llm.with_structured_output(self.json_schema)
+def split_risks(text: str) -> list[tuple[str, str]]:
+    """
+    Splits a risk analysis into its risks, starting with a "Risk N" heading (e.g. "**Risk 1: Insider Attack**"). The text before the first risk (e.g. the high-level risk table) is left out. If a risk appears several times, its last occurrence (the most detailed) is kept.
+
+    Parameters:
+    - text: The risk analysis
 
-        chain = prompt | structured_llm
-        result_dict = chain.invoke({
-            "input": text
-        })
+    Returns:
+    - The list of (number of the risk, text of the risk) pairs, in order of appearance
+    """
 
-        # Return the JSON as a string
-        return json.dumps(result_dict)
+    headings = list(re.finditer(r"^[ \t]*(?:#+[ \t]*)?(?:\*\*|__)?[ \t]*Risk[ \t]+(\d+)\b", text, re.MULTILINE | re.IGNORECASE))
+
+    risks = {}
+    for i, heading in enumerate(headings):
+        end = headings[i + 1].start() if i + 1 < len(headings) else len(text)
+        number = heading.group(1)
+        risks.pop(number, None)
+        risks[number] = text[heading.start():end].strip()
+
+    return list(risks.items())
+
+def merge_coras_graphs(graphs: list[tuple[str, dict]]) -> dict:
+    """
+    Merges the CORAS graphs of several risks into one. The IDs of each risk are namespaced with its number ("R1-T1", "R2-T1"...) and assets shared by several risks are merged into one vertex.
+
+    Parameters:
+    - graphs: The list of (number of the risk, graph) pairs
+
+    Returns:
+    - The merged graph
+    """
+
+    vertices = []
+    edges = []
+    asset_ids = set()
+
+    for number, graph in graphs:
+        ids = {}
+        for vertex in graph.get("vertices", []):
+            if vertex.get("type") == "asset":
+                asset_id = get_asset_id(vertex.get("text", "")) or get_asset_id(vertex["id"])
+                ids[vertex["id"]] = asset_id
+                if asset_id not in asset_ids:
+                    asset_ids.add(asset_id)
+                    vertices.append({**vertex, "id": asset_id})
+            else:
+                ids[vertex["id"]] = get_risk_vertex_id(number, vertex["id"])
+                vertices.append({**vertex, "id": ids[vertex["id"]]})
+
+        for edge in graph.get("edges", []):
+            edges.append({
+                **edge,
+                "source": ids.get(edge["source"], get_risk_vertex_id(number, edge["source"])),
+                "target": ids.get(edge["target"], get_risk_vertex_id(number, edge["target"]))
+            })
+
+    return {
+        "vertices": vertices,
+        "edges": edges
+    }
 
+def get_risk_vertex_id(number: str, vertex_id: str) -> str:
+    local_id = re.sub(r"^R\d+-", "", vertex_id)
+    return f"R{number}-{local_id}"
@@ -0,0 +1,115 @@
+import faiss
+import numpy as np
+
+class IndexKind:
+    FLAT = "flat"
+    HNSW = "hnsw"
+    IVF = "ivf"
+
+class Compression:
+    NONE = None
+    PQ = "pq"
+    SQ8 = "sq8"
+
+class IndexSpec:
+    """
+    Describes the FAISS index of a vector store. The flat index is exact, HNSW and IVF are approximate but scale sub-linearly with the number of documents, and PQ/SQ8 compress the stored vectors.
+
+    Attributes:
+    - kind:        The IndexKind
+    - m:           HNSW: number of neighbors per node
+    - ef_search:   HNSW: size of the candidate list at query time (higher is more accurate and slower)
+    - nlist:       IVF: number of clusters
+    - nprobe:      IVF: number of clusters visited at query time (higher is more accurate and slower)
+    - compression: The Compression of the stored vectors
+    - pq_m:        PQ: number of sub-quantizers (must divide the embedding dimension)
+    """
+
+    def __init__(self, kind: str = IndexKind.FLAT, m: int = 32, ef_search: int = 64, nlist: int = 256, nprobe: int = 16, compression: str = Compression.NONE, pq_m: int = 16):
+        if kind not in [IndexKind.FLAT, IndexKind.HNSW, IndexKind.IVF]:
+            raise Exception(f"Unknown index kind '{kind}'")
+        if compression not in [Compression.NONE, Compression.PQ, Compression.SQ8]:
+            raise Exception(f"Unknown compression '{compression}'")
+
+        self.kind = kind
+        self.m = m
+        self.ef_search = ef_search
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.compression = compression
+        self.pq_m = pq_m
+
+    @staticmethod
+    def parse(text: str):
+        """
+        Parses a spec such as "flat", "hnsw:m=32,ef_search=64" or "ivf:nlist=256,nprobe=16,compression=pq,pq_m=16".
+        """
+
+        kind, _, parameters = text.partition(":")
+        arguments = {}
+        for parameter in filter(lambda x: x != '', parameters.split(",")):
+            name, _, value = parameter.partition("=")
+            arguments[name.strip()] = value.strip() if name.strip() == "compression" else int(value)
+        return IndexSpec(kind.strip(), **arguments)
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "m": self.m,
+            "ef_search": self.ef_search,
+            "nlist": self.nlist,
+            "nprobe": self.nprobe,
+            "compression": self.compression,
+            "pq_m": self.pq_m
+        }
+
+    def factory_string(self, document_count: int = None) -> str:
+        """
+        Returns the description of the index for faiss.index_factory.
+
+        Parameters:
+        - document_count: The number of training vectors, used to cap the number of IVF clusters
+        """
+
+        encoding = {
+            Compression.NONE: "Flat",
+            Compression.PQ: f"PQ{self.pq_m}",
+            Compression.SQ8: "SQ8"
+        }[self.compression]
+
+        if self.kind == IndexKind.HNSW:
+            return f"HNSW{self.m}" if self.compression is None else f"HNSW{self.m}_{encoding}"
+        if self.kind == IndexKind.IVF:
+            nlist = self.nlist if document_count is None else max(1, min(self.nlist, document_count // 39))
+            return f"IVF{nlist},{encoding}"
+        return encoding
+
+    def supports_removal(self) -> bool:
+        # HNSW graphs can not remove vectors
+        return self.kind != IndexKind.HNSW
+
+    def create_index(self, vectors: list[list[float]]) -> faiss.Index:
+        """
+        Creates an empty index, trained on vectors if the index requires training (IVF, PQ, SQ8).
+
+        Parameters:
+        - vectors: The vectors to be added to the index
+        """
+
+        matrix = np.array(vectors, dtype=np.float32)
+        index = faiss.index_factory(matrix.shape[1], self.factory_string(len(vectors)), faiss.METRIC_L2)
+        if not index.is_trained:
+            index.train(matrix)
+
+        self.configure(index)
+        return index
+
+    def configure(self, index: faiss.Index) -> None:
+        """
+        Sets the query time parameters of the index.
+        """
+
+        if self.kind == IndexKind.HNSW:
+            faiss.ParameterSpace().set_index_parameter(index, "efSearch", self.ef_search)
+        elif self.kind == IndexKind.IVF:
+            faiss.ParameterSpace().set_index_parameter(index, "nprobe", self.nprobe)
@@ -0,0 +1,281 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from typing import Callable, Iterator
+from uuid import uuid4
+import threading
+import time
+
+class JobStatus:
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    FINISHED = [DONE, FAILED, CANCELLED]
+
+class JobCancelled(Exception):
+    pass
+
+class JobQueueFull(Exception):
+    pass
+
+class Job:
+    """
+    A unit of work submitted to the JobManager.
+
+    Attributes:
+    - id:          Unique ID of the job
+    - stage:       The name of the work performed (e.g. "summarize")
+    - status:      The current JobStatus
+    - result:      The result of the job, once done
+    - error:       The reason of the failure or cancellation, if any
+    - events:      The (event, data) pairs emitted so far, replayed to every subscriber
+    - deadline:    Time after which the job is cancelled (None if no timeout)
+    - last_seen:   Last time a client polled or listened to the job
+    - abandon_timeout: The job is cancelled if no client polled or listened to it for this many seconds (None to disable)
+    """
+
+    def __init__(self, stage: str, timeout: float = None, abandon_timeout: float = None):
+        self.id = str(uuid4())
+        self.stage = stage
+        self.status = JobStatus.QUEUED
+        self.result = None
+        self.error = None
+        self.events = []
+        self.created_at = time.time()
+        self.finished_at = None
+        self.deadline = None if timeout is None else self.created_at + timeout
+        self.last_seen = self.created_at
+        self.abandon_timeout = abandon_timeout
+        self.subscribers = 0
+
+        self.__cancelled = threading.Event()
+        self.__condition = threading.Condition()
+
+    def emit(self, event: str, data) -> None:
+        """
+        Publishes an event (e.g. a generated token) to the subscribers of the job.
+        """
+
+        with self.__condition:
+            self.events.append((event, data))
+            self.__condition.notify_all()
+
+    def subscribe(self, poll_interval: float = 1.0) -> Iterator[tuple[str, object]]:
+        """
+        Yields every event of the job, starting from the first one, until the job is finished. A ("status", ...) event is yielded last.
+
+        Parameters:
+        - poll_interval: Maximum time to wait between two checks of the job status
+        """
+
+        index = 0
+        self.subscribers += 1
+        try:
+            while True:
+                with self.__condition:
+                    if index >= len(self.events) and not self.is_finished():
+                        self.__condition.wait(poll_interval)
+                    events = self.events[index:]
+                    finished = self.is_finished()
+                index += len(events)
+                self.touch()
+
+                for event in events:
+                    yield event
+                if finished and index >= len(self.events):
+                    yield ("status", self.to_dict())
+                    return
+        finally:
+            self.subscribers -= 1
+            self.touch()
+
+    def collect(self, chunks: Iterator[str]) -> str:
+        """
+        Consumes a stream of generated text, publishing each chunk as a "token" event. The stream is closed as soon as the job is cancelled, which stops the underlying generation.
+
+        Parameters:
+        - chunks: The stream of generated text
+
+        Returns:
+        - The whole generated text
+        """
+
+        text = ""
+        try:
+            for chunk in chunks:
+                self.raise_if_cancelled()
+                text += chunk
+                self.emit("token", {'token': chunk})
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+        return text
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Blocks until the job is finished. The waiting client counts as a subscriber, so the job is not seen as abandoned.
+
+        Returns:
+        - Whether the job is finished
+        """
+
+        with self.__condition:
+            self.subscribers += 1
+            try:
+                return self.__condition.wait_for(self.is_finished, timeout)
+            finally:
+                self.subscribers -= 1
+                self.touch()
+
+    def touch(self) -> None:
+        self.last_seen = time.time()
+
+    def cancel(self, reason: str = "Cancelled by client") -> None:
+        if self.error is None:
+            self.error = reason
+        self.__cancelled.set()
+        with self.__condition:
+            self.__condition.notify_all()
+
+    def is_cancelled(self) -> bool:
+        return self.__cancelled.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        """
+        Called by the running work between two steps (e.g. between two tokens) so that the job stops as soon as it is cancelled or timed out.
+        """
+
+        now = time.time()
+        if self.deadline is not None and now > self.deadline:
+            self.cancel("Timed out")
+        if self.abandon_timeout is not None and self.subscribers == 0 and now - self.last_seen > self.abandon_timeout:
+            self.cancel("Abandoned by client")
+        if self.is_cancelled():
+            raise JobCancelled(self.error)
+
+    def is_finished(self) -> bool:
+        return self.status in JobStatus.FINISHED
+
+    def finish(self, status: str, result=None, error: str = None) -> None:
+        with self.__condition:
+            self.status = status
+            self.result = result
+            if error is not None:
+                self.error = error
+            self.finished_at = time.time()
+            self.__condition.notify_all()
+
+    def to_dict(self) -> dict:
+        return {
+            'job-id': self.id,
+            'stage': self.stage,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error if self.status in [JobStatus.FAILED, JobStatus.CANCELLED] else None
+        }
+
+class JobManager:
+    """
+    Runs jobs on a bounded pool of workers. The pool should be sized to the number of generations the Ollama backend can actually run in parallel: additional jobs wait in the queue instead of competing for the GPU.
+
+    Attributes:
+    - max_workers:     Number of jobs running concurrently
+    - max_pending:     Maximum number of queued and running jobs, further submissions are rejected
+    - timeout:         Maximum lifetime of a job in seconds (None for no limit)
+    - abandon_timeout: A job nobody polled or listened to for this many seconds is cancelled (None to disable)
+    - retention:       Time in seconds finished jobs are kept before being forgotten
+    """
+
+    def __init__(self, max_workers: int = 1, max_pending: int = 32, timeout: float = None, abandon_timeout: float = None, retention: float = 600):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.abandon_timeout = abandon_timeout
+        self.retention = retention
+
+        self.jobs = {}
+        self.__lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="navigator-job")
+
+    def submit(self, stage: str, work: Callable[[Job], object], abandonable: bool = True) -> Job:
+        """
+        Queues work to be run by the pool.
+
+        Parameters:
+        - stage: The name of the work
+        - work:  Function called with the Job, it returns the result of the job
+        - abandonable: False for background work that must not be cancelled when no client polls it
+
+        Returns:
+        - The created job
+
+        Raises:
+        - JobQueueFull if max_pending jobs are already queued or running
+        """
+
+        with self.__lock:
+            self.__forget_old_jobs()
+            if self.pending() >= self.max_pending:
+                raise JobQueueFull(f"Too many pending jobs ({self.max_pending})")
+
+            job = Job(stage, self.timeout, self.abandon_timeout if abandonable else None)
+            self.jobs[job.id] = job
+
+        # The job keeps the context of its submitter (e.g. the ID of the request in the logs)
+        self.__executor.submit(contextvars.copy_context().run, self.__run, job, work)
+        return job
+
+    def get(self, job_id: str) -> Job:
+        """
+        Returns the job with the given ID, or None if it does not exist (anymore).
+        """
+
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Job:
+        job = self.get(job_id)
+        if job is not None and not job.is_finished():
+            job.cancel()
+            if job.status == JobStatus.QUEUED:
+                job.finish(JobStatus.CANCELLED)
+        return job
+
+    def pending(self) -> int:
+        return len([job for job in list(self.jobs.values()) if not job.is_finished()])
+
+    def stats(self) -> dict:
+        jobs = list(self.jobs.values())
+        return {
+            'workers': self.max_workers,
+            'queued': len([job for job in jobs if job.status == JobStatus.QUEUED]),
+            'running': len([job for job in jobs if job.status == JobStatus.RUNNING])
+        }
+
+    def shutdown(self) -> None:
+        for job in list(self.jobs.values()):
+            if not job.is_finished():
+                job.cancel("Server shutting down")
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    def __run(self, job: Job, work: Callable[[Job], object]) -> None:
+        if job.is_finished():
+            return
+
+        try:
+            job.raise_if_cancelled()
+            job.status = JobStatus.RUNNING
+            result = work(job)
+            job.raise_if_cancelled()
+            job.finish(JobStatus.DONE, result=result)
+        except JobCancelled as cancelled:
+            job.finish(JobStatus.CANCELLED, error=str(cancelled))
+        except Exception as exception:
+            job.finish(JobStatus.FAILED, error=str(exception))
+
+    def __forget_old_jobs(self) -> None:
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.is_finished() and now - job.finished_at > self.retention:
+                del self.jobs[job_id]
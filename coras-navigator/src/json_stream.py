@@ -0,0 +1,377 @@
+import json
+from typing import AsyncIterator, Iterator
+
+class ExtractionErrorReason:
+    NO_JSON = "no-json"        # No JSON object in the output
+    SYNTAX = "syntax"          # The output is not valid JSON
+    SCHEMA = "schema"          # The output does not follow the JSON schema
+    TRUNCATED = "truncated"    # The generation ended before the end of the JSON object
+    RUNAWAY = "runaway"        # The generation does not converge (endless whitespace, too long output)
+
+class JSONExtractionError(Exception):
+    """
+    Raised when a JSON object cannot be extracted from the output of a LLM.
+
+    Attributes:
+    - reason:   One of ExtractionErrorReason
+    - message:  Human readable description of the error
+    - path:     Location of the error in the JSON object (e.g. "vertices[3].type")
+    - position: Number of characters of the output read when the error was detected
+    """
+
+    def __init__(self, reason: str, message: str, path: str = "", position: int = 0):
+        super().__init__(f"{reason}: {message}" + (f" (at '{path}')" if path != "" else ""))
+        self.reason = reason
+        self.message = message
+        self.path = path
+        self.position = position
+
+    def to_dict(self) -> dict:
+        return {
+            "reason": self.reason,
+            "message": self.message,
+            "path": self.path,
+            "position": self.position
+        }
+
+class Frame:
+    """
+    An object or array being read.
+    """
+
+    def __init__(self, kind: str, schema: dict, path: str):
+        self.kind = kind
+        self.schema = schema or {}
+        self.path = path
+        self.keys = set()
+        self.key = None
+        self.count = 0
+        self.after_comma = False
+
+    def child_path(self) -> str:
+        if self.kind == "object":
+            return f"{self.path}.{self.key}" if self.path != "" else self.key
+        return f"{self.path}[{self.count}]"
+
+    def child_schema(self) -> dict:
+        if self.kind == "object":
+            return self.schema.get("properties", {}).get(self.key)
+        return self.schema.get("items")
+
+class JSONStreamValidator:
+    """
+    Reads a JSON object character by character as it is generated, and checks it against a JSON schema (types, enums, required and additional properties) as soon as possible. The first error is raised immediately, so that the generation can be stopped instead of being read until the end.
+
+    Text before the first "{" is skipped and text after the end of the object is ignored.
+
+    Attributes:
+    - schema:         The JSON schema of the object
+    - max_preamble:   Maximum number of characters before the object
+    - max_whitespace: Maximum number of consecutive whitespace characters
+    - max_length:     Maximum length of the object
+    - done:           Whether the object is complete
+    """
+
+    LITERAL_CHARACTERS = set("0123456789+-.eEtrufalsn")
+    VALUE_KINDS = {'{': "object", '[': "array", '"': "string", 't': "boolean", 'f': "boolean", 'n': "null"}
+
+    def __init__(self, schema: dict = None, max_preamble: int = 2000, max_whitespace: int = 256, max_length: int = 100000):
+        self.schema = schema or {}
+        self.max_preamble = max_preamble
+        self.max_whitespace = max_whitespace
+        self.max_length = max_length
+        self.done = False
+
+        self.__text = []
+        self.__position = 0
+        self.__state = "preamble"
+        self.__stack = []
+        self.__value_schema = self.schema
+        self.__value_path = ""
+        self.__whitespace = 0
+        self.__string = None
+        self.__escape = False
+        self.__string_escaped = False
+        self.__string_role = None
+        self.__literal = None
+        self.__last_complete = 0
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Reads the next chunk of the output.
+
+        Returns:
+        - Whether the object is complete (the rest of the output can be ignored)
+
+        Raises:
+        - JSONExtractionError as soon as the output cannot become a valid object
+        """
+
+        for character in chunk:
+            if self.done:
+                break
+            self.__consume(character)
+            self.__position += 1
+        return self.done
+
+    def close(self):
+        """
+        Ends the output.
+
+        Returns:
+        - The JSON object
+
+        Raises:
+        - JSONExtractionError if the object is incomplete
+        """
+
+        if self.__state == "preamble":
+            self.__fail(ExtractionErrorReason.NO_JSON, "No JSON object found")
+        if not self.done:
+            self.__fail(ExtractionErrorReason.TRUNCATED, "The output ends before the end of the JSON object", self.__current_path())
+
+        return json.loads("".join(self.__text))
+
+    def repair(self):
+        """
+        Repairs a truncated object: the incomplete value at the end is dropped and the open objects and arrays are closed.
+
+        Returns:
+        - The repaired JSON object
+
+        Raises:
+        - JSONExtractionError if the repaired object does not follow the schema either
+        """
+
+        if self.__last_complete == 0:
+            self.__fail(ExtractionErrorReason.TRUNCATED, "Nothing to repair: no complete value in the output")
+
+        # The output up to the end of the last complete value, and the objects and arrays still open at that point
+        text = "".join(self.__text[:self.__last_complete])
+        partial = JSONStreamValidator(self.schema, self.max_preamble, self.max_whitespace, self.max_length)
+        partial.feed(text)
+        closers = "".join("}" if frame.kind == "object" else "]" for frame in reversed(partial.__stack))
+
+        validator = JSONStreamValidator(self.schema, self.max_preamble, self.max_whitespace, self.max_length)
+        validator.feed(text + closers)
+        return validator.close()
+
+    def __consume(self, character: str) -> None:
+        if self.__state == "preamble":
+            if character == "{":
+                self.__text.append(character)
+                self.__begin_value(character)
+            elif self.__position >= self.max_preamble:
+                self.__fail(ExtractionErrorReason.NO_JSON, f"No JSON object in the first {self.max_preamble} characters")
+            return
+
+        self.__text.append(character)
+        if len(self.__text) > self.max_length:
+            self.__fail(ExtractionErrorReason.RUNAWAY, f"The JSON object is longer than {self.max_length} characters", self.__current_path())
+
+        if self.__state == "string":
+            self.__consume_string(character)
+            return
+
+        if self.__state == "literal":
+            if character in self.LITERAL_CHARACTERS:
+                self.__literal += character
+                return
+            self.__end_literal()
+
+        if character.isspace():
+            self.__whitespace += 1
+            if self.__whitespace > self.max_whitespace:
+                self.__fail(ExtractionErrorReason.RUNAWAY, f"More than {self.max_whitespace} consecutive whitespace characters", self.__current_path())
+            return
+        self.__whitespace = 0
+
+        frame = self.__stack[-1] if len(self.__stack) > 0 else None
+        if self.__state == "value":
+            if character == "]" and frame is not None and frame.kind == "array" and frame.count == 0 and not frame.after_comma:
+                self.__close(frame)
+            else:
+                self.__begin_value(character)
+        elif self.__state == "key":
+            if character == '"':
+                self.__begin_string("key")
+            elif character == "}" and not frame.after_comma:
+                self.__close(frame)
+            else:
+                self.__fail(ExtractionErrorReason.SYNTAX, f"Expected a key, got '{character}'", frame.path)
+        elif self.__state == "colon":
+            if character != ":":
+                self.__fail(ExtractionErrorReason.SYNTAX, f"Expected ':', got '{character}'", frame.child_path())
+            self.__state = "value"
+            self.__value_schema = frame.child_schema()
+            self.__value_path = frame.child_path()
+        elif self.__state == "after_value":
+            if character == ",":
+                frame.after_comma = True
+                if frame.kind == "object":
+                    self.__state = "key"
+                else:
+                    self.__state = "value"
+                    self.__value_schema = frame.child_schema()
+                    self.__value_path = frame.child_path()
+            elif (character == "}" and frame.kind == "object") or (character == "]" and frame.kind == "array"):
+                self.__close(frame)
+            else:
+                self.__fail(ExtractionErrorReason.SYNTAX, f"Expected ',' or the end of the {frame.kind}, got '{character}'", frame.path)
+
+    def __begin_value(self, character: str) -> None:
+        kind = self.VALUE_KINDS.get(character)
+        if kind is None and (character.isdigit() or character == "-"):
+            kind = "number"
+        if kind is None:
+            self.__fail(ExtractionErrorReason.SYNTAX, f"Expected a value, got '{character}'", self.__value_path)
+
+        schema = self.__value_schema or {}
+        expected = schema.get("type")
+        if expected is not None and kind != expected and not (expected == "integer" and kind == "number"):
+            self.__fail(ExtractionErrorReason.SCHEMA, f"Expected {expected}, got {kind}", self.__value_path)
+
+        if kind in ["object", "array"]:
+            self.__stack.append(Frame(kind, schema, self.__value_path))
+            self.__state = "key" if kind == "object" else "value"
+            if kind == "array":
+                self.__value_schema = self.__stack[-1].child_schema()
+                self.__value_path = self.__stack[-1].child_path()
+        elif kind == "string":
+            self.__begin_string("value")
+        else:
+            self.__literal = character
+            self.__state = "literal"
+
+    def __begin_string(self, role: str) -> None:
+        self.__string = []
+        self.__escape = False
+        self.__string_escaped = False
+        self.__string_role = role
+        self.__state = "string"
+
+    def __consume_string(self, character: str) -> None:
+        if self.__escape:
+            self.__escape = False
+            self.__string_escaped = True
+            self.__string.append("\\" + character)
+            return
+        if character == "\\":
+            self.__escape = True
+            return
+        if character == '"':
+            self.__end_string()
+            return
+        if ord(character) < 0x20:
+            self.__fail(ExtractionErrorReason.SYNTAX, "Unescaped control character in a string", self.__current_path())
+
+        self.__string.append(character)
+        enum = (self.__value_schema or {}).get("enum") if self.__string_role == "value" else None
+        if enum is not None and not self.__string_escaped:
+            prefix = "".join(self.__string)
+            if not any(str(value).startswith(prefix) for value in enum):
+                self.__fail(ExtractionErrorReason.SCHEMA, f"'{prefix}...' is not one of {enum}", self.__value_path)
+
+    def __end_string(self) -> None:
+        value = json.loads('"' + "".join(self.__string) + '"')
+        frame = self.__stack[-1]
+
+        if self.__string_role == "key":
+            if frame.schema.get("additionalProperties") is False and value not in frame.schema.get("properties", {}):
+                self.__fail(ExtractionErrorReason.SCHEMA, f"Unexpected property '{value}'", frame.path)
+            frame.key = value
+            frame.keys.add(value)
+            self.__state = "colon"
+            return
+
+        enum = (self.__value_schema or {}).get("enum")
+        if enum is not None and value not in enum:
+            self.__fail(ExtractionErrorReason.SCHEMA, f"'{value}' is not one of {enum}", self.__value_path)
+        self.__end_value()
+
+    def __end_literal(self) -> None:
+        try:
+            json.loads(self.__literal)
+        except ValueError:
+            self.__fail(ExtractionErrorReason.SYNTAX, f"Invalid literal '{self.__literal}'", self.__value_path)
+
+        # The character ending the literal is not part of it
+        self.__end_value(len(self.__text) - 1)
+
+    def __close(self, frame: Frame) -> None:
+        if frame.kind == "object":
+            missing = [key for key in frame.schema.get("required", []) if key not in frame.keys]
+            if len(missing) > 0:
+                self.__fail(ExtractionErrorReason.SCHEMA, f"Missing required properties {missing}", frame.path)
+
+        self.__stack.pop()
+        self.__value_schema = frame.schema
+        self.__value_path = frame.path
+        self.__end_value()
+
+    def __end_value(self, end: int = None) -> None:
+        self.__last_complete = len(self.__text) if end is None else end
+        if len(self.__stack) == 0:
+            self.done = True
+            self.__state = "done"
+            return
+
+        frame = self.__stack[-1]
+        frame.count += 1
+        frame.after_comma = False
+        self.__state = "after_value"
+
+    def __current_path(self) -> str:
+        if len(self.__stack) == 0:
+            return self.__value_path
+        return self.__value_path if self.__state in ["value", "string", "literal"] else self.__stack[-1].path
+
+    def __fail(self, reason: str, message: str, path: str = "") -> None:
+        raise JSONExtractionError(reason, message, path, self.__position)
+
+def validate_stream(chunks: Iterator[str], schema: dict = None) -> Iterator[str]:
+    """
+    Forwards the chunks of a generation while validating them. The generation is stopped (the iterator closed) as soon as the output cannot become a valid object, or once the object is complete.
+
+    Raises:
+    - JSONExtractionError if the output is invalid
+    """
+
+    validator = JSONStreamValidator(schema)
+    try:
+        for chunk in chunks:
+            yield chunk
+            if validator.feed(chunk):
+                break
+        validator.close()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+async def avalidate_stream(chunks: AsyncIterator[str], schema: dict = None) -> AsyncIterator[str]:
+    """
+    Same as validate_stream, for an asynchronous generation.
+    """
+
+    validator = JSONStreamValidator(schema)
+    try:
+        async for chunk in chunks:
+            yield chunk
+            if validator.feed(chunk):
+                break
+        validator.close()
+    finally:
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+
+def extract_json_object(text: str, schema: dict = None):
+    """
+    Extracts the JSON object from the complete output of a LLM and checks it against a JSON schema.
+
+    Raises:
+    - JSONExtractionError if the output contains no valid object
+    """
+
+    validator = JSONStreamValidator(schema, max_preamble=len(text), max_whitespace=len(text), max_length=len(text))
+    validator.feed(text)
+    return validator.close()
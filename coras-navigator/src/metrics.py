@@ -0,0 +1,240 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Iterator
+import asyncio
+from uuid import uuid4
+import threading
+import time
+
+# ID of the request being served, prefixed to the logs
+request_id = ContextVar("request_id", default=None)
+
+# The innermost span being run, which receives the token counts of the generations
+current_span = ContextVar("current_span", default=None)
+
+DURATION_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+
+class Span:
+    """
+    The timing of a stage of the analysis (e.g. "assess"), with the generations made during it.
+
+    Attributes:
+    - stage:            The name of the stage
+    - start:            Start time (perf_counter)
+    - prompt_tokens:    Number of prompt tokens evaluated by Ollama during the stage
+    - prompt_eval_s:    Time Ollama spent evaluating prompts
+    - generated_tokens: Number of tokens generated
+    - generation_s:     Time Ollama spent generating
+    - duration:         Duration in seconds, once the stage is over
+    - children:         The spans run within this one (e.g. "vector-search" within "retrieve")
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.start = time.perf_counter()
+        self.duration = None
+        self.children = []
+        self.prompt_tokens = 0
+        self.prompt_eval_s = 0.0
+        self.generated_tokens = 0
+        self.generation_s = 0.0
+
+    def describe(self, duration: float) -> str:
+        text = f"{self.stage} {duration:.2f}s"
+        if self.prompt_tokens > 0:
+            text += f", prompt: {self.prompt_tokens} tokens in {self.prompt_eval_s:.2f}s"
+        if self.generated_tokens > 0:
+            text += f", generated: {self.generated_tokens} tokens ({self.generated_tokens / self.generation_s if self.generation_s > 0 else 0:.1f} tokens/s)"
+        return text
+
+    def find(self, stage: str) -> list["Span"]:
+        """
+        Returns the spans of a stage run within this one, at any depth.
+        """
+
+        spans = []
+        for child in self.children:
+            if child.stage == stage:
+                spans.append(child)
+            spans += child.find(stage)
+        return spans
+
+class Metrics:
+    """
+    Collects the metrics of the server and writes them in the Prometheus text format: stage durations (histograms), stage outcomes and Ollama token counts and durations (counters), and values read at scrape time from registered collectors (cache, job queue...).
+    """
+
+    def __init__(self):
+        self.__counters = {}
+        self.__histograms = {}
+        self.__collectors = []
+        self.__help = {}
+        self.__lock = threading.Lock()
+
+    def increment(self, name: str, labels: dict, value: float = 1, help: str = "") -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__help.setdefault(name, ("counter", help))
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: dict, value: float, help: str = "") -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__help.setdefault(name, ("histogram", help))
+            histogram = self.__histograms.setdefault(key, {"buckets": [0] * len(DURATION_BUCKETS), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def register_collector(self, collector: Callable[[], list[tuple[str, dict, float]]], help: dict[str, str] = {}) -> None:
+        """
+        Registers a function called at scrape time, which returns gauges as (name, labels, value).
+        """
+
+        with self.__lock:
+            self.__collectors.append(collector)
+            for name, text in help.items():
+                self.__help[name] = ("gauge", text)
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[Span]:
+        """
+        Times a stage, records its duration and outcome, and logs it with the token counts of the generations made during it.
+        """
+
+        span = Span(stage)
+        parent = current_span.get()
+        token = current_span.set(span)
+        status = "ok"
+        try:
+            yield span
+        except (GeneratorExit, asyncio.CancelledError):
+            # A streamed stage whose client went away, or a cancelled task
+            status = "cancelled"
+            raise
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            try:
+                current_span.reset(token)
+            except ValueError:
+                # A streamed stage closed from another context
+                current_span.set(None)
+            duration = time.perf_counter() - span.start
+            span.duration = duration
+            if parent is not None:
+                parent.children.append(span)
+            self.observe("navigator_stage_duration_seconds", {"stage": stage}, duration, "Duration of the stages of the analysis")
+            self.increment("navigator_stage_total", {"stage": stage, "status": status}, help="Number of stages run, by outcome")
+            log(span.describe(duration) + (f" ({status})" if status != "ok" else ""))
+
+    def trace_stream(self, stage: str, chunks: Iterator) -> Iterator:
+        """
+        Times a streamed stage, from the first to the last chunk read.
+        """
+
+        with self.span(stage):
+            yield from chunks
+
+    async def atrace_stream(self, stage: str, chunks: AsyncIterator) -> AsyncIterator:
+        """
+        Times an asynchronously streamed stage, from the first to the last chunk read.
+        """
+
+        with self.span(stage):
+            async for chunk in chunks:
+                yield chunk
+
+    def record_generation(self, model: str, info: dict) -> None:
+        """
+        Records the token counts and durations reported by Ollama for a generation (in nanoseconds), and adds them to the current span.
+        """
+
+        span = current_span.get()
+        stage = span.stage if span is not None else "none"
+        labels = {"model": model, "stage": stage}
+        prompt_tokens = info.get("prompt_eval_count", 0)
+        prompt_eval_s = info.get("prompt_eval_duration", 0) / 1e9
+        generated_tokens = info.get("eval_count", 0)
+        generation_s = info.get("eval_duration", 0) / 1e9
+
+        self.increment("navigator_llm_prompt_tokens_total", labels, prompt_tokens, "Prompt tokens evaluated by Ollama")
+        self.increment("navigator_llm_prompt_eval_seconds_total", labels, prompt_eval_s, "Time Ollama spent evaluating prompts")
+        self.increment("navigator_llm_generated_tokens_total", labels, generated_tokens, "Tokens generated by Ollama")
+        self.increment("navigator_llm_generation_seconds_total", labels, generation_s, "Time Ollama spent generating")
+        self.increment("navigator_llm_load_seconds_total", labels, info.get("load_duration", 0) / 1e9, "Time Ollama spent loading models")
+        self.increment("navigator_llm_calls_total", labels, help="Number of generations")
+
+        if span is not None:
+            span.prompt_tokens += prompt_tokens
+            span.prompt_eval_s += prompt_eval_s
+            span.generated_tokens += generated_tokens
+            span.generation_s += generation_s
+
+    def render(self) -> str:
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+
+        gauges = []
+        for collector in list(self.__collectors):
+            gauges += collector()
+
+        with self.__lock:
+            samples = {}
+            for (name, labels), value in self.__counters.items():
+                samples.setdefault(name, []).append(f"{name}{format_labels(dict(labels))} {format_value(value)}")
+            for (name, labels), histogram in self.__histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, count in zip(DURATION_BUCKETS, histogram["buckets"]):
+                    lines.append(f"{name}_bucket{format_labels({**dict(labels), 'le': str(bound)})} {count}")
+                lines.append(f"{name}_bucket{format_labels({**dict(labels), 'le': '+Inf'})} {histogram['count']}")
+                lines.append(f"{name}_sum{format_labels(dict(labels))} {format_value(histogram['sum'])}")
+                lines.append(f"{name}_count{format_labels(dict(labels))} {histogram['count']}")
+            for name, labels, value in gauges:
+                self.__help.setdefault(name, ("gauge", ""))
+                samples.setdefault(name, []).append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+            text = ""
+            for name in sorted(samples):
+                kind, help = self.__help[name]
+                if help != "":
+                    text += f"# HELP {name} {help}\n"
+                text += f"# TYPE {name} {kind}\n"
+                text += "".join(f"{line}\n" for line in samples[name])
+        return text
+
+def format_labels(labels: dict) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = {key: str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for key, value in labels.items()}
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped.items()) + "}"
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def new_request_id() -> str:
+    return uuid4().hex[:12]
+
+def log(message: str) -> None:
+    """
+    Prints a message prefixed with the ID of the current request.
+    """
+
+    current = request_id.get()
+    print(f"[{current}] {message}" if current is not None else message)
+
+# The metrics of the server, shared by every module
+METRICS = Metrics()
+
+def span(stage: str):
+    return METRICS.span(stage)
+
+def trace_stream(stage: str, chunks: Iterator) -> Iterator:
+    return METRICS.trace_stream(stage, chunks)
+
+def atrace_stream(stage: str, chunks: AsyncIterator) -> AsyncIterator:
+    return METRICS.atrace_stream(stage, chunks)
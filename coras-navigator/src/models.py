@@ -0,0 +1,182 @@
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.embeddings import Embeddings
+from langchain_ollama import ChatOllama, OllamaLLM, OllamaEmbeddings
+import ollama
+
+from ollama_pool import OllamaPool, PooledModel, PooledEmbeddings
+from metrics import METRICS
+
+import threading
+import time
+
+class ModelTimings(BaseCallbackHandler):
+    """
+    Records, for each call to a model, the time Ollama spent loading the model, evaluating the prompt and generating, as reported in the metadata of its responses.
+
+    Attributes:
+    - model:     The Ollama model
+    - residency: The ModelResidency the timings are reported to
+    """
+
+    def __init__(self, model: str, residency: "ModelResidency"):
+        self.model = model
+        self.residency = residency
+
+    def on_llm_end(self, response: LLMResult, **kwargs) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                info = generation.generation_info or {}
+                message = getattr(generation, "message", None)
+                if "total_duration" not in info and message is not None:
+                    info = message.response_metadata
+                if "total_duration" in info:
+                    self.residency.record(self.model, info)
+
+class ModelResidency:
+    """
+    Keeps the Ollama models used by the agents loaded and consistently configured: every instance of a model shares the same keep_alive and num_ctx (Ollama reloads a model whose num_ctx changes), models can be loaded at startup, and the load, prompt evaluation and generation times of every call are recorded.
+
+    Attributes:
+    - keep_alive: How long Ollama keeps a model loaded after its last call (e.g. "30m", -1 for ever)
+    - num_ctx:    The context window of the models, in tokens
+    - base_url:   The Ollama server (None for the default one), when there is no pool
+    - pool:       The Ollama servers the calls are routed to (None to use base_url)
+    - models:     The registered models, with their kind ("llm" or "embedding")
+    """
+
+    def __init__(self, keep_alive: str = "30m", num_ctx: int = 8192, base_url: str = None, pool: OllamaPool = None):
+        self.keep_alive = keep_alive
+        self.num_ctx = num_ctx
+        self.base_url = base_url
+        self.pool = pool
+        self.models = {}
+        self.__timings = {}
+        self.__lock = threading.Lock()
+
+    def chat_model(self, model: str, **kwargs) -> ChatOllama:
+        """
+        Returns a chat model (temperature=0) managed by the residency.
+        """
+
+        return self.__create(model, lambda base_url: ChatOllama(
+            model=model,
+            temperature=0,
+            keep_alive=self.keep_alive,
+            num_ctx=self.num_ctx,
+            base_url=base_url,
+            callbacks=[ModelTimings(model, self)],
+            **kwargs
+        ))
+
+    def llm(self, model: str, **kwargs) -> OllamaLLM:
+        """
+        Returns a completion model (temperature=0) managed by the residency.
+        """
+
+        return self.__create(model, lambda base_url: OllamaLLM(
+            model=model,
+            temperature=0,
+            keep_alive=self.keep_alive,
+            num_ctx=self.num_ctx,
+            base_url=base_url,
+            callbacks=[ModelTimings(model, self)],
+            **kwargs
+        ))
+
+    def embeddings(self, model: str) -> Embeddings:
+        """
+        Returns embeddings managed by the residency.
+        """
+
+        self.register(model, kind="embedding")
+        factory = lambda base_url: OllamaEmbeddings(model=model, base_url=base_url)
+        if self.pool is not None:
+            return PooledEmbeddings(self.pool, model, factory)
+        return factory(self.base_url)
+
+    def register(self, model: str, kind: str = "llm") -> None:
+        self.models[model] = kind
+
+    def warm_up(self) -> dict[str, float]:
+        """
+        Loads every registered model, one after the other (loading several large models at once would compete for memory).
+
+        Returns:
+        - The load time of each model, in seconds
+        """
+
+        if self.pool is not None:
+            self.pool.check_all()
+
+        load_times = {}
+        for model, kind in self.models.items():
+            for base_url in self.__get_base_urls(model):
+                client = ollama.Client(host=base_url)
+                start = time.perf_counter()
+                if kind == "embedding":
+                    client.embed(model=model, input="", keep_alive=self.keep_alive)
+                else:
+                    # An empty prompt loads the model without generating anything
+                    client.generate(model=model, prompt="", keep_alive=self.keep_alive, options={"num_ctx": self.num_ctx})
+                load_times[model] = max(load_times.get(model, 0.0), time.perf_counter() - start)
+                print(f"Loaded model '{model}'" + (f" on {base_url}" if base_url is not None else "") + f" in {time.perf_counter() - start:.1f}s")
+        return load_times
+
+    def record(self, model: str, info: dict) -> None:
+        """
+        Records the durations reported by Ollama for a call (in nanoseconds).
+        """
+
+        METRICS.record_generation(model, info)
+        with self.__lock:
+            timings = self.__timings.setdefault(model, {
+                "calls": 0,
+                "loads": 0,
+                "load_s": 0.0,
+                "prompt_eval_s": 0.0,
+                "prompt_tokens": 0,
+                "generation_s": 0.0,
+                "generated_tokens": 0
+            })
+            load = info.get("load_duration", 0) / 1e9
+            timings["calls"] += 1
+            # Ollama reports a few milliseconds of load time when the model is already loaded
+            timings["loads"] += 1 if load > 1 else 0
+            timings["load_s"] += load
+            timings["prompt_eval_s"] += info.get("prompt_eval_duration", 0) / 1e9
+            timings["prompt_tokens"] += info.get("prompt_eval_count", 0)
+            timings["generation_s"] += info.get("eval_duration", 0) / 1e9
+            timings["generated_tokens"] += info.get("eval_count", 0)
+            timings["last"] = {
+                "load_s": load,
+                "prompt_eval_s": info.get("prompt_eval_duration", 0) / 1e9,
+                "generation_s": info.get("eval_duration", 0) / 1e9
+            }
+
+    def stats(self) -> dict:
+        """
+        Returns the configuration of the models and the accumulated timings of their calls, by model.
+        """
+
+        with self.__lock:
+            stats = {
+                "keep_alive": self.keep_alive,
+                "num_ctx": self.num_ctx,
+                "models": {model: {"kind": kind, **self.__timings.get(model, {})} for model, kind in self.models.items()}
+            }
+        if self.pool is not None:
+            stats["hosts"] = self.pool.stats()
+        return stats
+
+    def __create(self, model: str, factory):
+        self.register(model)
+        if self.pool is not None:
+            # One instance per server, each call is routed to the least loaded one
+            return PooledModel(self.pool, model, factory)
+        return factory(self.base_url)
+
+    def __get_base_urls(self, model: str) -> list[str]:
+        if self.pool is None:
+            return [self.base_url]
+        return [host.url for host in self.pool.hosts_for(model) if host.healthy]
@@ -1,11 +1,19 @@
 import os
 from datetime import datetime
+import asyncio
 import json
+from typing import AsyncIterator, Iterator
+
+from langchain_core.runnables import RunnableLambda
 
 from summarizer import *
 from rag import *
 from assessor import *
 from formatter import *
+from json_stream import extract_json_object
+from context_builder import ContextBuilder
+from metrics import span, trace_stream, atrace_stream, log
+from singleflight import SingleFlight
 
 class CorasNavigator:
     """
@@ -16,21 +24,38 @@ class CorasNavigator:
     - rag:        The RAG module
     - assessor:   The risk assessor agent
     - formatter:  The formatter agent
+    - context_builder: Assembles the retrieved entries within the token budget of the risk assessor (no limit by default)
+    - singleflight: Coalesces identical concurrent calls of a stage into one computation (e.g. several analysts opening the same system)
     """
 
     summarizer: Summarizer
     rag: RAG
     assessor: RiskAssessor
     formatter: Formatter
+    context_builder: ContextBuilder
+    singleflight: SingleFlight
 
-    def __init__(self, summarizer: Summarizer, rag: RAG, assessor: RiskAssessor, formatter: Formatter):
+    def __init__(self, summarizer: Summarizer, rag: RAG, assessor: RiskAssessor, formatter: Formatter, context_builder: ContextBuilder = None, singleflight: SingleFlight = None):
         self.summarizer = summarizer
         self.rag = rag
         self.assessor = assessor
         self.formatter = formatter
+        self.context_builder = context_builder if context_builder is not None else ContextBuilder()
+        self.singleflight = singleflight if singleflight is not None else SingleFlight()
     
     def summarize(self, description: str) -> str:
-        return self.summarizer.summarize(description)
+        with span("summarize"):
+            return self.singleflight.do("summarize", (description,), lambda: self.summarizer.summarize(description))
+
+    def summarize_stream(self, description: str) -> Iterator[str]:
+        return trace_stream("summarize", self.singleflight.stream("summarize", (description,), lambda: self.summarizer.summarize_stream(description)))
+
+    async def asummarize(self, description: str) -> str:
+        with span("summarize"):
+            return await self.singleflight.ado("summarize", (description,), lambda: self.summarizer.asummarize(description))
+
+    def asummarize_stream(self, description: str) -> AsyncIterator[str]:
+        return atrace_stream("summarize", self.singleflight.astream("summarize", (description,), lambda: self.summarizer.asummarize_stream(description)))
     
     def retrieve(self, text: str) -> str:
         """
@@ -43,29 +68,184 @@ class CorasNavigator:
         - The retrieved context as a string
         """
         
-        context = ""
-        results = self.rag.search(text)
+        return self.retrieve_with_report(text)[0]
+
+    def retrieve_with_report(self, text: str) -> tuple[str, dict]:
+        """
+        Uses the RAG module to return context related to input text, within the token budget of the risk assessor.
+
+        Parameters:
+        - text: The input text used for retreival (the summary given to the risk assessor)
 
-        for result in results:
-            context += result + "\n"
-        return context
+        Returns:
+        - The retrieved context as a string
+        - The report of the context builder (budget, tokens used, what was cut)
+        """
+
+        with span("retrieve"):
+            results = self.singleflight.do("retrieve", (text,), lambda: self.rag.search(text))
+
+            # The context shares the context window of the risk assessor with its system prompt and the summary
+            with span("build-context"):
+                prompt = getattr(self.assessor, "system_prompt", "") + text
+                context, report = self.context_builder.build(text, results, prompt)
+            if report["cut"]:
+                log(f"Context trimmed to {report['tokens']} tokens (budget: {report['budget']})")
+            return context, report
+
+    async def aretrieve(self, text: str) -> str:
+        return (await self.aretrieve_with_report(text))[0]
+
+    async def aretrieve_with_report(self, text: str) -> tuple[str, dict]:
+        """
+        Same as retrieve_with_report, without blocking the event loop.
+        """
+
+        with span("retrieve"):
+            results = await self.singleflight.ado("retrieve", (text,), lambda: self.rag.asearch(text))
+
+            with span("build-context"):
+                prompt = getattr(self.assessor, "system_prompt", "") + text
+                context, report = self.context_builder.build(text, results, prompt)
+            if report["cut"]:
+                log(f"Context trimmed to {report['tokens']} tokens (budget: {report['budget']})")
+            return context, report
 
     def assess_risks(self, description: str, context: str) -> str:
-        return self.assessor.assess(description, context)
+        with span("assess"):
+            return self.singleflight.do("assess", (description, context), lambda: self.assessor.assess(description, context))
+
+    def assess_risks_stream(self, description: str, context: str) -> Iterator[str]:
+        return trace_stream("assess", self.singleflight.stream("assess", (description, context), lambda: self.assessor.assess_stream(description, context)))
+
+    async def aassess_risks(self, description: str, context: str) -> str:
+        with span("assess"):
+            return await self.singleflight.ado("assess", (description, context), lambda: self.assessor.aassess(description, context))
+
+    def aassess_risks_stream(self, description: str, context: str) -> AsyncIterator[str]:
+        return atrace_stream("assess", self.singleflight.astream("assess", (description, context), lambda: self.assessor.aassess_stream(description, context)))
 
     def format(self, text: str) -> str:
-        return self.formatter.format(text)
+        with span("format"):
+            return self.singleflight.do("format", (text,), lambda: self.formatter.format(text))
+
+    # The streamed output of the formatter differs from its report: both are coalesced separately
+    def format_stream(self, text: str) -> Iterator[str]:
+        return trace_stream("format", self.singleflight.stream("format-stream", (text,), lambda: self.formatter.format_stream(text)))
+
+    def aformat_stream(self, text: str) -> AsyncIterator[str]:
+        return atrace_stream("format", self.singleflight.astream("format-stream", (text,), lambda: self.formatter.aformat_stream(text)))
+
+    def format_with_report(self, text: str) -> dict:
+        """
+        Formats the risk analysis into a CORAS model.
+
+        Returns:
+        - The CORAS model ('coras_model') and how each risk was formatted ('formatting'), with the same keys as the API responses
+        """
+
+        with span("format"):
+            text, report = self.singleflight.do("format-report", (text,), lambda: self.formatter.format_with_report(text))
+        return {
+            'coras_model': self.extract_json(text),
+            'formatting': report
+        }
+
+    async def aformat_with_report(self, text: str) -> dict:
+        with span("format"):
+            text, report = await self.singleflight.ado("format-report", (text,), lambda: self.formatter.aformat_with_report(text))
+        return {
+            'coras_model': self.extract_json(text),
+            'formatting': report
+        }
 
-    def extract_json(self, text: str) -> str:
+    def analyze(self, description: str) -> dict:
+        """
+        Runs the whole analysis of a system: summarize, retrieve, assess and format.
+
+        Parameters:
+        - description: The description of the system, as provided by the user
+
+        Returns:
+        - The result of each step, with the same keys as the API responses
+        """
+
+        summary = self.summarize(description)
+        context = self.retrieve(summary)
+        analysis = self.assess_risks(summary, context)
+        return {
+            'summary': summary,
+            'retrieved-context': context,
+            'analysis': analysis,
+            **self.format_with_report(analysis)
+        }
+
+    async def aanalyze(self, description: str) -> dict:
+        """
+        Same as analyze, without blocking the event loop. Cancelling the task cancels the call to Ollama in progress.
+        """
+
+        summary = await self.asummarize(description)
+        context = await self.aretrieve(summary)
+        analysis = await self.aassess_risks(summary, context)
+        return {
+            'summary': summary,
+            'retrieved-context': context,
+            'analysis': analysis,
+            **(await self.aformat_with_report(analysis))
+        }
+
+    def analyze_batch(self, descriptions: list[str], max_concurrency: int = 4) -> Iterator[tuple[int, dict]]:
+        """
+        Analyzes many systems concurrently, keeping at most max_concurrency analyses in flight.
+
+        Parameters:
+        - descriptions:    The descriptions of the systems
+        - max_concurrency: The maximum number of analyses run at the same time
+
+        Returns:
+        - An iterator over (index of the description, result of analyze()) pairs, in the order the analyses finish. A failed analysis gives {'error': reason}.
+        """
+
+        pipeline = RunnableLambda(self.analyze)
+        for index, result in pipeline.batch_as_completed(descriptions, config={"max_concurrency": max_concurrency}, return_exceptions=True):
+            if isinstance(result, Exception):
+                yield index, {'error': str(result)}
+            else:
+                yield index, result
+
+    async def aanalyze_batch(self, descriptions: list[str], max_concurrency: int = 4) -> AsyncIterator[tuple[int, dict]]:
+        """
+        Same as analyze_batch, without a thread per analysis. Closing the iterator cancels the analyses in progress.
+        """
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def analyze(index: int, description: str) -> tuple[int, dict]:
+            async with semaphore:
+                try:
+                    return index, await self.aanalyze(description)
+                except Exception as error:
+                    return index, {'error': str(error)}
+
+        tasks = [asyncio.create_task(analyze(index, description)) for index, description in enumerate(descriptions)]
         try:
-            json = extract_JSON(text)
-            return json
-        except ValueError as error:
-            # No JSON found
-            return ""
-        except Exception as exception:
-            # Invalid JSON
-            return ""
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def extract_json(self, text: str):
+        """
+        Extracts the CORAS model from the output of the formatter, checked against the JSON schema of the formatter (if any).
+
+        Raises:
+        - JSONExtractionError with the reason why no valid model could be extracted
+        """
+
+        with span("extract-json"):
+            return extract_json_object(text, getattr(self.formatter, "json_schema", None))
 
 def extract_JSON(text: str):
     try:
@@ -0,0 +1,381 @@
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import Runnable, RunnableConfig
+import httpx
+
+from contextlib import contextmanager, asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator
+import asyncio
+import json
+import threading
+import time
+
+# Errors meaning that the host, rather than the request, failed
+HOST_ERRORS = (ConnectionError, httpx.TransportError)
+
+class NoHostAvailable(Exception):
+    pass
+
+class OllamaHost:
+    """
+    An Ollama server of the pool.
+
+    Attributes:
+    - url:             The URL of the server (e.g. "http://localhost:11434")
+    - models:          The models the server may serve (None for any model it has)
+    - max_concurrency: Maximum number of calls sent to the server at the same time (should match its OLLAMA_NUM_PARALLEL)
+    - available:       The models the server has, as reported by its last health check
+    - healthy:         Whether the server answered its last health check or call
+    - in_flight:       Number of calls being served
+    """
+
+    def __init__(self, url: str, models: list[str] = None, max_concurrency: int = 1):
+        self.url = url if "://" in url else f"http://{url}"
+        self.models = models
+        self.max_concurrency = max_concurrency
+        self.available = None
+        self.healthy = True
+        self.last_check = 0.0
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+
+    def serves(self, model: str) -> bool:
+        names = [model, model.removesuffix(":latest"), f"{model}:latest"]
+        if self.models is not None and not any(name in self.models for name in names):
+            return False
+        return self.available is None or any(name in self.available for name in names)
+
+    def to_dict(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "models": self.models if self.models is not None else self.available,
+            "calls": self.calls,
+            "failures": self.failures
+        }
+
+class OllamaPool:
+    """
+    Routes the calls to the models over several Ollama servers: each call goes to the least loaded healthy server that serves the model, and is retried on another server if its server fails. Asynchronous calls wait for a free slot without holding a thread.
+
+    Attributes:
+    - hosts:           The Ollama servers
+    - retries:         Number of other servers a failed call is retried on
+    - health_interval: Time in seconds after which an unhealthy server is checked again
+    - wait_timeout:    Maximum time in seconds a call waits for a free slot on a server
+    """
+
+    def __init__(self, hosts: list[OllamaHost], retries: int = 2, health_interval: float = 30, wait_timeout: float = 600):
+        if len(hosts) == 0:
+            raise Exception("An Ollama pool needs at least one host")
+
+        self.hosts = hosts
+        self.retries = retries
+        self.health_interval = health_interval
+        self.wait_timeout = wait_timeout
+        self.__condition = threading.Condition()
+        # Futures of the asynchronous calls waiting for a free slot, with their event loop
+        self.__waiters = []
+
+    def check(self, host: OllamaHost) -> bool:
+        """
+        Checks that a server answers and lists the models it has.
+        """
+
+        try:
+            response = httpx.get(f"{host.url}/api/tags", timeout=5)
+            response.raise_for_status()
+            host.available = [model["name"] for model in response.json().get("models", [])]
+            host.healthy = True
+        except (httpx.HTTPError, ValueError):
+            host.healthy = False
+        host.last_check = time.time()
+        return host.healthy
+
+    def check_all(self) -> None:
+        for host in self.hosts:
+            self.check(host)
+        with self.__condition:
+            self.__notify()
+
+    def hosts_for(self, model: str) -> list[OllamaHost]:
+        return [host for host in self.hosts if host.serves(model)]
+
+    @contextmanager
+    def acquire(self, model: str, exclude: list[OllamaHost] = []) -> Iterator[OllamaHost]:
+        """
+        Reserves a slot on the least loaded healthy server that serves the model, waiting for a free slot if every server is busy.
+
+        Raises:
+        - NoHostAvailable if no healthy server serves the model, or no slot was freed in time
+        """
+
+        host = self.__reserve(model, exclude)
+        try:
+            yield host
+        finally:
+            self.__release(host)
+
+    @asynccontextmanager
+    async def aacquire(self, model: str, exclude: list[OllamaHost] = []) -> AsyncIterator[OllamaHost]:
+        """
+        Same as acquire, waiting for a free slot without blocking the event loop.
+        """
+
+        host = await self.__areserve(model, exclude)
+        try:
+            yield host
+        finally:
+            self.__release(host)
+
+    def call(self, model: str, work: Callable[[OllamaHost], Any]) -> Any:
+        """
+        Runs a call on a server, retrying it on other servers if its server fails.
+        """
+
+        failed = []
+        while True:
+            with self.acquire(model, failed) as host:
+                try:
+                    return work(host)
+                except HOST_ERRORS:
+                    self.__mark_failed(host)
+                    failed.append(host)
+                    if len(failed) > self.retries:
+                        raise
+
+    def stream(self, model: str, work: Callable[[OllamaHost], Iterator]) -> Iterator:
+        """
+        Streams a call from a server. The call is retried on another server if its server fails before the first chunk.
+        """
+
+        failed = []
+        while True:
+            with self.acquire(model, failed) as host:
+                started = False
+                chunks = work(host)
+                try:
+                    for chunk in chunks:
+                        started = True
+                        yield chunk
+                    return
+                except HOST_ERRORS:
+                    self.__mark_failed(host)
+                    failed.append(host)
+                    if started or len(failed) > self.retries:
+                        raise
+                finally:
+                    # Stops the generation if the caller stopped reading
+                    if hasattr(chunks, "close"):
+                        chunks.close()
+
+    async def acall(self, model: str, work: Callable[[OllamaHost], Awaitable]) -> Any:
+        """
+        Same as call, for an asynchronous call.
+        """
+
+        failed = []
+        while True:
+            async with self.aacquire(model, failed) as host:
+                try:
+                    return await work(host)
+                except HOST_ERRORS:
+                    self.__mark_failed(host)
+                    failed.append(host)
+                    if len(failed) > self.retries:
+                        raise
+
+    async def astream(self, model: str, work: Callable[[OllamaHost], AsyncIterator]) -> AsyncIterator:
+        """
+        Same as stream, for an asynchronous stream. Closing the stream cancels the request to the server.
+        """
+
+        failed = []
+        while True:
+            async with self.aacquire(model, failed) as host:
+                started = False
+                chunks = work(host)
+                try:
+                    async for chunk in chunks:
+                        started = True
+                        yield chunk
+                    return
+                except HOST_ERRORS:
+                    self.__mark_failed(host)
+                    failed.append(host)
+                    if started or len(failed) > self.retries:
+                        raise
+                finally:
+                    if hasattr(chunks, "aclose"):
+                        await chunks.aclose()
+
+    def stats(self) -> list[dict]:
+        with self.__condition:
+            return [host.to_dict() for host in self.hosts]
+
+    def __reserve(self, model: str, exclude: list[OllamaHost]) -> OllamaHost:
+        deadline = time.time() + self.wait_timeout
+        while True:
+            # Unhealthy servers are checked again once in a while (outside of the lock, it takes a request)
+            for host in self.__get_hosts_to_check(model, exclude):
+                self.check(host)
+
+            with self.__condition:
+                host = self.__try_reserve(model, exclude)
+                if host is not None:
+                    return host
+
+                now = time.time()
+                if now >= deadline:
+                    raise NoHostAvailable(f"Every Ollama host serving '{model}' is busy")
+                self.__condition.wait(min(deadline - now, self.health_interval))
+
+    async def __areserve(self, model: str, exclude: list[OllamaHost]) -> OllamaHost:
+        deadline = time.time() + self.wait_timeout
+        loop = asyncio.get_running_loop()
+        while True:
+            for host in self.__get_hosts_to_check(model, exclude):
+                await asyncio.to_thread(self.check, host)
+
+            with self.__condition:
+                host = self.__try_reserve(model, exclude)
+                if host is not None:
+                    return host
+
+                now = time.time()
+                if now >= deadline:
+                    raise NoHostAvailable(f"Every Ollama host serving '{model}' is busy")
+                waiter = loop.create_future()
+                self.__waiters.append((loop, waiter))
+
+            try:
+                await asyncio.wait_for(waiter, min(deadline - now, self.health_interval))
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self.__condition:
+                    if (loop, waiter) in self.__waiters:
+                        self.__waiters.remove((loop, waiter))
+
+    def __get_hosts_to_check(self, model: str, exclude: list[OllamaHost]) -> list[OllamaHost]:
+        return [host for host in self.hosts_for(model) if host not in exclude and not host.healthy and time.time() - host.last_check > self.health_interval]
+
+    def __try_reserve(self, model: str, exclude: list[OllamaHost]) -> OllamaHost:
+        """
+        Reserves a slot on the least loaded healthy server that serves the model (with the lock held).
+
+        Returns:
+        - The server, or None if every server is busy
+        """
+
+        healthy = [host for host in self.hosts_for(model) if host not in exclude and host.healthy]
+        if len(healthy) == 0:
+            raise NoHostAvailable(f"No healthy Ollama host serves '{model}'")
+
+        free = [host for host in healthy if host.in_flight < host.max_concurrency]
+        if len(free) == 0:
+            return None
+
+        host = min(free, key=lambda host: (host.in_flight / host.max_concurrency, host.calls))
+        host.in_flight += 1
+        host.calls += 1
+        return host
+
+    def __release(self, host: OllamaHost) -> None:
+        with self.__condition:
+            host.in_flight -= 1
+            self.__notify()
+
+    def __notify(self) -> None:
+        """
+        Wakes up the calls waiting for a free slot (with the lock held).
+        """
+
+        self.__condition.notify_all()
+        for loop, waiter in self.__waiters:
+            try:
+                loop.call_soon_threadsafe(lambda waiter=waiter: waiter.done() or waiter.set_result(None))
+            except RuntimeError:
+                # The event loop of the waiter is closed
+                pass
+        self.__waiters = []
+
+    def __mark_failed(self, host: OllamaHost) -> None:
+        with self.__condition:
+            host.healthy = False
+            host.failures += 1
+            host.last_check = time.time()
+
+class PooledModel(Runnable):
+    """
+    A chat or completion model whose calls are routed by an OllamaPool. One model is created per server, on first use.
+
+    Attributes:
+    - pool:    The pool routing the calls
+    - model:   The Ollama model
+    - factory: Creates the model for a server, given its URL
+    """
+
+    def __init__(self, pool: OllamaPool, model: str, factory: Callable[[str], Runnable]):
+        self.pool = pool
+        self.model = model
+        self.factory = factory
+        self.__models = {}
+        self.__lock = threading.Lock()
+
+    def invoke(self, input, config: RunnableConfig = None, **kwargs):
+        return self.pool.call(self.model, lambda host: self.__get_model(host).invoke(input, config, **kwargs))
+
+    def stream(self, input, config: RunnableConfig = None, **kwargs) -> Iterator:
+        yield from self.pool.stream(self.model, lambda host: self.__get_model(host).stream(input, config, **kwargs))
+
+    async def ainvoke(self, input, config: RunnableConfig = None, **kwargs):
+        return await self.pool.acall(self.model, lambda host: self.__get_model(host).ainvoke(input, config, **kwargs))
+
+    async def astream(self, input, config: RunnableConfig = None, **kwargs) -> AsyncIterator:
+        async for chunk in self.pool.astream(self.model, lambda host: self.__get_model(host).astream(input, config, **kwargs)):
+            yield chunk
+
+    def __get_model(self, host: OllamaHost) -> Runnable:
+        with self.__lock:
+            if host.url not in self.__models:
+                self.__models[host.url] = self.factory(host.url)
+            return self.__models[host.url]
+
+class PooledEmbeddings(Embeddings):
+    """
+    Embeddings whose requests are routed by an OllamaPool.
+    """
+
+    def __init__(self, pool: OllamaPool, model: str, factory: Callable[[str], Embeddings]):
+        self.pool = pool
+        self.model = model
+        self.factory = factory
+        self.__embeddings = {}
+        self.__lock = threading.Lock()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.pool.call(self.model, lambda host: self.__get_embeddings(host).embed_documents(texts))
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.pool.call(self.model, lambda host: self.__get_embeddings(host).embed_query(text))
+
+    def __get_embeddings(self, host: OllamaHost) -> Embeddings:
+        with self.__lock:
+            if host.url not in self.__embeddings:
+                self.__embeddings[host.url] = self.factory(host.url)
+            return self.__embeddings[host.url]
+
+def parse_hosts(text: str) -> list[OllamaHost]:
+    """
+    Reads the Ollama servers of the pool, either as a comma-separated list of URLs ("box1:11434,box2:11434") or as a JSON list:
+
+    [{"url": "http://box1:11434", "models": ["llama3:70b-instruct"], "max_concurrency": 2}, {"url": "http://box2:11434"}]
+    """
+
+    text = text.strip()
+    if text.startswith("["):
+        return [OllamaHost(host["url"], host.get("models"), int(host.get("max_concurrency", 1))) for host in json.loads(text)]
+    return [OllamaHost(url.strip()) for url in text.split(",") if url.strip() != ""]
@@ -0,0 +1,208 @@
+from navigator import CorasNavigator
+from jobs import Job, JobManager, JobQueueFull, JobStatus
+from cache import bypass_llm_cache
+
+from typing import Callable, Iterator
+from uuid import uuid4
+import threading
+import time
+
+class MissingInput(Exception):
+    """
+    A step was asked for without its input, e.g. no summary or risk analysis in an unknown or expired session.
+    """
+
+    pass
+
+class StepFailed(Exception):
+    """
+    A step run in the background failed (e.g. Ollama unreachable).
+    """
+
+    pass
+
+class PipelineSession:
+    """
+    The intermediate artifacts of the analysis of a system, kept server-side between the steps of the analysis.
+
+    Attributes:
+    - id:          Unique ID of the session
+    - summary:     The summary of the system
+    - context_job: The retrieval of the context of the summary, started as soon as the summary exists
+    - analysis:    The risk analysis
+    - format_job:  The formatting of the analysis, started as soon as the analysis exists
+    - last_used:   Last time the session was used
+    """
+
+    def __init__(self):
+        self.id = str(uuid4())
+        self.summary = None
+        self.context_job = None
+        self.analysis = None
+        self.format_job = None
+        self.last_used = time.time()
+
+class AnalysisPipeline:
+    """
+    Runs the steps of the analysis with overlap: the next step is started in the background as soon as its input exists, so that it is (partly) done when the client asks for it.
+
+    Attributes:
+    - navigator: The CORAS navigator
+    - jobs:      The job manager running background steps (they share its bounded pool)
+    - ttl:       Time in seconds an unused session is kept
+    - sessions:  The sessions, by ID
+    """
+
+    def __init__(self, navigator: CorasNavigator, jobs: JobManager, ttl: float = 3600):
+        self.navigator = navigator
+        self.jobs = jobs
+        self.ttl = ttl
+        self.sessions = {}
+        self.__lock = threading.Lock()
+
+    def create_session(self) -> PipelineSession:
+        with self.__lock:
+            now = time.time()
+            for session_id, session in list(self.sessions.items()):
+                if now - session.last_used > self.ttl:
+                    del self.sessions[session_id]
+
+            session = PipelineSession()
+            self.sessions[session.id] = session
+        return session
+
+    def get_session(self, session_id: str) -> PipelineSession:
+        """
+        Returns the session with the given ID, or a new one if it does not exist (anymore).
+        """
+
+        session = self.sessions.get(session_id) if session_id is not None else None
+        if session is None:
+            return self.create_session()
+
+        session.last_used = time.time()
+        return session
+
+    def set_summary(self, session: PipelineSession, summary: str, no_cache: bool = False) -> None:
+        """
+        Records the summary and starts retrieving its context in the background.
+        """
+
+        if session.summary == summary and session.context_job is not None:
+            return
+
+        session.summary = summary
+        session.context_job = self.__prefetch("retrieve", lambda: self.__retrieve(summary), no_cache)
+
+    def get_context(self, session: PipelineSession, summary: str = None, no_cache: bool = False) -> dict:
+        """
+        Returns the context of the summary (by default, the summary of the session), waiting for the background retrieval if needed.
+
+        Returns:
+        - The context ('retrieved-context') and the report of its assembly within the token budget ('context-report')
+        """
+
+        if summary is not None:
+            self.set_summary(session, summary, no_cache)
+        if session.summary is None:
+            raise MissingInput("No summary in the session")
+
+        summary = session.summary
+        return self.__get_result(session.context_job, lambda: self.__retrieve(summary), no_cache)
+
+    def set_analysis(self, session: PipelineSession, analysis: str, no_cache: bool = False) -> None:
+        """
+        Records the risk analysis and starts formatting it in the background.
+        """
+
+        if session.analysis == analysis and session.format_job is not None:
+            return
+
+        session.analysis = analysis
+        session.format_job = self.__prefetch("format", lambda: self.__format(analysis), no_cache)
+
+    def get_coras_model(self, session: PipelineSession, analysis: str = None, no_cache: bool = False) -> dict:
+        """
+        Returns the CORAS model of the analysis (by default, the analysis of the session), waiting for the background formatting if needed.
+
+        Returns:
+        - The CORAS model ('coras_model') and how each risk was formatted ('formatting')
+        """
+
+        if analysis is not None:
+            self.set_analysis(session, analysis, no_cache)
+        if session.analysis is None:
+            raise MissingInput("No risk analysis in the session")
+
+        analysis = session.analysis
+        return self.__get_result(session.format_job, lambda: self.__format(analysis), no_cache)
+
+    def run(self, description: str, no_cache: bool = False) -> Iterator[tuple[str, dict]]:
+        """
+        Runs the whole analysis of a system in one call, streaming the summary and the analysis as they are generated.
+
+        Returns:
+        - An iterator over (event, data) pairs: "token" events, then "summary", "retrieved-context", "analysis" and a final "result" with every artifact
+        """
+
+        session = self.create_session()
+
+        with bypass_llm_cache(no_cache):
+            summary = ""
+            for token in self.navigator.summarize_stream(description):
+                summary += token
+                yield ("token", {'stage': 'summary', 'token': token})
+            self.set_summary(session, summary, no_cache)
+            yield ("summary", {'summary': summary, 'session-id': session.id})
+
+            retrieval = self.get_context(session, no_cache=no_cache)
+            context = retrieval['retrieved-context']
+            yield ("retrieved-context", retrieval)
+
+            analysis = ""
+            for token in self.navigator.assess_risks_stream(summary, context):
+                analysis += token
+                yield ("token", {'stage': 'analysis', 'token': token})
+            self.set_analysis(session, analysis, no_cache)
+            yield ("analysis", {'analysis': analysis})
+
+            yield ("result", {
+                'session-id': session.id,
+                'summary': summary,
+                **retrieval,
+                'analysis': analysis,
+                **self.get_coras_model(session, no_cache=no_cache)
+            })
+
+    def __retrieve(self, summary: str) -> dict:
+        context, report = self.navigator.retrieve_with_report(summary)
+        return {
+            'retrieved-context': context,
+            'context-report': report
+        }
+
+    def __format(self, analysis: str) -> dict:
+        return self.navigator.format_with_report(analysis)
+
+    def __prefetch(self, stage: str, work: Callable[[], object], no_cache: bool) -> Job:
+        def run(job: Job):
+            with bypass_llm_cache(no_cache):
+                return work()
+
+        try:
+            return self.jobs.submit(stage, run, abandonable=False)
+        except JobQueueFull:
+            # Too busy to prefetch, the step will be run when needed
+            return None
+
+    def __get_result(self, job: Job, work: Callable[[], object], no_cache: bool):
+        # A cancelled job (even if it is still queued) is not waited for: the step is run again
+        if job is not None and not job.is_cancelled():
+            job.wait()
+            if job.status == JobStatus.DONE:
+                return job.result
+            if job.status != JobStatus.CANCELLED:
+                raise StepFailed(job.error)
+
+        with bypass_llm_cache(no_cache):
+            return work()
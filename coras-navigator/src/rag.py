@@ -9,13 +9,29 @@ from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
 # Models
 from langchain_ollama import ChatOllama, OllamaEmbeddings
+from langchain_core.embeddings import Embeddings
+# Embedding cache
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
 # Retrievers
 from langchain.retrievers import ContextualCompressionRetriever
 from langchain.retrievers.document_compressors import LLMChainExtractor
 
 from langchain_core.prompts import ChatPromptTemplate
 
+from reranker import Reranker, EmbeddingReranker
+from bm25 import BM25Index, reciprocal_rank_fusion
+from docstore import CapecDetailStore, save_faiss, load_faiss, is_faiss_saved
+from index_spec import IndexSpec
+from metrics import span
+
+import asyncio
+import contextvars
+from functools import cached_property
 import os
+import re
+from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from uuid import uuid4
 import json
 
@@ -24,19 +40,37 @@ class DocumentExtension:
     TXT = "TXT"
     PDF = "PDF"
     JSON = "JSON"
+    SQLITE = "SQLITE"
 
 class RAG:
     """
     A RAG module.
 
     Attributes:
-    - VECTOR_STORE_DOCUMENTS_RECORD: The file containing the list of files used to populate the vector store
+    - VECTOR_STORE_MANIFEST:         The file recording the embedding model and the hash of each document used to populate the vector store
     - VECTOR_STORE_FOLDER:           The folder where the vector store is saved
+    - EMBEDDING_CACHE_FOLDER:        The folder where document embeddings are cached
+    - LEXICAL_INDEX:                 The file where the lexical (BM25) index is saved
     - vector_store:                  The vector store
+    - index_spec:                    The type of FAISS index of the vector store
+    - lexical_index:                 The lexical index, searched along with the vector store
+    - lexical_weight:                The weight of the lexical index when merging rankings (0 to only use the vector store)
+    - embedding_batch_size:          The number of documents embedded per request to the embedding model
+    - embedding_concurrency:         The number of embedding requests sent concurrently
     """
 
-    VECTOR_STORE_DOCUMENTS_RECORD = "vector-store-documents.json"
+    VECTOR_STORE_MANIFEST = "vector-store-manifest.json"
+    VECTOR_STORE_MANIFEST_VERSION = 3
     VECTOR_STORE_FOLDER = "faiss-vector-store/"
+    EMBEDDING_CACHE_FOLDER = "embedding-cache/"
+    LEXICAL_INDEX = "bm25-index.json"
+
+    index_spec = IndexSpec()
+    lexical_index = None
+    lexical_weight = 1.0
+
+    embedding_batch_size = 64
+    embedding_concurrency = 4
 
     def __init__(self, embedding_model: str, directory: str):
         raise Exception("Invalid class: __init__() not implemented")
@@ -54,40 +88,217 @@ class RAG:
         """
 
         raise Exception("Invalid class: search() not implemented")
+
+    async def asearch(self, query: str, k: int=3) -> list[str]:
+        """
+        Same as search, without blocking the event loop: the search is run in a thread (the FAISS and lexical searches are CPU-bound and the query embedding is a single short request).
+        """
+
+        return await asyncio.to_thread(self.search, query, k)
     
     def load_files(self, files: list[(str, DocumentExtension)]) -> None:
         """
-        Loads files to be used as sources for retrieval. If the saved vector store contained the same files, it is simply loaded from local storage. Otherwise, the vector store is created.
+        Loads files to be used as sources for retrieval. The saved vector store is loaded from local storage and only the documents that were added, changed or removed since it was saved are embedded or deleted. The vector store is created from scratch if none was saved or if it was built with another embedding model or index type.
 
         Parameters:
         - files: List of files to load
         """
 
-        filepaths = [path for (path, _) in files]
-        
-        if is_list_equal_to_json_file_content(filepaths, f"{self.directory}{self.VECTOR_STORE_DOCUMENTS_RECORD}"):
+        documents = {}
+        manifest = {
+            "version": self.VECTOR_STORE_MANIFEST_VERSION,
+            "embedding_model": self.embedding_model,
+            "index": self.index_spec.to_dict(),
+            "files": {}
+        }
+        for path, extension in files:
+            file_documents = self.__get_documents_from_file(path, extension)
+            manifest["files"][path] = []
+            for document in file_documents:
+                document_id = get_document_id(document.page_content)
+                documents[document_id] = document
+                manifest["files"][path].append(document_id)
+
+        saved_manifest = read_manifest(f"{self.directory}{self.VECTOR_STORE_MANIFEST}")
+        if not is_manifest_compatible(saved_manifest, manifest) or not is_faiss_saved(f"{self.directory}{self.VECTOR_STORE_FOLDER}"):
+            self.__create_vector_store(documents)
+            self.__save_vector_store(manifest)
+            self.__create_lexical_index(documents)
+            return
+
+        added_ids, removed_ids = diff_manifests(saved_manifest, manifest)
+        if len(added_ids) == 0 and len(removed_ids) == 0:
             self.__load_vector_store()
-        else:
-            self.__create_vector_store(files)
-            self.__save_vector_store(filepaths)        
+            self.__load_lexical_index(documents)
+            return
 
-    def __create_vector_store(self, files: list[(str, DocumentExtension)]) -> None:
+        if len(removed_ids) > 0 and not self.index_spec.supports_removal():
+            self.__create_vector_store(documents)
+            self.__save_vector_store(manifest)
+            self.__create_lexical_index(documents)
+            return
+
+        self.__load_vector_store(read_only=False)
+        self.__update_vector_store({document_id: documents[document_id] for document_id in added_ids}, removed_ids)
+        self.__save_vector_store(manifest)
+        self.__create_lexical_index(documents)
+
+    def retrieve_documents(self, query: str, k: int, embedding: list[float] = None) -> list[Document]:
         """
-        Creates a vector store from files.
+        Retrieves the documents most related to the query. If lexical_weight is not 0, the vector store and the lexical index are searched in parallel and their rankings are merged with reciprocal rank fusion.
 
         Parameters:
-        - files: List of files to use
+        - query:     The query used for retrieval
+        - k:         The number of documents to retrieve
+        - embedding: The embedding of the query, if already computed
+
+        Returns:
+        - The retrieved documents, the most relevant first
         """
 
-        documents = []
-        for path, extension in files:
-            documents.extend(self.__get_documents_from_file(path, extension))
+        if embedding is None:
+            embedding = self.embeddings.embed_query(query)
+
+        if self.lexical_weight == 0 or self.lexical_index is None:
+            return self.vector_store.similarity_search_by_vector(embedding, k=k)
+
+        # The lexical search runs in the pool while the vector store is searched, with the context of the caller (e.g. the span timing the retrieval)
+        lexical_future = self.__search_executor.submit(contextvars.copy_context().run, self.lexical_index.search, query, k)
+        vector_documents = self.vector_store.similarity_search_by_vector(embedding, k=k)
+        lexical_ids = [document_id for document_id, _ in lexical_future.result()]
+
+        documents = {get_document_id(document.page_content): document for document in vector_documents}
+        ids = reciprocal_rank_fusion([list(documents), lexical_ids], [1.0, self.lexical_weight])[:k]
+
+        results = []
+        for document_id in ids:
+            document = documents[document_id] if document_id in documents else self.vector_store.docstore.search(document_id)
+            # The docstore answers an unknown ID (e.g. a lexical index out of sync) with a message
+            if isinstance(document, Document):
+                results.append(document)
+        return results
 
-        self.vector_store = FAISS.from_documents(
-            documents,
-            self.embeddings
+    @cached_property
+    def __search_executor(self) -> ThreadPoolExecutor:
+        # Shared by every query instead of a pool per query
+        return ThreadPoolExecutor(thread_name_prefix="rag-search")
+
+    def get_lexical_text(self, document: Document) -> str:
+        """
+        Returns the text of a document indexed by the lexical index.
+        """
+
+        return document.page_content
+
+    def get_document_metadata(self, content: str) -> dict:
+        """
+        Returns the metadata stored with a document when the vector store is built.
+
+        Parameters:
+        - content: The content of the document
+        """
+
+        return {}
+
+    def __create_lexical_index(self, documents: dict[str, Document]) -> None:
+        """
+        Creates the lexical index from documents and saves it next to the vector store.
+
+        Parameters:
+        - documents: The documents to index, by ID
+        """
+
+        self.lexical_index = BM25Index.build({document_id: self.get_lexical_text(document) for document_id, document in documents.items()})
+        self.lexical_index.save(f"{self.directory}{self.LEXICAL_INDEX}")
+        print(f"Saved lexical index to '{self.directory}{self.LEXICAL_INDEX}'")
+
+    def __load_lexical_index(self, documents: dict[str, Document]) -> None:
+        """
+        Loads the lexical index from local storage, or creates it if it was not saved.
+
+        Parameters:
+        - documents: The documents to index if the lexical index is created
+        """
+
+        if not os.path.exists(f"{self.directory}{self.LEXICAL_INDEX}"):
+            self.__create_lexical_index(documents)
+            return
+
+        self.lexical_index = BM25Index.load(f"{self.directory}{self.LEXICAL_INDEX}")
+        print(f"Loaded lexical index from '{self.directory}{self.LEXICAL_INDEX}'")
+
+    def __create_vector_store(self, documents: dict[str, Document]) -> None:
+        """
+        Creates a vector store from documents.
+
+        Parameters:
+        - documents: The documents to use, by ID
+        """
+
+        ids = list(documents)
+        texts = [documents[document_id].page_content for document_id in ids]
+        embeddings = self.__embed_documents(texts)
+
+        self.vector_store = FAISS(
+            embedding_function=self.embeddings,
+            index=self.index_spec.create_index(embeddings),
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={}
+        )
+        self.vector_store.add_embeddings(
+            zip(texts, embeddings),
+            metadatas=[documents[document_id].metadata for document_id in ids],
+            ids=ids
         )
-        print(f"Successfully created the Vector Store with {len(documents)} documents")
+        print(f"Successfully created the Vector Store with {len(documents)} documents (index: {self.index_spec.factory_string(len(documents))})")
+
+    def __update_vector_store(self, added_documents: dict[str, Document], removed_ids: list[str]) -> None:
+        """
+        Updates the vector store with the differences between the saved documents and the current ones.
+
+        Parameters:
+        - added_documents: The new documents, by ID
+        - removed_ids:     The IDs of the documents to remove
+        """
+
+        if len(removed_ids) > 0:
+            self.vector_store.delete(removed_ids)
+
+        if len(added_documents) > 0:
+            ids = list(added_documents)
+            texts = [added_documents[document_id].page_content for document_id in ids]
+            self.vector_store.add_embeddings(
+                zip(texts, self.__embed_documents(texts)),
+                metadatas=[added_documents[document_id].metadata for document_id in ids],
+                ids=ids
+            )
+
+        print(f"Updated the Vector Store: {len(added_documents)} documents added, {len(removed_ids)} documents removed")
+
+    def __embed_documents(self, texts: list[str]) -> list[list[float]]:
+        """
+        Embeds texts in concurrent batches. Embeddings are cached on disk as soon as a batch is done, so an interrupted build resumes where it stopped and texts that did not change are never embedded twice.
+
+        Parameters:
+        - texts: The texts to embed
+
+        Returns:
+        - The embeddings, in the same order as the texts
+        """
+
+        batches = [texts[i:i + self.embedding_batch_size] for i in range(0, len(texts), self.embedding_batch_size)]
+        embeddings = [None] * len(batches)
+        embedded_count = 0
+
+        with ThreadPoolExecutor(max_workers=self.embedding_concurrency) as executor:
+            futures = {executor.submit(self.embeddings.embed_documents, batch): i for i, batch in enumerate(batches)}
+            for future in as_completed(futures):
+                i = futures[future]
+                embeddings[i] = future.result()
+                embedded_count += len(batches[i])
+                print(f"Embedded {embedded_count}/{len(texts)} documents")
+
+        return [embedding for batch in embeddings for embedding in batch]
 
     def __get_documents_from_file(self, path: str, extension: DocumentExtension) -> None:
         """
@@ -105,53 +316,69 @@ class RAG:
 
         documents = []
         with open(path, "r") as file:
-            documents = [Document(page_content=content) for content in file.read().split(";\n")]
+            documents = [Document(page_content=content, metadata={"source": path, **self.get_document_metadata(content)}) for content in file.read().split(";\n") if content.strip() != ""]
             
         print(f"File '{path}' loaded ({len(documents)} documents).")
         return documents
  
-    def __save_vector_store(self, filepaths: list[str]) -> None:
+    def __save_vector_store(self, manifest: dict) -> None:
         """
         Saves the current vector store to local storage.
 
         Parameters:
-        - filepaths: List of paths of the files used to populate the vector store
+        - manifest: The manifest of the documents used to populate the vector store
         """
 
-        self.vector_store.save_local(
-            folder_path=f"{self.directory}{self.VECTOR_STORE_FOLDER}"
-        )
-        with open(f"{self.directory}{self.VECTOR_STORE_DOCUMENTS_RECORD}", "w") as file:
-            json.dump(filepaths, file)
-        print(f"Saved Vector Store to {self.VECTOR_STORE_FOLDER}")   
+        save_faiss(self.vector_store, f"{self.directory}{self.VECTOR_STORE_FOLDER}")
+        with open(f"{self.directory}{self.VECTOR_STORE_MANIFEST}", "w") as file:
+            json.dump(manifest, file)
+        print(f"Saved Vector Store to {self.VECTOR_STORE_FOLDER}")
+
+        # Serve the saved files (memory-mapped index, documents read on demand)
+        self.__load_vector_store()
 
-    def __load_vector_store(self) -> None:
+    def __load_vector_store(self, read_only: bool = True) -> None:
         """
-        Loads a vector store from local storage.
+        Loads a vector store from local storage. No pickle is involved: the index is memory-mapped and documents are read from SQLite by ID.
+
+        Parameters:
+        - read_only: False to load a vector store that will be updated
         """
 
-        self.vector_store = FAISS.load_local(
-            folder_path=f"{self.directory}{self.VECTOR_STORE_FOLDER}",
-            embeddings=self.embeddings,
-            allow_dangerous_deserialization=True # WARNING: Load only self-created files (trusted)
+        self.vector_store = load_faiss(
+            f"{self.directory}{self.VECTOR_STORE_FOLDER}",
+            self.embeddings,
+            read_only=read_only
         )
-        print(f"Loaded Vector Store from '{self.directory}{self.VECTOR_STORE_FOLDER}' (same files)")   
+        self.index_spec.configure(self.vector_store.index)
+        print(f"Loaded Vector Store from '{self.directory}{self.VECTOR_STORE_FOLDER}'")
 
 class CapecRAG(RAG):
     """
-    RAG module with re-ranking
+    RAG module with re-ranking: abstracts of CAPEC entries are retrieved from the vector store, then their detailed version is reranked.
+
+    Attributes:
+    - complete_capec: The detailed CAPEC entries, by ID (a CapecDetailStore read on demand, or a dict for JSON files)
+    - reranker:       The reranker of the detailed entries (by default, based on embeddings)
     """
 
-    def __init__(self, embedding_model: str, directory: str, complete_capec: (str, DocumentExtension)):
-        self.embeddings = OllamaEmbeddings(model=embedding_model)
+    def __init__(self, embedding_model: str, directory: str, complete_capec: (str, DocumentExtension), embedding_batch_size: int = 64, embedding_concurrency: int = 4, reranker: Reranker = None, lexical_weight: float = 1.0, index_spec: IndexSpec = None, embeddings: Embeddings = None):
+        self.embedding_model = embedding_model
+        self.embeddings = get_cached_embeddings(embedding_model, f"{directory}{self.EMBEDDING_CACHE_FOLDER}", embeddings)
         self.directory = directory
-        self.llm = ChatOllama(model="llama3:8b", temperature=0)
+        self.embedding_batch_size = embedding_batch_size
+        self.embedding_concurrency = embedding_concurrency
+        self.lexical_weight = lexical_weight
+        self.index_spec = index_spec if index_spec is not None else IndexSpec()
+        self.reranker = reranker if reranker is not None else EmbeddingReranker(self.embeddings)
         
         complete_capec_file, extension = complete_capec
-        if extension != DocumentExtension.JSON:
-            raise Exception("Only JSON file are supported")
-
-        self.complete_capec = self.__get_complete_capec(complete_capec_file)
+        if extension == DocumentExtension.SQLITE:
+            self.complete_capec = CapecDetailStore(complete_capec_file)
+        elif extension == DocumentExtension.JSON:
+            self.complete_capec = self.__get_complete_capec(complete_capec_file)
+        else:
+            raise Exception("Only SQLite and JSON files are supported")
  
     def __get_complete_capec(self, filename):
         capec_dict = {}
@@ -161,38 +388,103 @@ class CapecRAG(RAG):
 
         return capec_dict   
 
-    def search(self, query, k=6):
-        results = self.vector_store.similarity_search(query=query, k=k)
-        complete_results = ""
-        for result in results:
-            capec_id = get_capec_id_from_text(result.page_content)
-            complete_results += self.complete_capec[capec_id]
-
-        system_prompt = "You are a helpful assistant that determines whether given information items (delimited by '###') relates to a certain context (delimited by <context></context>) or not. You return the top 3 detailed capec entries that relate best to the context. For each capec entry you decide to return, copy all the details including the description, vulnerabilities (if there are any), and mitigations"
-        human_prompt = """You will be given a context and information items. Return the top 3 detailed (just copy the description, vulnerabilities and mitigations) capec entries that relate best to the context.
-Context:
-<context>
-{context}
-</context>
-
-Capec entries: 
-###
-{items}
-###"""
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", system_prompt),
-            ("human", human_prompt)
-        ])
-        chain = prompt | self.llm
-        result = chain.invoke({
-            "context": query,
-            "items": complete_results
-        })
-
-        return [result.content]
+    def __get_details(self, capec_ids: list[str]) -> dict[str, str]:
+        if isinstance(self.complete_capec, dict):
+            return {capec_id: self.complete_capec[capec_id] for capec_id in capec_ids if capec_id in self.complete_capec}
+        return self.complete_capec.get(capec_ids)
+
+    def get_document_metadata(self, content: str) -> dict:
+        capec_id = get_capec_id_from_text(content)
+        return {} if capec_id is None else {"capec_id": capec_id}
+
+    def get_lexical_text(self, document: Document) -> str:
+        # Also index the vulnerabilities and mitigations of the detailed entry
+        capec_id = document.metadata.get("capec_id")
+        details = self.__get_details([capec_id]) if capec_id is not None else {}
+        return f"{document.page_content}\n{details.get(capec_id, '')}"
+
+    async def asearch(self, query, k=6, top_k=3):
+        return await asyncio.to_thread(self.search, query, k, top_k)
+
+    def search(self, query, k=6, top_k=3):
+        with span("vector-search"):
+            # The query is embedded once, for the vector search and the reranking
+            query_embedding = self.embeddings.embed_query(query)
+            results = self.retrieve_documents(query, k, query_embedding)
+            capec_ids = [result.metadata["capec_id"] for result in results if "capec_id" in result.metadata]
+            details = self.__get_details(capec_ids)
+        candidates = {capec_id: details[capec_id] for capec_id in capec_ids if capec_id in details}
+
+        # Detailed entries are returned verbatim, in order of relevance
+        with span("rerank"):
+            return [candidates[capec_id] for capec_id in self.reranker.rerank(query, candidates, top_k, query_embedding)]
+
+def get_cached_embeddings(embedding_model: str, cache_directory: str, embeddings: Embeddings = None) -> CacheBackedEmbeddings:
+    """
+    Returns Ollama embeddings whose document embeddings are cached on disk, keyed by the embedding model and a hash of the text.
+
+    Parameters:
+    - embedding_model: The Ollama embedding model
+    - cache_directory: The folder where embeddings are cached
+    - embeddings:      The embeddings of the model (by default, from the default Ollama server)
+    """
+
+    return CacheBackedEmbeddings.from_bytes_store(
+        embeddings if embeddings is not None else OllamaEmbeddings(model=embedding_model),
+        LocalFileStore(cache_directory),
+        # Keys of the file store can not contain ':' (e.g. "nomic-embed-text:latest")
+        namespace=re.sub(r"[^a-zA-Z0-9_.\-]", "_", embedding_model)
+    )
+
+def get_document_id(text: str) -> str:
+    """
+    Returns the ID of a document: the hash of its content. A changed document is thus seen as the removal of the old one and the addition of a new one.
+    """
+
+    return sha256(text.encode("utf-8")).hexdigest()
+
+def read_manifest(file_path: str) -> dict:
+    if not os.path.exists(file_path):
+        return None
+
+    with open(file_path, "r") as file:
+        return json.load(file)
+
+def is_manifest_compatible(saved_manifest: dict, manifest: dict) -> bool:
+    """
+    Tells whether a vector store saved with saved_manifest can be updated to match manifest, instead of being created from scratch.
+    """
+
+    return saved_manifest is not None \
+        and saved_manifest.get("version") == manifest["version"] \
+        and saved_manifest.get("embedding_model") == manifest["embedding_model"] \
+        and saved_manifest.get("index") == manifest["index"]
+
+def diff_manifests(saved_manifest: dict, manifest: dict) -> (list[str], list[str]):
+    """
+    Compares the documents recorded in two manifests.
+
+    Returns:
+    - The IDs of the documents only in manifest (to add)
+    - The IDs of the documents only in saved_manifest (to remove)
+    """
+
+    saved_ids = [document_id for file_ids in saved_manifest["files"].values() for document_id in file_ids]
+    ids = [document_id for file_ids in manifest["files"].values() for document_id in file_ids]
+
+    saved_id_set = set(saved_ids)
+    id_set = set(ids)
+    added_ids = [document_id for document_id in dict.fromkeys(ids) if document_id not in saved_id_set]
+    removed_ids = [document_id for document_id in dict.fromkeys(saved_ids) if document_id not in id_set]
+    return added_ids, removed_ids
 
 def get_capec_id_from_text(text: str) -> str:
-    return text.split('-')[1].split(']')[0]
+    """
+    Returns the ID of the first CAPEC entry cited in the text (e.g. "66" for "[CAPEC-66]"), or None.
+    """
+
+    match = re.search(r"CAPEC-(\d+)", text)
+    return match.group(1) if match is not None else None
 
 def is_list_equal_to_json_file_content(data: list, file_path: str) -> bool:
     if not os.path.exists(file_path):
@@ -0,0 +1,116 @@
+from langchain_core.embeddings import Embeddings
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_ollama import ChatOllama
+
+from functools import cached_property
+import math
+import re
+
+class Reranker:
+    """
+    Ranks the entries retrieved from the vector store by relevance to the query.
+    """
+
+    def rerank(self, query: str, candidates: dict[str, str], k: int, query_embedding: list[float] = None) -> list[str]:
+        """
+        Ranks candidate entries.
+
+        Parameters:
+        - query:           The query used for retrieval
+        - candidates:      The text of the candidate entries, by ID
+        - k:               The number of entries to keep
+        - query_embedding: The embedding of the query by the embeddings of the vector store, if already computed
+
+        Returns:
+        - The IDs of the k most relevant entries, the most relevant first
+        """
+
+        raise Exception("Invalid class: Reranker::rerank() not implemented")
+
+class EmbeddingReranker(Reranker):
+    """
+    Ranks entries by cosine similarity between the query and their complete text (the vector store only indexes an abstract of each entry).
+    """
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+
+    def rerank(self, query: str, candidates: dict[str, str], k: int, query_embedding: list[float] = None) -> list[str]:
+        ids = list(candidates)
+        if query_embedding is None:
+            query_embedding = self.embeddings.embed_query(query)
+        embeddings = self.embeddings.embed_documents([candidates[candidate_id] for candidate_id in ids])
+
+        scores = {candidate_id: cosine_similarity(query_embedding, embedding) for candidate_id, embedding in zip(ids, embeddings)}
+        return sorted(ids, key=lambda candidate_id: scores[candidate_id], reverse=True)[:k]
+
+class LexicalReranker(Reranker):
+    """
+    Ranks entries by the terms they share with the query, weighted by their rarity among the candidates. No model is called.
+    """
+
+    def rerank(self, query: str, candidates: dict[str, str], k: int, query_embedding: list[float] = None) -> list[str]:
+        ids = list(candidates)
+        terms = {candidate_id: set(tokenize(candidates[candidate_id])) for candidate_id in ids}
+        query_terms = set(tokenize(query))
+
+        scores = {}
+        for candidate_id in ids:
+            scores[candidate_id] = 0.0
+            for term in query_terms & terms[candidate_id]:
+                document_frequency = len([other_id for other_id in ids if term in terms[other_id]])
+                scores[candidate_id] += math.log(1 + len(ids) / document_frequency)
+
+        return sorted(ids, key=lambda candidate_id: scores[candidate_id], reverse=True)[:k]
+
+class LLMReranker(Reranker):
+    """
+    Asks an LLM to select the entries that relate best to the query. Slower than the other rerankers as it requires a generation.
+    """
+
+    system_prompt = "You are a helpful assistant that determines whether given information items (delimited by '###') relates to a certain context (delimited by <context></context>) or not. You return the IDs of the top {k} capec entries that relate best to the context."
+    human_prompt = """You will be given a context and information items. Return the IDs of the top {k} capec entries that relate best to the context, separated by commas (e.g. CAPEC-1, CAPEC-2), and nothing else.
+Context:
+<context>
+{context}
+</context>
+
+Capec entries:
+###
+{items}
+###"""
+
+    def __init__(self, model: str, residency: "ModelResidency" = None):
+        if residency is not None:
+            self.llm = residency.chat_model(model)
+        else:
+            self.llm = ChatOllama(model=model, temperature=0)
+
+    def rerank(self, query: str, candidates: dict[str, str], k: int, query_embedding: list[float] = None) -> list[str]:
+        result = self.__chain.invoke({
+            "k": k,
+            "context": query,
+            "items": "\n".join(candidates.values())
+        })
+
+        # Ignore hallucinated IDs and complete with the vector store order if needed
+        ids = [candidate_id for candidate_id in dict.fromkeys(re.findall(r"CAPEC-(\d+)", result.content)) if candidate_id in candidates]
+        ids += [candidate_id for candidate_id in candidates if candidate_id not in ids]
+        return ids[:k]
+
+    @cached_property
+    def __chain(self):
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", self.system_prompt),
+            ("human", self.human_prompt)
+        ])
+        return prompt | self.llm
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+def cosine_similarity(a: list[float], b: list[float]) -> float:
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    if norm == 0:
+        return 0.0
+    return sum(x * y for x, y in zip(a, b)) / norm
@@ -0,0 +1,158 @@
+import re
+
+class ThreatKeywords:
+    HUMAN_NON_MALICIOUS = ["accidental", "accidentally", "unintentional", "unintentionally", "careless", "mistake", "negligent", "negligence", "untrained", "non-malicious", "unaware", "human error"]
+    NON_HUMAN = ["failure", "malfunction", "natural", "flood", "fire", "earthquake", "power outage", "outage", "bug", "wear", "disaster", "faulty", "defective"]
+
+LABELS = {
+    "threat": r"threats?|threat source",
+    "scenarios": r"(?:consecutive |sequence of )?threat scenarios?",
+    "incident": r"unwanted incidents?",
+    "assets": r"(?:impacted |affected |harmed )?assets?(?: impacted| affected| harmed)?",
+    "vulnerabilities": r"(?:associated )?vulnerabilit(?:y|ies)(?: \(cwe\))?",
+    "mitigations": r"(?:potential )?mitigations?"
+}
+
+def parse_risk(number: str, text: str) -> dict:
+    """
+    Converts the description of a risk, as written by the risk assessor, into a CORAS graph without calling an LLM. The description must contain a threat, numbered threat scenarios, an unwanted incident and impacted assets:
+
+    **Risk 1: Insider Attack on Tester Computer**
+    * **Threat:** Insider with access to tester computer
+    * **Consecutive Threat Scenarios:**
+        1. The insider gains unauthorized access to the tester computer (vulnerabilities: CWE-284).
+            * Mitigations: Restrict access to the tester computer
+    * **Unwanted Incident:** Injection of malicious firmware
+    * **Impacted Assets:** Health data, Wearable sensor-patch
+
+    Parameters:
+    - number: The number of the risk, used to namespace the IDs of its vertices ("R1-T1")
+    - text:   The description of the risk
+
+    Returns:
+    - The CORAS graph, or None if the description does not follow the expected structure
+    """
+
+    fields = get_fields(text)
+    threat = fields.get("threat", "").strip()
+    incident = fields.get("incident", "").strip()
+    assets = [asset.strip(" .") for asset in re.split(r"[,;]", fields.get("assets", "")) if asset.strip(" .") != ""]
+    scenarios = get_scenarios(fields.get("scenarios", ""))
+    if threat == "" or incident == "" or len(assets) == 0 or len(scenarios) == 0:
+        return None
+
+    prefix = f"R{number}-"
+    vertices = [{"id": f"{prefix}T1", "type": get_threat_type(threat), "text": remove_markdown(threat)}]
+    edges = []
+    used_vulnerabilities = set()
+
+    previous_id = f"{prefix}T1"
+    for i, (scenario, vulnerabilities, mitigations) in enumerate(scenarios):
+        scenario_id = f"{prefix}TS{i + 1}"
+        vertices.append({"id": scenario_id, "type": "threat_scenario", "text": scenario})
+
+        # A vulnerability is linked to one and only one edge: the edge leading to the scenario it makes possible
+        edge_vulnerabilities = [vulnerability for vulnerability in dict.fromkeys(vulnerabilities) if vulnerability not in used_vulnerabilities]
+        used_vulnerabilities.update(edge_vulnerabilities)
+        edges.append({"source": previous_id, "target": scenario_id, "vulnerabilities": edge_vulnerabilities})
+
+        for mitigation in mitigations:
+            mitigation_id = f"{prefix}M{len([vertex for vertex in vertices if vertex['type'] == 'mitigation']) + 1}"
+            vertices.append({"id": mitigation_id, "type": "mitigation", "text": mitigation})
+            edges.append({"source": mitigation_id, "target": scenario_id, "vulnerabilities": []})
+
+        previous_id = scenario_id
+
+    vertices.append({"id": f"{prefix}UI", "type": "unwanted_incident", "text": remove_markdown(incident)})
+    edges.append({"source": previous_id, "target": f"{prefix}UI", "vulnerabilities": []})
+
+    for asset in assets:
+        asset_id = get_asset_id(asset)
+        if asset_id == "" or asset_id in [vertex["id"] for vertex in vertices]:
+            continue
+        vertices.append({"id": asset_id, "type": "asset", "text": remove_markdown(asset)})
+        edges.append({"source": f"{prefix}UI", "target": asset_id, "vulnerabilities": []})
+
+    return {
+        "vertices": vertices,
+        "edges": edges
+    }
+
+def get_fields(text: str) -> dict[str, str]:
+    """
+    Splits the description of a risk into its labelled fields (e.g. "* **Threat:** ..."). The content of a field goes until the next top-level label, or until a paragraph that is neither indented nor a list item (e.g. the conclusion of the analysis after the last risk).
+    """
+
+    fields = {}
+    current = None
+    for line in text.splitlines():
+        label, content = match_label(line)
+        if label is not None and label not in ["vulnerabilities", "mitigations"]:
+            current = label
+            fields[current] = content
+        elif current is None:
+            continue
+        elif line.strip() != "" and re.match(r"^(?:\s|[*+\-]\s|\d+[.)]\s)", line) is None:
+            current = None
+        else:
+            fields[current] += "\n" + line
+
+    return fields
+
+def match_label(line: str) -> tuple[str, str]:
+    """
+    Returns the (field, content) of a line such as "* **Impacted Assets:** Health data", or (None, None).
+    """
+
+    for label, pattern in LABELS.items():
+        match = re.match(rf"^\s*(?:[*+\-]\s+)?(?:\*\*|__)?\s*(?:{pattern})\s*(?::\s*(?:\*\*|__)|(?:\*\*|__)\s*:|:)\s*(.*)$", line, re.IGNORECASE)
+        if match is not None:
+            return label, match.group(1)
+    return None, None
+
+def get_scenarios(text: str) -> list[tuple[str, list[str], list[str]]]:
+    """
+    Reads the numbered threat scenarios, with the vulnerabilities (CWE IDs) and mitigations listed in or below them.
+
+    Returns:
+    - The list of (text, vulnerabilities, mitigations) of each scenario
+    """
+
+    scenarios = []
+    for line in text.splitlines():
+        scenario = re.match(r"^\s*(?:[*+\-]\s+)?\d+[.)]\s+(.*)$", line)
+        if scenario is not None:
+            scenarios.append([scenario.group(1), [], []])
+            continue
+        if len(scenarios) == 0 or line.strip() == "":
+            continue
+
+        label, content = match_label(line)
+        if label == "mitigations":
+            scenarios[-1][2].extend([remove_markdown(mitigation) for mitigation in re.split(r";", content) if mitigation.strip() != ""])
+        elif label == "vulnerabilities" or "CWE-" in line:
+            scenarios[-1][1].extend(re.findall(r"CWE-\d+", line))
+        else:
+            # Continuation of the scenario text
+            scenarios[-1][0] += " " + line.strip()
+
+    return [(get_scenario_text(text), re.findall(r"CWE-\d+", text) + vulnerabilities, mitigations) for text, vulnerabilities, mitigations in scenarios]
+
+def get_scenario_text(text: str) -> str:
+    # Remove the inline list of vulnerabilities, e.g. "(vulnerabilities: CWE-140: Improper Neutralization of Delimiters)"
+    text = re.sub(r"\s*\((?:[^()]*\bvul[a-z]*\b|[^()]*CWE-\d+)[^()]*\)", "", text, flags=re.IGNORECASE)
+    return remove_markdown(text)
+
+def get_threat_type(threat: str) -> str:
+    text = threat.lower()
+    if any(keyword in text for keyword in ThreatKeywords.HUMAN_NON_MALICIOUS):
+        return "human_threat_non_malicious"
+    if any(re.search(rf"\b{keyword}", text) for keyword in ThreatKeywords.NON_HUMAN):
+        return "non_human_threat"
+    return "human_threat_malicious"
+
+def remove_markdown(text: str) -> str:
+    return re.sub(r"\*\*|__|`", "", text).strip()
+
+def get_asset_id(text: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", remove_markdown(text).lower()).strip("_")
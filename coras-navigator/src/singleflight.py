@@ -0,0 +1,409 @@
+from hashlib import sha256
+from typing import AsyncIterator, Awaitable, Callable, Iterator
+import asyncio
+import threading
+
+from cache import is_llm_cache_bypassed
+from jobs import JobCancelled
+from metrics import METRICS, log
+
+class FlightAbandoned(Exception):
+    """
+    The call running a shared computation went away (client disconnected, cancelled job or task) before its end.
+    """
+
+    pass
+
+class Flight:
+    """
+    A computation in progress, shared by the identical calls made while it runs.
+
+    Attributes:
+    - key:       The stage and the normalized input of the computation
+    - chunks:    The chunks streamed so far (for a streamed computation), replayed to every follower
+    - result:    The result, once done
+    - error:     The exception raised by the computation, if any
+    - done:      Whether the computation is over
+    - followers: Number of calls attached to the computation, besides the one running it
+    - listeners: Number of calls still waiting for the computation (the one running it included)
+    - producer:  The task running an asynchronous computation
+    """
+
+    def __init__(self, key: tuple):
+        self.key = key
+        self.chunks = []
+        self.result = None
+        self.error = None
+        self.done = False
+        self.followers = 0
+        self.listeners = 1
+        self.producer = None
+        self.__condition = threading.Condition()
+        # Futures of the asynchronous followers waiting for a chunk, with their event loop
+        self.__waiters = []
+
+    def emit(self, chunk: str) -> None:
+        with self.__condition:
+            self.chunks.append(chunk)
+            self.__notify()
+
+    def finish(self, result=None, error: BaseException = None) -> None:
+        with self.__condition:
+            self.result = result
+            self.error = error
+            self.done = True
+            self.__notify()
+
+    def wait(self):
+        """
+        Blocks until the computation is over.
+
+        Returns:
+        - The result of the computation (raises its error, if any)
+        """
+
+        with self.__condition:
+            while not self.done:
+                self.__condition.wait()
+        return self.__get_result()
+
+    async def await_result(self):
+        """
+        Same as wait, without blocking the event loop.
+        """
+
+        while not (await self.__anext_chunks(len(self.chunks)))[1]:
+            pass
+        return self.__get_result()
+
+    def subscribe(self) -> Iterator[str]:
+        """
+        Yields every chunk of the computation, starting from the first one, until it is over. A computation that is not streamed gives its result as a single chunk.
+        """
+
+        index = 0
+        while True:
+            with self.__condition:
+                while index >= len(self.chunks) and not self.done:
+                    self.__condition.wait()
+                chunks = self.chunks[index:]
+                done = self.done
+            index += len(chunks)
+            yield from chunks
+
+            if done:
+                result = self.__get_result()
+                if index == 0 and isinstance(result, str):
+                    yield result
+                return
+
+    async def asubscribe(self) -> AsyncIterator[str]:
+        """
+        Same as subscribe, without blocking the event loop.
+        """
+
+        index = 0
+        while True:
+            chunks, done = await self.__anext_chunks(index)
+            index += len(chunks)
+            for chunk in chunks:
+                yield chunk
+
+            if done:
+                result = self.__get_result()
+                if index == 0 and isinstance(result, str):
+                    yield result
+                return
+
+    async def __anext_chunks(self, index: int) -> tuple[list[str], bool]:
+        """
+        Waits for the chunks after index, or for the end of the computation.
+
+        Returns:
+        - The new chunks, and whether the computation is over
+        """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.__condition:
+                if index < len(self.chunks) or self.done:
+                    return self.chunks[index:], self.done
+                waiter = loop.create_future()
+                self.__waiters.append((loop, waiter))
+
+            try:
+                await waiter
+            finally:
+                with self.__condition:
+                    if (loop, waiter) in self.__waiters:
+                        self.__waiters.remove((loop, waiter))
+
+    def __get_result(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def __notify(self) -> None:
+        self.__condition.notify_all()
+        for loop, waiter in self.__waiters:
+            try:
+                loop.call_soon_threadsafe(lambda waiter=waiter: waiter.done() or waiter.set_result(None))
+            except RuntimeError:
+                # The event loop of the waiter is closed
+                pass
+        self.__waiters = []
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: the first call with a given stage and input runs the computation, and the calls made while it runs attach to it (waiting for its result, or following its stream from the first chunk) instead of running it again.
+
+    A computation whose caller goes away goes on as long as it has followers. If it is abandoned anyway, the followers that received nothing yet run it again.
+
+    Attributes:
+    - enabled: False to run every call
+    - flights: The computations in progress, by key
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.flights = {}
+        self.__lock = threading.Lock()
+
+    def do(self, stage: str, inputs: tuple, work: Callable[[], object]):
+        """
+        Runs work, or waits for the result of an identical call in progress.
+
+        Parameters:
+        - stage:  The name of the computation (e.g. "summarize")
+        - inputs: The inputs of the computation (strings), which identify it with the stage
+        - work:   Function running the computation
+
+        Returns:
+        - The result of the computation
+        """
+
+        flight, leader = self.__join(stage, inputs)
+        if flight is None:
+            return work()
+
+        if not leader:
+            try:
+                return flight.wait()
+            except FlightAbandoned:
+                pass
+            finally:
+                self.__detach(flight)
+            return self.do(stage, inputs, work)
+
+        try:
+            result = work()
+        except BaseException as error:
+            self.__land(flight, error=error)
+            raise
+        finally:
+            self.__detach(flight)
+        self.__land(flight, result=result)
+        return result
+
+    async def ado(self, stage: str, inputs: tuple, work: Callable[[], Awaitable]):
+        """
+        Same as do, for an asynchronous computation. The computation runs in its own task, which every call (the first one included) only waits for: a cancelled call detaches from the computation, which is cancelled only once no call waits for it anymore.
+        """
+
+        flight, leader = self.__join(stage, inputs)
+        if flight is None:
+            return await work()
+
+        if leader:
+            flight.producer = asyncio.create_task(self.__produce(flight, work))
+        try:
+            return await flight.await_result()
+        except FlightAbandoned:
+            if leader:
+                raise
+        finally:
+            self.__detach(flight)
+        return await self.ado(stage, inputs, work)
+
+    def stream(self, stage: str, inputs: tuple, work: Callable[[], Iterator[str]]) -> Iterator[str]:
+        """
+        Streams the chunks of work, or of an identical call in progress. The result of the computation, for the calls of do, is the whole text.
+        """
+
+        flight, leader = self.__join(stage, inputs)
+        if flight is None:
+            yield from work()
+            return
+
+        if not leader:
+            received = 0
+            try:
+                for chunk in flight.subscribe():
+                    received += 1
+                    yield chunk
+                return
+            except FlightAbandoned:
+                if received > 0:
+                    raise
+            finally:
+                self.__detach(flight)
+            yield from self.stream(stage, inputs, work)
+            return
+
+        chunks = work()
+        text = ""
+        closed = False
+        try:
+            for chunk in chunks:
+                text += chunk
+                flight.emit(chunk)
+                if closed:
+                    continue
+                try:
+                    yield chunk
+                except GeneratorExit:
+                    # The caller went away: the generation goes on for the followers, otherwise it is stopped
+                    closed = True
+                    self.__detach(flight)
+                    if flight.listeners == 0:
+                        raise
+        except BaseException as error:
+            self.__land(flight, error=error)
+            raise
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            if not closed:
+                self.__detach(flight)
+        self.__land(flight, result=text)
+
+    async def astream(self, stage: str, inputs: tuple, work: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """
+        Same as stream, for an asynchronous stream. As with ado, the stream is generated by its own task and every call follows it.
+        """
+
+        flight, leader = self.__join(stage, inputs)
+        if flight is None:
+            async for chunk in work():
+                yield chunk
+            return
+
+        if leader:
+            flight.producer = asyncio.create_task(self.__produce_stream(flight, work))
+        received = 0
+        try:
+            async for chunk in flight.asubscribe():
+                received += 1
+                yield chunk
+            return
+        except FlightAbandoned:
+            if leader or received > 0:
+                raise
+        finally:
+            self.__detach(flight)
+        async for chunk in self.astream(stage, inputs, work):
+            yield chunk
+
+    async def __produce(self, flight: Flight, work: Callable[[], Awaitable]) -> None:
+        """
+        Runs an asynchronous computation for its calls (the task of ado).
+        """
+
+        try:
+            result = await work()
+        except asyncio.CancelledError as error:
+            self.__land(flight, error=error)
+            raise
+        except Exception as error:
+            # Raised to the calls, not by the task
+            self.__land(flight, error=error)
+            return
+        self.__land(flight, result=result)
+
+    async def __produce_stream(self, flight: Flight, work: Callable[[], AsyncIterator[str]]) -> None:
+        """
+        Generates an asynchronous stream for its calls (the task of astream).
+        """
+
+        chunks = work()
+        text = ""
+        try:
+            async for chunk in chunks:
+                text += chunk
+                flight.emit(chunk)
+        except asyncio.CancelledError as error:
+            self.__land(flight, error=error)
+            raise
+        except Exception as error:
+            self.__land(flight, error=error)
+            return
+        finally:
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+        self.__land(flight, result=text)
+
+    def __join(self, stage: str, inputs: tuple) -> tuple[Flight, bool]:
+        """
+        Returns the computation of the call (None if coalescing is disabled), and whether the call runs it.
+        """
+
+        if not self.enabled:
+            return None, True
+
+        key = get_flight_key(stage, inputs)
+        with self.__lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                flight.listeners += 1
+                METRICS.increment("navigator_coalesced_calls_total", {"stage": stage}, help="Calls attached to an identical call in progress")
+                log(f"{stage}: attached to an identical call in progress")
+                return flight, False
+
+            flight = Flight(key)
+            self.flights[key] = flight
+            return flight, True
+
+    def __detach(self, flight: Flight) -> None:
+        """
+        Detaches a call that stopped waiting for a computation. An asynchronous computation that no call waits for anymore is cancelled.
+        """
+
+        with self.__lock:
+            flight.listeners -= 1
+            if flight.listeners > 0 or flight.producer is None or flight.producer.done():
+                return
+            # A new identical call starts a new computation
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+        # The call may come from another thread than the loop of the task
+        flight.producer.get_loop().call_soon_threadsafe(flight.producer.cancel)
+
+    def __land(self, flight: Flight, result=None, error: BaseException = None) -> None:
+        with self.__lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+
+        if (error is not None and not isinstance(error, Exception)) or isinstance(error, JobCancelled):
+            # The failure is the caller's (disconnected, cancelled), not the computation's
+            error = FlightAbandoned(f"Abandoned by its caller ({type(error).__name__})")
+        flight.finish(result, error)
+
+def normalize_input(text: str) -> str:
+    """
+    Normalizes the line endings and the trailing whitespace of an input, so that inputs that differ only by them (e.g. a trailing newline) share a computation. Line breaks are kept: the formatter and the risk parser read the input line by line.
+    """
+
+    lines = str(text).replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip("\n")
+
+def get_flight_key(stage: str, inputs: tuple) -> tuple:
+    """
+    Returns the key of a computation: its stage, whether the LLM cache is bypassed (a forced generation does not attach to a cached one) and the hash of its normalized inputs.
+    """
+
+    digest = sha256()
+    for value in inputs:
+        digest.update(normalize_input(value).encode("utf-8"))
+        digest.update(b"\0")
+    return (stage, is_llm_cache_bypassed(), digest.hexdigest())
@@ -0,0 +1,15 @@
+import json
+
+def format_sse_event(event: str, data) -> str:
+    """
+    Formats a Server-Sent Event.
+
+    Parameters:
+    - event: The name of the event
+    - data:  The payload of the event, serialized as JSON
+
+    Returns:
+    - The event as a string, ready to be written to the response stream
+    """
+
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,252 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from datetime import datetime, timezone
+from hashlib import sha256
+import json
+import math
+import re
+import threading
+import time
+
+class StubOllama:
+    """
+    A stand-in for the Ollama HTTP API, to run the navigator without a GPU or network. Generations return canned outputs at a configured speed, with the durations and token counts Ollama reports; embeddings are deterministic vectors of the words of the text, so that texts sharing words are similar.
+
+    Attributes:
+    - responses:          The canned outputs: (pattern, output) pairs, the first pattern found in the prompt gives the output
+    - default_response:   The output when no pattern matches
+    - latency:            Time in seconds before the first token of a generation (and the time of an embedding request)
+    - tokens_per_second:  Generation speed
+    - prompt_tokens_per_second: Prompt evaluation speed, added to the latency (None to ignore the length of the prompt)
+    - load_duration:      Time in seconds to load a model on its first call
+    - max_parallel:       Number of requests served at the same time, the others wait (as OLLAMA_NUM_PARALLEL)
+    - embedding_size:     Size of the embeddings
+    - models:             The models listed by /api/tags (None for the models called so far)
+    - port:               The port the server listens on (0 for any free port)
+    """
+
+    def __init__(self, responses: list[tuple[str, str]] = [], default_response: str = "", latency: float = 0.0, tokens_per_second: float = 50.0, prompt_tokens_per_second: float = None, load_duration: float = 0.0, max_parallel: int = 1, embedding_size: int = 256, models: list[str] = None, port: int = 0):
+        self.responses = responses
+        self.default_response = default_response
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.load_duration = load_duration
+        self.max_parallel = max_parallel
+        self.embedding_size = embedding_size
+        self.models = models
+        self.port = port
+        self.loaded = set()
+        self.requests = {}
+        self.generated_tokens = 0
+        self.__slots = threading.Semaphore(max_parallel)
+        self.__lock = threading.Lock()
+        self.__server = None
+        self.__thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self) -> "StubOllama":
+        stub = self
+
+        class Handler(StubOllamaHandler):
+            server_stub = stub
+
+        self.__server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self.__server.daemon_threads = True
+        self.port = self.__server.server_address[1]
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def __enter__(self) -> "StubOllama":
+        return self.start()
+
+    def __exit__(self, *exception) -> None:
+        self.stop()
+
+    def get_response(self, prompt: str) -> str:
+        for pattern, response in self.responses:
+            if pattern in prompt:
+                return response
+        return self.default_response
+
+    def generate(self, model: str, prompt: str) -> (list[str], dict):
+        """
+        Waits as Ollama would before the first token.
+
+        Returns:
+        - The tokens of the output, to be sent at tokens_per_second
+        - The durations (in nanoseconds) and token counts reported with the last chunk
+        """
+
+        tokens = split_tokens(self.get_response(prompt))
+        prompt_tokens = math.ceil(len(prompt) / 4)
+        load = self.__load(model)
+        prompt_eval = self.latency
+        if self.prompt_tokens_per_second is not None:
+            prompt_eval += prompt_tokens / self.prompt_tokens_per_second
+        time.sleep(prompt_eval)
+
+        self.__count(model, len(tokens))
+        return tokens, {
+            "total_duration": int((load + prompt_eval + len(tokens) / self.tokens_per_second) * 1e9),
+            "load_duration": int(load * 1e9),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_eval * 1e9),
+            "eval_count": len(tokens),
+            "eval_duration": int(len(tokens) / self.tokens_per_second * 1e9)
+        }
+
+    def embed(self, model: str, texts: list[str]) -> list[list[float]]:
+        self.__load(model)
+        time.sleep(self.latency)
+        self.__count(model, 0)
+        return [get_stub_embedding(text, self.embedding_size) for text in texts]
+
+    def acquire(self) -> None:
+        self.__slots.acquire()
+
+    def release(self) -> None:
+        self.__slots.release()
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "requests": dict(self.requests),
+                "generated_tokens": self.generated_tokens
+            }
+
+    def __load(self, model: str) -> float:
+        with self.__lock:
+            if model in self.loaded:
+                return 0.0
+            self.loaded.add(model)
+        time.sleep(self.load_duration)
+        return self.load_duration
+
+    def __count(self, model: str, tokens: int) -> None:
+        with self.__lock:
+            self.requests[model] = self.requests.get(model, 0) + 1
+            self.generated_tokens += tokens
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    """
+    Serves the endpoints of the Ollama API used by the navigator: /api/chat, /api/generate, /api/embed, /api/embeddings, /api/tags and /api/version.
+    """
+
+    server_stub: StubOllama = None
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            models = self.server_stub.models if self.server_stub.models is not None else sorted(self.server_stub.loaded)
+            self.__send_json({"models": [{"name": model, "model": model} for model in models]})
+        elif self.path == "/api/version":
+            self.__send_json({"version": "0.0.0-stub"})
+        else:
+            self.__send_json({"error": f"Unknown endpoint '{self.path}'"}, 404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        model = body.get("model", "")
+
+        if self.path in ["/api/embed", "/api/embeddings"]:
+            texts = body.get("input", body.get("prompt", ""))
+            self.server_stub.acquire()
+            try:
+                embeddings = self.server_stub.embed(model, [texts] if isinstance(texts, str) else texts)
+            finally:
+                self.server_stub.release()
+            if self.path == "/api/embed":
+                self.__send_json({"model": model, "embeddings": embeddings})
+            else:
+                self.__send_json({"embedding": embeddings[0]})
+            return
+
+        if self.path not in ["/api/chat", "/api/generate"]:
+            self.__send_json({"error": f"Unknown endpoint '{self.path}'"}, 404)
+            return
+
+        chat = self.path == "/api/chat"
+        if chat:
+            prompt = "\n".join(str(message.get("content", "")) for message in body.get("messages", []))
+        else:
+            prompt = body.get("system", "") + body.get("prompt", "")
+
+        self.server_stub.acquire()
+        try:
+            tokens, info = self.server_stub.generate(model, prompt)
+            if not body.get("stream", True):
+                time.sleep(len(tokens) / self.server_stub.tokens_per_second)
+                self.__send_json(self.__chunk(model, chat, "".join(tokens), info))
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            for token in tokens:
+                time.sleep(1 / self.server_stub.tokens_per_second)
+                self.__write_line(self.__chunk(model, chat, token))
+            self.__write_line(self.__chunk(model, chat, "", info))
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading
+            pass
+        finally:
+            self.server_stub.release()
+
+    def log_message(self, format, *args):
+        pass
+
+    def __chunk(self, model: str, chat: bool, text: str, info: dict = None) -> dict:
+        chunk = {
+            "model": model,
+            "created_at": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+            "done": info is not None
+        }
+        if chat:
+            chunk["message"] = {"role": "assistant", "content": text}
+        else:
+            chunk["response"] = text
+        if info is not None:
+            chunk.update({"done_reason": "stop", **info})
+        return chunk
+
+    def __write_line(self, data: dict) -> None:
+        self.wfile.write((json.dumps(data) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def __send_json(self, data: dict, status: int = 200) -> None:
+        content = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+def split_tokens(text: str) -> list[str]:
+    """
+    Splits a text into the chunks streamed by the stub: a word with the whitespace that follows it.
+    """
+
+    return re.findall(r"\s*\S+\s*|\s+", text)
+
+def get_stub_embedding(text: str, size: int) -> list[float]:
+    """
+    Returns a deterministic embedding of a text: each word adds a fixed random direction (derived from its hash), and the vector is normalized. Texts sharing words thus have a high cosine similarity.
+    """
+
+    vector = [0.0] * size
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        digest = sha256(word.encode("utf-8")).digest()
+        for i in range(0, 8, 2):
+            vector[int.from_bytes(digest[i:i + 2], "big") % size] += 1.0 if digest[i + 8] % 2 == 0 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector))
+    # An empty text still gets a valid (unit) vector
+    return [value / norm for value in vector] if norm > 0 else [1.0] + [0.0] * (size - 1)
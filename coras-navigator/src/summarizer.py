@@ -11,6 +11,10 @@ from langchain_community.document_loaders import PyPDFLoader
 # Summarize
 from langchain.chains.summarize import load_summarize_chain
 
+from functools import cached_property
+from typing import AsyncIterator, Iterator
+import asyncio
+
 class Summarizer:
     """
     Agent responsible for generating a structured and comprehensive description of the target of analysis from the unstructured user-provided description.
@@ -21,11 +25,14 @@ class Summarizer:
 
     llm = None
     
-    def __init__(self, model: str):
-        self.llm = OllamaLLM( 
-            model=model,
-            temperature=0
-        )
+    def __init__(self, model: str, residency: "ModelResidency" = None):
+        if residency is not None:
+            self.llm = residency.llm(model)
+        else:
+            self.llm = OllamaLLM( 
+                model=model,
+                temperature=0
+            )
 
     def summarize(self, text: str) -> str:
         """
@@ -40,16 +47,58 @@ class Summarizer:
 
         raise Exception("Invalid class: Summarizer::summarize() not implemented")
 
-class SimpleSummarizer(Summarizer):
-    def summarize(self, text: str) -> str:
-        prompt = ChatPromptTemplate.from_template("""System description: {text}
+    def summarize_stream(self, text: str) -> Iterator[str]:
+        """
+        Structures the input text, yielding the result as it is generated. By default, the whole result is yielded at once.
+
+        Parameters:
+        - text: The text to summarize/structure
+
+        Returns:
+        - An iterator over chunks of the structured description
+        """
+
+        yield self.summarize(text)
+
+    async def asummarize(self, text: str) -> str:
+        """
+        Structures the input text without blocking the event loop. By default, summarize() is run in a thread.
+        """
 
-Do not write any introductory sentence such as 'Here is a description...'. Provide a structured, clear and comprehensive description of the system: """)
+        return await asyncio.to_thread(self.summarize, text)
 
-        chain = prompt | self.llm
-        result = chain.invoke({
+    async def asummarize_stream(self, text: str) -> AsyncIterator[str]:
+        """
+        Structures the input text without blocking the event loop, yielding the result as it is generated. By default, the whole result is yielded at once.
+        """
+
+        yield await self.asummarize(text)
+
+class SimpleSummarizer(Summarizer):
+    def summarize(self, text: str) -> str:
+        result = self.__chain.invoke({
             "text": text
         })
 
         return result
 
+    def summarize_stream(self, text: str) -> Iterator[str]:
+        for chunk in self.__chain.stream({"text": text}):
+            yield chunk
+
+    async def asummarize(self, text: str) -> str:
+        return await self.__chain.ainvoke({"text": text})
+
+    async def asummarize_stream(self, text: str) -> AsyncIterator[str]:
+        async for chunk in self.__chain.astream({"text": text}):
+            yield chunk
+
+    @cached_property
+    def __chain(self):
+        # The instructions come first so that Ollama reuses their evaluation across requests
+        prompt = ChatPromptTemplate.from_template("""Do not write any introductory sentence such as 'Here is a description...'. Provide a structured, clear and comprehensive description of the system: 
+
+System description: {text}""")
+
+        return prompt | self.llm
+
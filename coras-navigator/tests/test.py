@@ -1,9 +1,51 @@
 from test_extract_JSON import test_suite_extract_JSON
 from test_is_list_equal_to_json_file_content import test_suite_is_list_equal_to_json_file_content
+from test_format_sse_event import test_suite_format_sse_event
+from test_job_manager import test_suite_job_manager
+from test_llm_cache import test_suite_llm_cache
+from test_diff_manifests import test_suite_diff_manifests
+from test_reranker import test_suite_reranker
+from test_bm25 import test_suite_bm25
+from test_sqlite_docstore import test_suite_sqlite_docstore
+from test_index_spec import test_suite_index_spec
+from test_get_capec_id_from_text import test_suite_get_capec_id_from_text
+from test_split_risks import test_suite_split_risks
+from test_parse_risk import test_suite_parse_risk
+from test_json_stream import test_suite_json_stream
+from test_model_timings import test_suite_model_timings
+from test_ollama_pool import test_suite_ollama_pool
+from test_context_builder import test_suite_context_builder
+from test_metrics import test_suite_metrics
+from test_stub_ollama import test_suite_stub_ollama
+from test_singleflight import test_suite_singleflight
+from test_download_rag_docs import test_suite_download_rag_docs
+from test_formatter import test_suite_formatter
+from test_pipeline import test_suite_pipeline
 
 def run_test_suites():
     test_suite_extract_JSON()
     test_suite_is_list_equal_to_json_file_content()
+    test_suite_format_sse_event()
+    test_suite_job_manager()
+    test_suite_llm_cache()
+    test_suite_diff_manifests()
+    test_suite_reranker()
+    test_suite_bm25()
+    test_suite_sqlite_docstore()
+    test_suite_index_spec()
+    test_suite_get_capec_id_from_text()
+    test_suite_split_risks()
+    test_suite_parse_risk()
+    test_suite_json_stream()
+    test_suite_model_timings()
+    test_suite_ollama_pool()
+    test_suite_context_builder()
+    test_suite_metrics()
+    test_suite_stub_ollama()
+    test_suite_singleflight()
+    test_suite_download_rag_docs()
+    test_suite_formatter()
+    test_suite_pipeline()
     print("All tests have been passed.")
 
 if __name__ == "__main__":
@@ -0,0 +1,40 @@
+import os
+import tempfile
+
+from bm25 import BM25Index, reciprocal_rank_fusion
+from run_test import run_test
+
+documents = {
+    "66": "[CAPEC-66]: SQL Injection: An attacker crafts SQL queries to exploit CWE-89.",
+    "98": "[CAPEC-98]: Phishing: An attacker sends fake emails to steal credentials.",
+    "112": "[CAPEC-112]: Brute Force: An attacker tries every possible credentials."
+}
+
+def test_bm25_exact_term():
+    results = BM25Index.build(documents).search("The portal is vulnerable to SQL injection", 3)
+    return results[0][0] == "66"
+
+def test_bm25_cwe_number():
+    results = BM25Index.build(documents).search("CWE-89", 3)
+    return [document_id for document_id, _ in results] == ["66"]
+
+def test_bm25_save_load():
+    file_path = os.path.join(tempfile.mkdtemp(), "bm25-index.json")
+    BM25Index.build(documents).save(file_path)
+    return BM25Index.load(file_path).search("stolen credentials", 3) == BM25Index.build(documents).search("stolen credentials", 3)
+
+def test_reciprocal_rank_fusion():
+    # "b" is ranked well by both rankings
+    return reciprocal_rank_fusion([["a", "b", "c"], ["b", "c", "d"]], [1.0, 1.0]) == ["b", "c", "a", "d"]
+
+def test_reciprocal_rank_fusion_weight():
+    return reciprocal_rank_fusion([["a"], ["d"]], [1.0, 0.0]) == ["a", "d"]
+
+def test_suite_bm25():
+    print("test_suite_bm25: ", end="")
+    run_test(test_bm25_exact_term)
+    run_test(test_bm25_cwe_number)
+    run_test(test_bm25_save_load)
+    run_test(test_reciprocal_rank_fusion)
+    run_test(test_reciprocal_rank_fusion_weight)
+    print("")
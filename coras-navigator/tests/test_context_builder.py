@@ -0,0 +1,71 @@
+from context_builder import ContextBuilder, CapecEntry
+from run_test import run_test
+
+sql_injection = """[CAPEC-66]
+**Attack pattern**: SQL Injection
+**Description**: An attacker crafts input strings to change SQL queries.
+**Vulnerabilities**:
+- CWE-89: Improper Neutralization of Special Elements used in an SQL Command
+- CWE-1286: Improper Validation of Syntactic Correctness of Input
+**Mitigations**:
+- Use parameterized SQL queries
+- Run the database with least privileges
+"""
+
+sniffing = """[CAPEC-158]
+**Attack pattern**: Sniffing Network Traffic
+**Description**: An attacker monitors network traffic between nodes.
+**Vulnerabilities**:
+- CWE-311: Missing Encryption of Sensitive Data
+**Mitigations**:
+- Encrypt the Bluetooth traffic
+"""
+
+# One token per character, to make budgets easy to reason about
+def count_characters(text: str) -> int:
+    return len(text)
+
+def test_capec_entry():
+    entry = CapecEntry(sql_injection)
+    return entry.capec_id == "66" \
+        and entry.header.endswith("change SQL queries.") \
+        and entry.vulnerabilities[0].startswith("- CWE-89") \
+        and entry.mitigations == ["- Use parameterized SQL queries", "- Run the database with least privileges"] \
+        and entry.render(entry.vulnerabilities, entry.mitigations) == sql_injection
+
+def test_context_builder_no_limit():
+    context, report = ContextBuilder().build("web form", [sql_injection, sniffing])
+    return context == sql_injection + "\n" + sniffing + "\n" \
+        and not report["cut"] \
+        and report["budget"] is None
+
+def test_context_builder_budget():
+    headers = len(CapecEntry(sql_injection).header) + 1 + len(CapecEntry(sniffing).header) + 1
+    budget = headers + len("**Mitigations**:\n- Encrypt the Bluetooth traffic\n") + 5
+    builder = ContextBuilder(budget=budget, count_tokens=count_characters)
+    context, report = builder.build("The wearable sends health data over Bluetooth traffic", [sql_injection, sniffing])
+    return report["cut"] \
+        and report["tokens"] <= budget \
+        and "[CAPEC-66]" in context and "CWE-89" not in context \
+        and "Encrypt the Bluetooth traffic" in context \
+        and report["entries"][1] == {"capec_id": "158", "kept": True, "vulnerabilities": "0/1", "mitigations": "1/1"}
+
+def test_context_builder_drops_entries():
+    builder = ContextBuilder(budget=len(CapecEntry(sql_injection).header) + 1, count_tokens=count_characters)
+    context, report = builder.build("web form", [sql_injection, sniffing])
+    return "[CAPEC-158]" not in context \
+        and report["entries"][1] == {"capec_id": "158", "kept": False}
+
+def test_context_builder_num_ctx():
+    builder = ContextBuilder(budget=10000, num_ctx=1000, answer_tokens=200, count_tokens=count_characters)
+    return builder.get_budget("x" * 300) == 500 \
+        and builder.get_budget("x" * 2000) == 0
+
+def test_suite_context_builder():
+    print("test_suite_context_builder: ", end="")
+    run_test(test_capec_entry)
+    run_test(test_context_builder_no_limit)
+    run_test(test_context_builder_budget)
+    run_test(test_context_builder_drops_entries)
+    run_test(test_context_builder_num_ctx)
+    print("")
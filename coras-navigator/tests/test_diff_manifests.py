@@ -0,0 +1,52 @@
+from rag import diff_manifests, is_manifest_compatible
+from run_test import run_test
+
+def manifest(files, embedding_model="nomic-embed-text:latest", index={"kind": "flat"}):
+    return {"version": 1, "embedding_model": embedding_model, "index": index, "files": files}
+
+def test_diff_manifests_unchanged():
+    added_ids, removed_ids = diff_manifests(
+        manifest({"capec.txt": ["a", "b"]}),
+        manifest({"capec.txt": ["b", "a"]})
+    )
+    return added_ids == [] and removed_ids == []
+
+def test_diff_manifests_changed_document():
+    added_ids, removed_ids = diff_manifests(
+        manifest({"capec.txt": ["a", "b", "c"]}),
+        manifest({"capec.txt": ["a", "b2", "c", "d"]})
+    )
+    return added_ids == ["b2", "d"] and removed_ids == ["b"]
+
+def test_diff_manifests_moved_file():
+    # Renaming a file does not require embedding its documents again
+    added_ids, removed_ids = diff_manifests(
+        manifest({"old/capec.txt": ["a", "b"]}),
+        manifest({"new/capec.txt": ["a", "b"]})
+    )
+    return added_ids == [] and removed_ids == []
+
+def test_is_manifest_compatible_other_model():
+    return not is_manifest_compatible(
+        manifest({"capec.txt": ["a"]}, "nomic-embed-text:latest"),
+        manifest({"capec.txt": ["a"]}, "mxbai-embed-large:latest")
+    )
+
+def test_is_manifest_compatible_other_index():
+    return not is_manifest_compatible(
+        manifest({"capec.txt": ["a"]}, index={"kind": "flat"}),
+        manifest({"capec.txt": ["a"]}, index={"kind": "hnsw"})
+    )
+
+def test_is_manifest_compatible_no_manifest():
+    return not is_manifest_compatible(None, manifest({"capec.txt": ["a"]}))
+
+def test_suite_diff_manifests():
+    print("test_suite_diff_manifests: ", end="")
+    run_test(test_diff_manifests_unchanged)
+    run_test(test_diff_manifests_changed_document)
+    run_test(test_diff_manifests_moved_file)
+    run_test(test_is_manifest_compatible_other_model)
+    run_test(test_is_manifest_compatible_other_index)
+    run_test(test_is_manifest_compatible_no_manifest)
+    print("")
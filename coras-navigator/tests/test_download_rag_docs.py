@@ -0,0 +1,173 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import importlib.util
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from contextlib import redirect_stdout
+
+from run_test import run_test
+
+# The script is not a module (its name has dashes)
+spec = importlib.util.spec_from_file_location("download_rag_docs", os.path.join(os.path.dirname(os.path.abspath(__file__)), "../script/download-rag-docs.py"))
+download_rag_docs = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(download_rag_docs)
+
+def get_zip(filename: str, text: str) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        zip_file.writestr(filename, text)
+    return buffer.getvalue()
+
+class Source:
+    """
+    A zip served by the test server, with its ETag.
+    """
+
+    def __init__(self, filename: str, text: str):
+        self.filename = filename
+        self.update(text)
+
+    def update(self, text: str) -> None:
+        self.text = text
+        self.content = get_zip(self.filename, text)
+        self.etag = f'"{abs(hash(self.content))}"'
+
+class SourceServer:
+    """
+    Serves zips with ETag, conditional requests (If-None-Match) and ranges (Range, If-Range), and records the requests. A zip can be cut short once, as an interrupted connection.
+    """
+
+    def __init__(self, sources: dict[str, Source]):
+        self.sources = sources
+        self.requests = []
+        self.cut_once = set()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                source = server.sources[self.path]
+                server.requests.append((self.path, dict(self.headers)))
+                if self.headers.get("If-None-Match") == source.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+
+                start = 0
+                if self.headers.get("Range") is not None and self.headers.get("If-Range") == source.etag:
+                    start = int(self.headers["Range"].removeprefix("bytes=").removesuffix("-"))
+                content = source.content[start:]
+                self.send_response(206 if start > 0 else 200)
+                self.send_header("ETag", source.etag)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                if self.path in server.cut_once:
+                    server.cut_once.remove(self.path)
+                    content = content[:len(content) // 2]
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}{path}"
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+def run_downloads(test):
+    """
+    Runs test(server, download) with a server of two sources and a temporary folder, download() downloading the sources into it.
+    """
+
+    sources = {
+        "/1000.csv.zip": Source("1000.csv", "ID,Name\n1,Attack\n"),
+        "/699.csv.zip": Source("699.csv", "ID,Name\n79,XSS\n")
+    }
+    server = SourceServer(sources)
+    directory = tempfile.mkdtemp()
+    sources_file = os.path.join(directory, "rag-sources.json")
+    with open(sources_file, "w") as file:
+        json.dump({"zip_sources": [{
+            "url": server.url(path),
+            "zip_filename": f"{name}.zip",
+            "original_filename": source.filename,
+            "final_filename": f"{name}.csv"
+        } for (path, source), name in zip(sources.items(), ["capec", "cwe"])]}, file)
+
+    def download(force=False):
+        with redirect_stdout(io.StringIO()):
+            return download_rag_docs.download_rag_docs(sources_file, os.path.join(directory, "docs/"), os.path.join(directory, "temp/"), max_workers=2, force=force)
+
+    try:
+        return test(server, download, os.path.join(directory, "docs/"))
+    finally:
+        server.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def read(filename: str) -> str:
+    with open(filename, "r") as file:
+        return file.read()
+
+def test_download_and_extract():
+    def test(server, download, docs):
+        statuses = download()
+        manifest = download_rag_docs.get_json_from_file(os.path.join(docs, download_rag_docs.MANIFEST))
+        return statuses == {"capec.csv": "downloaded", "cwe.csv": "downloaded"} \
+            and read(os.path.join(docs, "capec.csv")) == "ID,Name\n1,Attack\n" \
+            and read(os.path.join(docs, "cwe.csv")) == "ID,Name\n79,XSS\n" \
+            and all(entry["sha256"] == download_rag_docs.get_file_hash(os.path.join(docs, entry["final_filename"])) for entry in manifest.values())
+
+    return run_downloads(test)
+
+def test_download_conditional():
+    def test(server, download, docs):
+        download()
+        unchanged = download()
+        # Upstream update of one source
+        server.sources["/699.csv.zip"].update("ID,Name\n79,XSS\n89,SQL Injection\n")
+        updated = download()
+        return unchanged == {"capec.csv": "unchanged", "cwe.csv": "unchanged"} \
+            and updated == {"capec.csv": "unchanged", "cwe.csv": "downloaded"} \
+            and read(os.path.join(docs, "cwe.csv")).endswith("89,SQL Injection\n")
+
+    return run_downloads(test)
+
+def test_download_modified_locally():
+    # A file that no longer matches its checksum is downloaded again, even if it did not change upstream
+    def test(server, download, docs):
+        download()
+        with open(os.path.join(docs, "capec.csv"), "w") as file:
+            file.write("corrupted")
+        statuses = download()
+        return statuses["capec.csv"] == "downloaded" and read(os.path.join(docs, "capec.csv")) == "ID,Name\n1,Attack\n"
+
+    return run_downloads(test)
+
+def test_download_resume():
+    def test(server, download, docs):
+        server.sources["/1000.csv.zip"].update("ID,Name\n" + "".join(f"{i},Attack {i}\n" for i in range(5000)))
+        server.cut_once.add("/1000.csv.zip")
+        interrupted = download()
+        resumed = download()
+        ranges = [headers.get("Range") for path, headers in server.requests if path == "/1000.csv.zip"]
+        return interrupted["capec.csv"] == "failed" and resumed["capec.csv"] == "downloaded" \
+            and ranges[0] is None and ranges[1] is not None \
+            and read(os.path.join(docs, "capec.csv")) == server.sources["/1000.csv.zip"].text
+
+    return run_downloads(test)
+
+def test_suite_download_rag_docs():
+    print("test_suite_download_rag_docs: ", end="")
+    run_test(test_download_and_extract)
+    run_test(test_download_conditional)
+    run_test(test_download_modified_locally)
+    run_test(test_download_resume)
+    print("")
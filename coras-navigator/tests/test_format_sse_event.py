@@ -0,0 +1,20 @@
+import json
+
+from sse import format_sse_event
+from run_test import run_test
+
+def test_format_sse_event_fields():
+    event = format_sse_event("token", {"token": "Hello"})
+    return event.startswith("event: token\ndata: ") and event.endswith("\n\n")
+
+def test_format_sse_event_multiline_data():
+    # Newlines in the payload must not split the data field
+    event = format_sse_event("result", {"summary": "line 1\nline 2"})
+    data = event.split("\n")[1][len("data: "):]
+    return len(event.split("\n")) == 4 and json.loads(data) == {"summary": "line 1\nline 2"}
+
+def test_suite_format_sse_event():
+    print("test_suite_format_sse_event: ", end="")
+    run_test(test_format_sse_event_fields)
+    run_test(test_format_sse_event_multiline_data)
+    print("")
@@ -0,0 +1,64 @@
+import asyncio
+import json
+import tempfile
+
+from langchain_core.globals import set_llm_cache
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+
+from cache import LLMCache, bypass_llm_cache
+from formatter import SimpleJSONFormatter
+from run_test import run_test
+
+CORAS_MODEL = '{"vertices": [{"type": "asset", "id": "health_data", "text": "Health data"}], "edges": []}'
+
+# Not a "Risk N" section: formatted by the LLM rather than by the rule-based parser
+TEXT = "The attacker steals the health data."
+
+def create_formatter(outputs: list[str]):
+    """
+    Returns a formatter whose LLM answers outputs in turn, and the iterator of the outputs not generated yet.
+    """
+
+    messages = iter([AIMessage(content=output) for output in outputs])
+    formatter = SimpleJSONFormatter("llama3:70b")
+    formatter.llm = GenericFakeChatModel(messages=messages)
+    return formatter, messages
+
+def test_formatter_cache():
+    # The generations are streamed to be validated, they go through the LLM cache all the same
+    set_llm_cache(LLMCache(tempfile.mkdtemp()))
+    try:
+        formatter, remaining = create_formatter([CORAS_MODEL, CORAS_MODEL])
+        first = formatter.format(TEXT)
+        second = formatter.format(TEXT)
+        streamed = "".join(formatter.format_stream(TEXT))
+        with bypass_llm_cache():
+            forced = formatter.format(TEXT)
+    finally:
+        set_llm_cache(None)
+    return first == second == forced and json.loads(streamed) == json.loads(first) and list(remaining) == []
+
+def test_formatter_retry():
+    # An output cut before the end of the object that cannot be repaired is generated again, in both the synchronous and the asynchronous formatting
+    truncated = '{"vertices": [{"type": "asset", "id": "health_data", "te'
+    formatter, remaining = create_formatter([truncated, CORAS_MODEL])
+    text, report = formatter.format_with_report(TEXT)
+    async_formatter, async_remaining = create_formatter([truncated, CORAS_MODEL])
+    async_text, async_report = asyncio.run(async_formatter.aformat_with_report(TEXT))
+
+    return json.loads(text) == json.loads(async_text) == json.loads(CORAS_MODEL) \
+        and report == async_report == [{"risk": None, "path": "llm"}] and list(remaining) == list(async_remaining) == []
+
+def test_formatter_retry_failed():
+    # Once the retries are exhausted, the error is reported and the risk is left empty
+    formatter, _ = create_formatter(['{"vertices": [{"type": "unknown"', '{"edges": 1}'])
+    text, report = asyncio.run(formatter.aformat_with_report(TEXT))
+    return json.loads(text) == {"vertices": [], "edges": []} and "error" in report[0]
+
+def test_suite_formatter():
+    print("test_suite_formatter: ", end="")
+    run_test(test_formatter_cache)
+    run_test(test_formatter_retry)
+    run_test(test_formatter_retry_failed)
+    print("")
@@ -0,0 +1,19 @@
+from rag import get_capec_id_from_text
+from run_test import run_test
+
+def test_get_capec_id_from_text_abstract():
+    return get_capec_id_from_text("[CAPEC-66]: SQL Injection: This attack exploits target software...") == "66"
+
+def test_get_capec_id_from_text_hyphen_before_id():
+    # The name of the attack pattern may contain hyphens
+    return get_capec_id_from_text("Cross-Site Scripting [CAPEC-63]") == "63"
+
+def test_get_capec_id_from_text_no_id():
+    return get_capec_id_from_text("CWE-79: Improper Neutralization of Input") is None
+
+def test_suite_get_capec_id_from_text():
+    print("test_suite_get_capec_id_from_text: ", end="")
+    run_test(test_get_capec_id_from_text_abstract)
+    run_test(test_get_capec_id_from_text_hyphen_before_id)
+    run_test(test_get_capec_id_from_text_no_id)
+    print("")
@@ -0,0 +1,33 @@
+from index_spec import IndexSpec
+from run_test import run_test
+
+def test_index_spec_flat():
+    return IndexSpec().factory_string() == "Flat"
+
+def test_index_spec_parse_hnsw():
+    spec = IndexSpec.parse("hnsw:m=16,ef_search=128")
+    return spec.factory_string() == "HNSW16" and spec.ef_search == 128 and not spec.supports_removal()
+
+def test_index_spec_parse_ivf_pq():
+    return IndexSpec.parse("ivf:nlist=256,compression=pq,pq_m=8").factory_string() == "IVF256,PQ8"
+
+def test_index_spec_ivf_clusters_capped():
+    # 39 training vectors per cluster at least
+    return IndexSpec.parse("ivf:nlist=256,compression=sq8").factory_string(document_count=600) == "IVF15,SQ8"
+
+def test_index_spec_unknown_kind():
+    try:
+        IndexSpec.parse("lsh")
+    except Exception:
+        return True
+
+    return False
+
+def test_suite_index_spec():
+    print("test_suite_index_spec: ", end="")
+    run_test(test_index_spec_flat)
+    run_test(test_index_spec_parse_hnsw)
+    run_test(test_index_spec_parse_ivf_pq)
+    run_test(test_index_spec_ivf_clusters_capped)
+    run_test(test_index_spec_unknown_kind)
+    print("")
@@ -0,0 +1,73 @@
+import threading
+
+from jobs import JobManager, JobQueueFull, JobStatus
+from run_test import run_test
+
+def wait_for(job, timeout=5):
+    for event, data in job.subscribe(poll_interval=0.05):
+        if event == "status":
+            return data
+    return None
+
+def test_job_manager_done():
+    manager = JobManager(max_workers=1)
+    job = manager.submit("test", lambda job: job.collect(iter(["a", "b", "c"])))
+    status = wait_for(job)
+    tokens = [data['token'] for event, data in job.events if event == "token"]
+    return status['status'] == JobStatus.DONE and status['result'] == "abc" and tokens == ["a", "b", "c"]
+
+def test_job_manager_failed():
+    def work(job):
+        raise Exception("Ollama unreachable")
+
+    manager = JobManager(max_workers=1)
+    status = wait_for(manager.submit("test", work))
+    return status['status'] == JobStatus.FAILED and status['error'] == "Ollama unreachable"
+
+def test_job_manager_cancel_running():
+    started = threading.Event()
+
+    def tokens():
+        started.set()
+        while True:
+            yield "token"
+
+    manager = JobManager(max_workers=1)
+    job = manager.submit("test", lambda job: job.collect(tokens()))
+    started.wait(5)
+    manager.cancel(job.id)
+    return wait_for(job)['status'] == JobStatus.CANCELLED
+
+def test_job_manager_cancel_queued():
+    release = threading.Event()
+
+    manager = JobManager(max_workers=1)
+    blocking = manager.submit("test", lambda job: release.wait(5))
+    queued = manager.submit("test", lambda job: "never")
+    manager.cancel(queued.id)
+    release.set()
+    wait_for(blocking)
+    return queued.status == JobStatus.CANCELLED and queued.result is None
+
+def test_job_manager_queue_full():
+    release = threading.Event()
+
+    manager = JobManager(max_workers=1, max_pending=1)
+    manager.submit("test", lambda job: release.wait(5))
+    try:
+        manager.submit("test", lambda job: None)
+    except JobQueueFull:
+        return True
+    finally:
+        release.set()
+
+    return False
+
+def test_suite_job_manager():
+    print("test_suite_job_manager: ", end="")
+    run_test(test_job_manager_done)
+    run_test(test_job_manager_failed)
+    run_test(test_job_manager_cancel_running)
+    run_test(test_job_manager_cancel_queued)
+    run_test(test_job_manager_queue_full)
+    print("")
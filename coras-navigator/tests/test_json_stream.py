@@ -0,0 +1,75 @@
+from json_stream import JSONStreamValidator, JSONExtractionError, ExtractionErrorReason, extract_json_object
+from run_test import run_test
+
+schema = {
+    "type": "object",
+    "properties": {
+        "vertices": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "type": {"type": "string", "enum": ["asset", "threat_scenario"]},
+                    "id": {"type": "string"}
+                },
+                "required": ["type", "id"]
+            }
+        },
+        "edges": {"type": "array", "items": {"type": "object"}}
+    },
+    "required": ["vertices", "edges"]
+}
+
+def get_error(chunks: list[str]) -> JSONExtractionError:
+    validator = JSONStreamValidator(schema)
+    try:
+        for chunk in chunks:
+            validator.feed(chunk)
+        validator.close()
+    except JSONExtractionError as error:
+        return error
+    return None
+
+def test_json_stream_valid():
+    chunks = ['Here is the model: {"vert', 'ices": [{"type": "asset", "id": "a\\"b"}], ', '"edges": [], "count": -1.5e2, "ok": true}', ' Done.']
+    validator = JSONStreamValidator(schema)
+    done = [validator.feed(chunk) for chunk in chunks]
+    return done == [False, False, True, True] \
+        and validator.close() == {"vertices": [{"type": "asset", "id": "a\"b"}], "edges": [], "count": -150.0, "ok": True}
+
+def test_json_stream_early_abort():
+    # The invalid enum value is detected before the end of the string
+    error = get_error(['{"vertices": [{"type": "assez', 'this part is never read'])
+    return error.reason == ExtractionErrorReason.SCHEMA \
+        and error.path == "vertices[0].type" \
+        and error.position < len('{"vertices": [{"type": "assez')
+
+def test_json_stream_errors():
+    return get_error(['{"vertices": "none"}']).reason == ExtractionErrorReason.SCHEMA \
+        and get_error(['{"vertices": [{"id": "a"}]']).to_dict()["path"] == "vertices[0]" \
+        and get_error(['{"vertices" 1}']).reason == ExtractionErrorReason.SYNTAX \
+        and get_error(['{"vertices": [], ']).reason == ExtractionErrorReason.TRUNCATED \
+        and get_error(['{"vertices": [], ' + ' ' * 1000]).reason == ExtractionErrorReason.RUNAWAY \
+        and get_error(['No JSON here']).reason == ExtractionErrorReason.NO_JSON
+
+def test_json_stream_repair():
+    validator = JSONStreamValidator(schema)
+    validator.feed('{"edges": [], "vertices": [{"type": "asset", "id": "a"}, {"type": "thr')
+    return validator.repair() == {"edges": [], "vertices": [{"type": "asset", "id": "a"}]}
+
+def test_extract_json_object():
+    try:
+        extract_json_object('{"vertices": []}', schema)
+    except JSONExtractionError as error:
+        return error.reason == ExtractionErrorReason.SCHEMA \
+            and extract_json_object('Model:\n{"vertices": [], "edges": []}\n', schema) == {"vertices": [], "edges": []}
+    return False
+
+def test_suite_json_stream():
+    print("test_suite_json_stream: ", end="")
+    run_test(test_json_stream_valid)
+    run_test(test_json_stream_early_abort)
+    run_test(test_json_stream_errors)
+    run_test(test_json_stream_repair)
+    run_test(test_extract_json_object)
+    print("")
@@ -0,0 +1,46 @@
+import tempfile
+
+from langchain_core.outputs import Generation
+
+from cache import LLMCache, bypass_llm_cache
+from run_test import run_test
+
+def test_llm_cache_hit():
+    cache = LLMCache(tempfile.mkdtemp())
+    cache.update("prompt", "llama3", [Generation(text="answer")])
+    result = cache.lookup("prompt", "llama3")
+    return result is not None and result[0].text == "answer" and cache.hits == 1
+
+def test_llm_cache_miss_other_parameters():
+    cache = LLMCache(tempfile.mkdtemp())
+    cache.update("prompt", "llama3 temperature=0", [Generation(text="answer")])
+    return cache.lookup("prompt", "llama3 temperature=1") is None and cache.misses == 1
+
+def test_llm_cache_disk_tier():
+    directory = tempfile.mkdtemp()
+    LLMCache(directory).update("prompt", "llama3", [Generation(text="answer")])
+    # A new cache (e.g. after a restart) reads the entry from disk
+    result = LLMCache(directory).lookup("prompt", "llama3")
+    return result is not None and result[0].text == "answer"
+
+def test_llm_cache_disk_eviction():
+    cache = LLMCache(tempfile.mkdtemp(), max_bytes=1)
+    cache.update("first", "llama3", [Generation(text="answer")])
+    cache.update("second", "llama3", [Generation(text="answer")])
+    return cache.stats()['disk_entries'] == 1
+
+def test_llm_cache_bypass():
+    cache = LLMCache(tempfile.mkdtemp())
+    cache.update("prompt", "llama3", [Generation(text="answer")])
+    with bypass_llm_cache():
+        result = cache.lookup("prompt", "llama3")
+    return result is None and cache.lookup("prompt", "llama3") is not None
+
+def test_suite_llm_cache():
+    print("test_suite_llm_cache: ", end="")
+    run_test(test_llm_cache_hit)
+    run_test(test_llm_cache_miss_other_parameters)
+    run_test(test_llm_cache_disk_tier)
+    run_test(test_llm_cache_disk_eviction)
+    run_test(test_llm_cache_bypass)
+    print("")
@@ -0,0 +1,111 @@
+from metrics import Metrics, request_id, current_span
+from run_test import run_test
+
+from contextlib import redirect_stdout
+import asyncio
+import io
+
+def test_span_records_duration():
+    metrics = Metrics()
+    with metrics.span("retrieve"):
+        pass
+    text = metrics.render()
+    return 'navigator_stage_duration_seconds_count{stage="retrieve"} 1' in text \
+        and 'navigator_stage_duration_seconds_bucket{stage="retrieve",le="+Inf"} 1' in text \
+        and 'navigator_stage_total{stage="retrieve",status="ok"} 1' in text \
+        and "# TYPE navigator_stage_duration_seconds histogram" in text \
+        and current_span.get() is None
+
+def test_span_records_error():
+    metrics = Metrics()
+    try:
+        with metrics.span("format"):
+            raise ValueError("Invalid JSON")
+    except ValueError:
+        pass
+    return 'navigator_stage_total{stage="format",status="error"} 1' in metrics.render()
+
+def test_generation_added_to_span():
+    metrics = Metrics()
+    info = {"prompt_eval_count": 120, "prompt_eval_duration": 2 * 10**9, "eval_count": 40, "eval_duration": 4 * 10**9}
+    with metrics.span("assess") as span:
+        metrics.record_generation("llama3:70b-instruct", info)
+        metrics.record_generation("llama3:70b-instruct", info)
+    text = metrics.render()
+    return span.prompt_tokens == 240 \
+        and span.generated_tokens == 80 \
+        and "generated: 80 tokens (10.0 tokens/s)" in span.describe(1.0) \
+        and 'navigator_llm_generated_tokens_total{model="llama3:70b-instruct",stage="assess"} 80' in text \
+        and 'navigator_llm_calls_total{model="llama3:70b-instruct",stage="assess"} 2' in text
+
+def test_trace_stream_cancelled():
+    metrics = Metrics()
+    chunks = metrics.trace_stream("summarize", iter(["The ", "system ", "..."]))
+    next(chunks)
+    # The client went away
+    chunks.close()
+    return 'navigator_stage_total{stage="summarize",status="cancelled"} 1' in metrics.render()
+
+def test_atrace_stream_cancelled():
+    metrics = Metrics()
+
+    async def generate():
+        for chunk in ["The ", "system ", "..."]:
+            await asyncio.sleep(0)
+            yield chunk
+
+    async def read():
+        chunks = metrics.atrace_stream("assess", generate())
+        first = await anext(chunks)
+        # The client went away
+        await chunks.aclose()
+        return first
+
+    return asyncio.run(read()) == "The " \
+        and 'navigator_stage_total{stage="assess",status="cancelled"} 1' in metrics.render()
+
+def test_collectors():
+    metrics = Metrics()
+    metrics.register_collector(lambda: [("navigator_jobs_queued", {}, 3), ("navigator_ollama_host_healthy", {"host": 'http://box"1'}, 1.0)], {
+        "navigator_jobs_queued": "Jobs waiting for a worker"
+    })
+    text = metrics.render()
+    return "# HELP navigator_jobs_queued Jobs waiting for a worker\n# TYPE navigator_jobs_queued gauge\nnavigator_jobs_queued 3\n" in text \
+        and 'navigator_ollama_host_healthy{host="http://box\\"1"} 1' in text
+
+def test_request_id_in_logs():
+    metrics = Metrics()
+    output = io.StringIO()
+    token = request_id.set("abc123")
+    try:
+        with redirect_stdout(output):
+            with metrics.span("retrieve"):
+                pass
+    finally:
+        request_id.reset(token)
+    return output.getvalue().startswith("[abc123] retrieve ")
+
+def test_nested_spans():
+    metrics = Metrics()
+    with metrics.span("retrieve") as root:
+        with metrics.span("vector-search"):
+            with metrics.span("embed"):
+                pass
+        with metrics.span("rerank"):
+            with metrics.span("embed"):
+                pass
+    return [child.stage for child in root.children] == ["vector-search", "rerank"] \
+        and len(root.find("embed")) == 2 \
+        and root.duration >= sum(child.duration for child in root.children)
+
+def test_suite_metrics():
+    print("test_suite_metrics: ", end="")
+    run_test(test_span_records_duration)
+    run_test(test_span_records_error)
+    run_test(test_generation_added_to_span)
+    run_test(test_trace_stream_cancelled)
+    run_test(test_atrace_stream_cancelled)
+    run_test(test_collectors)
+    run_test(test_request_id_in_logs)
+    run_test(test_nested_spans)
+    print("")
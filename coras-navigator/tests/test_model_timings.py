@@ -0,0 +1,42 @@
+from models import ModelResidency, ModelTimings
+from langchain_core.outputs import LLMResult, Generation
+from run_test import run_test
+
+def get_response(load_duration: int) -> LLMResult:
+    return LLMResult(generations=[[Generation(text="Hello", generation_info={
+        "total_duration": 4_000_000_000,
+        "load_duration": load_duration,
+        "prompt_eval_count": 100,
+        "prompt_eval_duration": 1_000_000_000,
+        "eval_count": 20,
+        "eval_duration": 2_000_000_000
+    })]])
+
+def test_model_timings():
+    residency = ModelResidency(keep_alive="10m", num_ctx=4096)
+    residency.register("llama3:8b")
+    timings = ModelTimings("llama3:8b", residency)
+    timings.on_llm_end(get_response(3_000_000_000))
+    timings.on_llm_end(get_response(5_000_000))
+
+    stats = residency.stats()
+    model = stats["models"]["llama3:8b"]
+    return stats["num_ctx"] == 4096 \
+        and model["calls"] == 2 \
+        and model["loads"] == 1 \
+        and abs(model["load_s"] - 3.005) < 1e-9 \
+        and model["prompt_tokens"] == 200 \
+        and model["generation_s"] == 4.0 \
+        and model["last"]["load_s"] == 0.005
+
+def test_model_timings_without_metadata():
+    residency = ModelResidency()
+    residency.register("llama3:8b")
+    ModelTimings("llama3:8b", residency).on_llm_end(LLMResult(generations=[[Generation(text="Hello")]]))
+    return residency.stats()["models"]["llama3:8b"] == {"kind": "llm"}
+
+def test_suite_model_timings():
+    print("test_suite_model_timings: ", end="")
+    run_test(test_model_timings)
+    run_test(test_model_timings_without_metadata)
+    print("")
@@ -0,0 +1,128 @@
+from ollama_pool import OllamaHost, OllamaPool, NoHostAvailable, parse_hosts
+from run_test import run_test
+
+import asyncio
+
+def get_pool() -> OllamaPool:
+    return OllamaPool([
+        OllamaHost("box1:11434", ["llama3:70b-instruct", "llama3:8b"], max_concurrency=2),
+        OllamaHost("box2:11434", ["llama3:8b"], max_concurrency=1)
+    ], retries=1, health_interval=3600)
+
+def test_ollama_pool_least_loaded():
+    pool = get_pool()
+    with pool.acquire("llama3:8b") as first:
+        with pool.acquire("llama3:8b") as second:
+            with pool.acquire("llama3:8b") as third:
+                hosts = [first.url, second.url, third.url]
+    return sorted(hosts) == ["http://box1:11434", "http://box1:11434", "http://box2:11434"] \
+        and all(host.in_flight == 0 for host in pool.hosts)
+
+def test_ollama_pool_model_availability():
+    pool = get_pool()
+    with pool.acquire("llama3:70b-instruct") as host:
+        url = host.url
+    try:
+        with pool.acquire("mistral"):
+            return False
+    except NoHostAvailable:
+        return url == "http://box1:11434"
+
+def test_ollama_pool_failover():
+    pool = get_pool()
+    calls = []
+
+    def work(host):
+        calls.append(host.url)
+        if host.url == "http://box1:11434":
+            raise ConnectionError("Connection refused")
+        return "answer"
+
+    # box1 is tried first
+    pool.hosts[1].calls = 1
+    return pool.call("llama3:8b", work) == "answer" \
+        and calls == ["http://box1:11434", "http://box2:11434"] \
+        and not pool.hosts[0].healthy \
+        and pool.hosts[0].failures == 1
+
+def test_ollama_pool_stream_failover():
+    pool = get_pool()
+
+    def work(host):
+        if host.url == "http://box1:11434":
+            raise ConnectionError("Connection refused")
+        yield "a"
+        yield "b"
+
+    pool.hosts[1].calls = 1
+    return list(pool.stream("llama3:8b", work)) == ["a", "b"]
+
+def test_ollama_pool_request_error():
+    # Errors that are not caused by the server are not retried
+    pool = get_pool()
+    calls = []
+
+    def work(host):
+        calls.append(host.url)
+        raise ValueError("Invalid request")
+
+    try:
+        pool.call("llama3:8b", work)
+    except ValueError:
+        return len(calls) == 1 and all(host.healthy for host in pool.hosts)
+    return False
+
+def test_ollama_pool_async_wait():
+    # box2 serves one call at a time: the second call waits for the first to release its slot
+    pool = OllamaPool([OllamaHost("box2:11434", ["llama3:8b"], max_concurrency=1)], health_interval=3600)
+    order = []
+
+    async def work(host, name):
+        order.append(f"start {name}")
+        await asyncio.sleep(0.01)
+        order.append(f"end {name}")
+        return name
+
+    async def run():
+        return await asyncio.gather(
+            pool.acall("llama3:8b", lambda host: work(host, "first")),
+            pool.acall("llama3:8b", lambda host: work(host, "second"))
+        )
+
+    return asyncio.run(run()) == ["first", "second"] \
+        and order == ["start first", "end first", "start second", "end second"] \
+        and pool.hosts[0].in_flight == 0
+
+def test_ollama_pool_async_stream_failover():
+    pool = get_pool()
+
+    async def work(host):
+        if host.url == "http://box1:11434":
+            raise ConnectionError("Connection refused")
+        yield "a"
+        yield "b"
+
+    async def read():
+        return [chunk async for chunk in pool.astream("llama3:8b", work)]
+
+    pool.hosts[1].calls = 1
+    return asyncio.run(read()) == ["a", "b"] and not pool.hosts[0].healthy
+
+def test_parse_hosts():
+    hosts = parse_hosts('[{"url": "http://box1:11434", "models": ["llama3:8b"], "max_concurrency": 2}, {"url": "box2:11434"}]')
+    simple = parse_hosts("box1:11434, http://box2:11434")
+    return [host.url for host in hosts] == ["http://box1:11434", "http://box2:11434"] \
+        and hosts[0].max_concurrency == 2 and hosts[1].models is None \
+        and [host.url for host in simple] == ["http://box1:11434", "http://box2:11434"]
+
+def test_suite_ollama_pool():
+    print("test_suite_ollama_pool: ", end="")
+    run_test(test_ollama_pool_least_loaded)
+    run_test(test_ollama_pool_model_availability)
+    run_test(test_ollama_pool_failover)
+    run_test(test_ollama_pool_stream_failover)
+    run_test(test_ollama_pool_request_error)
+    run_test(test_ollama_pool_async_wait)
+    run_test(test_ollama_pool_async_stream_failover)
+    run_test(test_parse_hosts)
+    print("")
@@ -0,0 +1,50 @@
+from risk_parser import parse_risk, get_threat_type
+from run_test import run_test
+
+risk = """**Risk 1: Insider Attack on Tester Computer**
+* **Threat:** Insider with access to tester computer
+* **Consecutive Threat Scenarios:**
+	1. The insider gains unauthorized access to the tester computer.
+	2. The compromised tester computer injects the wearable sensor-patch with malicious firmware (vulerabilities: CWE-1073: Non-SQL Invokable Control Element, CWE-140: Improper Neutralization of Delimiters).
+		* **Mitigations:** Sign the firmware; Restrict access to the tester computer
+* **Unwanted Incident:** Injection of wearable sensor-patch with malicious firmware
+* **Impacted Assets:** Health data, Wearable sensor-patch"""
+
+def test_parse_risk():
+    graph = parse_risk("1", risk)
+    ids = [vertex["id"] for vertex in graph["vertices"]]
+    return ids == ["R1-T1", "R1-TS1", "R1-TS2", "R1-M1", "R1-M2", "R1-UI", "health_data", "wearable_sensor_patch"] \
+        and graph["vertices"][2]["text"] == "The compromised tester computer injects the wearable sensor-patch with malicious firmware." \
+        and graph["edges"][1] == {"source": "R1-TS1", "target": "R1-TS2", "vulnerabilities": ["CWE-1073", "CWE-140"]} \
+        and {"source": "R1-M1", "target": "R1-TS2", "vulnerabilities": []} in graph["edges"] \
+        and {"source": "R1-TS2", "target": "R1-UI", "vulnerabilities": []} in graph["edges"] \
+        and {"source": "R1-UI", "target": "wearable_sensor_patch", "vulnerabilities": []} in graph["edges"]
+
+def test_parse_risk_vulnerability_on_one_edge():
+    text = risk.replace("tester computer.", "tester computer (CWE-140).")
+    graph = parse_risk("1", text)
+    return graph["edges"][0]["vulnerabilities"] == ["CWE-140"] \
+        and graph["edges"][1]["vulnerabilities"] == ["CWE-1073"]
+
+def test_parse_risk_malformed():
+    return parse_risk("1", risk.replace("* **Unwanted Incident:** Injection of wearable sensor-patch with malicious firmware\n", "")) is None \
+        and parse_risk("2", "**Risk 2: Eavesdropping**\nAn attacker could listen to the Bluetooth traffic.") is None
+
+def test_parse_risk_closing_paragraph():
+    # The prose after the last risk of the analysis is not part of its assets
+    graph = parse_risk("1", risk + "\n\nThese risks highlight the importance of access control, secure firmware updates, and monitoring.")
+    return [vertex["id"] for vertex in graph["vertices"] if vertex["type"] == "asset"] == ["health_data", "wearable_sensor_patch"]
+
+def test_get_threat_type():
+    return get_threat_type("Insider with access to tester computer") == "human_threat_malicious" \
+        and get_threat_type("Careless nurse") == "human_threat_non_malicious" \
+        and get_threat_type("Power outage in the hospital") == "non_human_threat"
+
+def test_suite_parse_risk():
+    print("test_suite_parse_risk: ", end="")
+    run_test(test_parse_risk)
+    run_test(test_parse_risk_vulnerability_on_one_edge)
+    run_test(test_parse_risk_malformed)
+    run_test(test_parse_risk_closing_paragraph)
+    run_test(test_get_threat_type)
+    print("")
@@ -0,0 +1,173 @@
+import threading
+import time
+
+from jobs import JobManager, JobStatus
+from pipeline import AnalysisPipeline, MissingInput, StepFailed
+from run_test import run_test
+
+class FakeNavigator:
+    """
+    Records the steps run by the pipeline, with the thread running them.
+    """
+
+    def __init__(self):
+        self.calls = []
+        # Events the next steps wait for before returning (e.g. to keep a prefetch running)
+        self.holds = []
+
+    def retrieve_with_report(self, summary: str) -> tuple[str, dict]:
+        self.__run("retrieve", summary)
+        return f"Context of {summary}", {"cut": False}
+
+    def format_with_report(self, analysis: str) -> dict:
+        self.__run("format", analysis)
+        if analysis == "":
+            raise Exception("Ollama unreachable")
+        return {"coras_model": {"vertices": [], "edges": []}, "formatting": [{"risk": None, "path": "llm"}]}
+
+    def __run(self, stage: str, text: str) -> None:
+        hold = self.holds.pop(0) if len(self.holds) > 0 else None
+        self.calls.append((stage, text, threading.current_thread()))
+        if hold is not None:
+            hold.wait(5)
+
+def block(jobs: JobManager) -> threading.Event:
+    """
+    Occupies the worker of jobs until the returned event is set.
+    """
+
+    release = threading.Event()
+    started = threading.Event()
+
+    def work(job):
+        started.set()
+        release.wait(5)
+
+    jobs.submit("block", work)
+    started.wait(5)
+    return release
+
+def test_pipeline_prefetch_reused():
+    navigator = FakeNavigator()
+    pipeline = AnalysisPipeline(navigator, JobManager(max_workers=1))
+    session = pipeline.create_session()
+
+    pipeline.set_summary(session, "A web shop")
+    context = pipeline.get_context(session)
+    pipeline.set_analysis(session, "Risk 1: SQL injection")
+    coras_model = pipeline.get_coras_model(session)
+    # Setting the same analysis again does not start another formatting
+    pipeline.set_analysis(session, "Risk 1: SQL injection")
+    pipeline.get_coras_model(session)
+
+    return context["retrieved-context"] == "Context of A web shop" and coras_model["formatting"] == [{"risk": None, "path": "llm"}] \
+        and [(stage, text) for stage, text, _ in navigator.calls] == [("retrieve", "A web shop"), ("format", "Risk 1: SQL injection")] \
+        and all(thread is not threading.current_thread() for _, _, thread in navigator.calls)
+
+def test_pipeline_input_changed():
+    # A summary or an analysis edited by the client is processed again
+    navigator = FakeNavigator()
+    pipeline = AnalysisPipeline(navigator, JobManager(max_workers=1))
+    session = pipeline.create_session()
+
+    pipeline.set_summary(session, "A web shop")
+    first_job = session.context_job
+    pipeline.get_context(session)
+    context = pipeline.get_context(session, summary="An online bank")
+    pipeline.set_analysis(session, "Risk 1: SQL injection")
+    pipeline.get_coras_model(session)
+    pipeline.get_coras_model(session, analysis="Risk 1: Phishing")
+
+    return context["retrieved-context"] == "Context of An online bank" and session.context_job is not first_job \
+        and [(stage, text) for stage, text, _ in navigator.calls] == [("retrieve", "A web shop"), ("retrieve", "An online bank"), ("format", "Risk 1: SQL injection"), ("format", "Risk 1: Phishing")]
+
+def test_pipeline_queue_full():
+    # Too busy to prefetch: the step is run by the request that needs it
+    navigator = FakeNavigator()
+    jobs = JobManager(max_workers=1, max_pending=1)
+    pipeline = AnalysisPipeline(navigator, jobs)
+    session = pipeline.create_session()
+
+    release = block(jobs)
+    try:
+        pipeline.set_analysis(session, "Risk 1: SQL injection")
+        coras_model = pipeline.get_coras_model(session)
+    finally:
+        release.set()
+
+    return session.format_job is None and coras_model["coras_model"] == {"vertices": [], "edges": []} \
+        and [(stage, thread) for stage, _, thread in navigator.calls] == [("format", threading.current_thread())]
+
+def test_pipeline_prefetch_cancelled():
+    # A prefetch cancelled while queued or running (e.g. on shutdown) is run again by the request that needs it
+    navigator = FakeNavigator()
+    jobs = JobManager(max_workers=1)
+    pipeline = AnalysisPipeline(navigator, jobs)
+    session = pipeline.create_session()
+
+    release = block(jobs)
+    try:
+        pipeline.set_summary(session, "A web shop")
+        jobs.cancel(session.context_job.id)
+        context = pipeline.get_context(session)
+    finally:
+        release.set()
+
+    hold = threading.Event()
+    navigator.holds.append(hold)
+    pipeline.set_analysis(session, "Risk 1: SQL injection")
+    while len(navigator.calls) < 2:
+        time.sleep(0.01)
+    try:
+        jobs.cancel(session.format_job.id)
+        coras_model = pipeline.get_coras_model(session)
+    finally:
+        hold.set()
+    session.format_job.wait(5)
+
+    return context["retrieved-context"] == "Context of A web shop" and coras_model["coras_model"] == {"vertices": [], "edges": []} \
+        and session.format_job.status == JobStatus.CANCELLED \
+        and [(stage, thread is threading.current_thread()) for stage, _, thread in navigator.calls] == [("retrieve", True), ("format", False), ("format", True)]
+
+def test_pipeline_sessions_expire():
+    pipeline = AnalysisPipeline(FakeNavigator(), JobManager(max_workers=1), ttl=0.05)
+    expired = pipeline.create_session()
+    time.sleep(0.1)
+    used = pipeline.create_session()
+    # An unknown (or expired) session is replaced by a new one
+    replaced = pipeline.get_session(expired.id)
+
+    return expired.id not in pipeline.sessions and used.id in pipeline.sessions and replaced.id not in [expired.id, used.id] \
+        and pipeline.get_session(used.id) is used
+
+def test_pipeline_missing_input():
+    pipeline = AnalysisPipeline(FakeNavigator(), JobManager(max_workers=1))
+    session = pipeline.create_session()
+    errors = []
+    for step in [pipeline.get_context, pipeline.get_coras_model]:
+        try:
+            step(session)
+        except MissingInput as error:
+            errors.append(str(error))
+    return errors == ["No summary in the session", "No risk analysis in the session"]
+
+def test_pipeline_prefetch_failed():
+    pipeline = AnalysisPipeline(FakeNavigator(), JobManager(max_workers=1))
+    session = pipeline.create_session()
+    pipeline.set_analysis(session, "")
+    try:
+        pipeline.get_coras_model(session)
+    except StepFailed as error:
+        return str(error) == "Ollama unreachable"
+    return False
+
+def test_suite_pipeline():
+    print("test_suite_pipeline: ", end="")
+    run_test(test_pipeline_prefetch_reused)
+    run_test(test_pipeline_input_changed)
+    run_test(test_pipeline_queue_full)
+    run_test(test_pipeline_prefetch_cancelled)
+    run_test(test_pipeline_sessions_expire)
+    run_test(test_pipeline_missing_input)
+    run_test(test_pipeline_prefetch_failed)
+    print("")
@@ -0,0 +1,45 @@
+from reranker import EmbeddingReranker, LexicalReranker
+from run_test import run_test
+
+class KeywordEmbeddings:
+    """
+    Embeds a text by counting the occurrences of a few keywords.
+    """
+
+    keywords = ["sql", "injection", "firmware", "phishing"]
+
+    def embed_query(self, text):
+        return [text.lower().count(keyword) for keyword in self.keywords]
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+candidates = {
+    "66": "[CAPEC-66]\n**Attack pattern**: SQL Injection\n**Description**: An attacker crafts SQL queries.",
+    "98": "[CAPEC-98]\n**Attack pattern**: Phishing\n**Description**: An attacker sends fake emails.",
+    "441": "[CAPEC-441]\n**Attack pattern**: Malicious Logic Insertion\n**Description**: An attacker installs malicious firmware."
+}
+
+def test_lexical_reranker_order():
+    ids = LexicalReranker().rerank("The web server builds SQL queries from user input", candidates, 3)
+    return ids[0] == "66" and sorted(ids) == ["441", "66", "98"]
+
+def test_lexical_reranker_top_k():
+    return len(LexicalReranker().rerank("phishing emails", candidates, 2)) == 2
+
+def test_embedding_reranker_order():
+    ids = EmbeddingReranker(KeywordEmbeddings()).rerank("Sensors run a firmware updated over the air", candidates, 1)
+    return ids == ["441"]
+
+def test_embedding_reranker_query_embedding():
+    # The embedding of the query computed for the vector search is reused
+    ids = EmbeddingReranker(KeywordEmbeddings()).rerank("Sensors run a firmware updated over the air", candidates, 1, query_embedding=[0, 0, 0, 1])
+    return ids == ["98"]
+
+def test_suite_reranker():
+    print("test_suite_reranker: ", end="")
+    run_test(test_lexical_reranker_order)
+    run_test(test_lexical_reranker_top_k)
+    run_test(test_embedding_reranker_order)
+    run_test(test_embedding_reranker_query_embedding)
+    print("")
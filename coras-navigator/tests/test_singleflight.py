@@ -0,0 +1,200 @@
+import asyncio
+import threading
+import time
+
+from singleflight import SingleFlight, normalize_input
+from cache import bypass_llm_cache
+from run_test import run_test
+
+def test_singleflight_do():
+    singleflight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def summarize():
+        calls.append("summarize")
+        started.set()
+        release.wait(5)
+        return "The system..."
+
+    leader = threading.Thread(target=lambda: results.append(singleflight.do("summarize", ("A web shop",), summarize)))
+    leader.start()
+    started.wait(5)
+    # Same input up to the line endings and trailing whitespace
+    follower = threading.Thread(target=lambda: results.append(singleflight.do("summarize", ("A web shop \r\n",), summarize)))
+    follower.start()
+    while list(singleflight.flights.values())[0].followers == 0:
+        time.sleep(0.01)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    return calls == ["summarize"] and results == ["The system...", "The system..."] and len(singleflight.flights) == 0
+
+def test_singleflight_stream_replay():
+    singleflight = SingleFlight()
+    calls = []
+
+    def assess():
+        calls.append("assess")
+        yield from ["Risk ", "1: ", "..."]
+
+    leader = singleflight.stream("assess", ("summary", "context"), assess)
+    first = next(leader)
+    # The follower gets the chunks generated before it attached, then the next ones
+    follower = singleflight.stream("assess", ("summary", "context"), assess)
+    follower_chunks = [next(follower)]
+    leader_chunks = [first] + list(leader)
+    follower_chunks += list(follower)
+    return calls == ["assess"] and leader_chunks == follower_chunks == ["Risk ", "1: ", "..."]
+
+def test_singleflight_leader_closed():
+    # The generation goes on for the follower when the client of the leader goes away
+    singleflight = SingleFlight()
+    leader = singleflight.stream("summarize", ("description",), lambda: iter(["a", "b", "c"]))
+    next(leader)
+    follower = singleflight.stream("summarize", ("description",), lambda: iter(["x"]))
+    first = next(follower)
+    leader.close()
+    return [first] + list(follower) == ["a", "b", "c"]
+
+def test_singleflight_error_shared():
+    singleflight = SingleFlight()
+    calls = []
+
+    def format():
+        calls.append("format")
+        yield "{"
+        raise ValueError("Invalid JSON")
+
+    leader = singleflight.stream("format-stream", ("analysis",), format)
+    next(leader)
+    follower = singleflight.stream("format-stream", ("analysis",), format)
+    next(follower)
+    errors = []
+    for stream in [leader, follower]:
+        try:
+            list(stream)
+        except ValueError as error:
+            errors.append(str(error))
+    return errors == ["Invalid JSON", "Invalid JSON"] and calls == ["format"]
+
+def test_singleflight_keys():
+    # A forced generation does not attach to a regular one, nor a stage to another one
+    singleflight = SingleFlight()
+    calls = []
+
+    def stream(name):
+        calls.append(name)
+        yield name
+
+    regular = singleflight.stream("summarize", ("description",), lambda: stream("regular"))
+    next(regular)
+    with bypass_llm_cache():
+        forced = list(singleflight.stream("summarize", ("description",), lambda: stream("forced")))
+    other_stage = list(singleflight.stream("assess", ("description",), lambda: stream("assess")))
+    return forced == ["forced"] and other_stage == ["assess"] and calls == ["regular", "forced", "assess"]
+
+def test_singleflight_async():
+    singleflight = SingleFlight()
+    calls = []
+
+    async def summarize():
+        calls.append("summarize")
+        for chunk in ["The ", "system"]:
+            await asyncio.sleep(0.01)
+            yield chunk
+
+    async def read():
+        return "".join([chunk async for chunk in singleflight.astream("summarize", ("description",), summarize)])
+
+    async def wait():
+        await asyncio.sleep(0.005)
+        return await singleflight.ado("summarize", ("description",), lambda: asyncio.sleep(0, "other"))
+
+    async def run():
+        return await asyncio.gather(read(), read(), wait())
+
+    return asyncio.run(run()) == ["The system", "The system", "The system"] and calls == ["summarize"]
+
+def test_singleflight_async_leader_cancelled():
+    # A disconnected client cancels the task of the leader: the generation goes on for the follower
+    singleflight = SingleFlight()
+    calls = []
+
+    async def assess():
+        calls.append("assess")
+        for chunk in ["a", "b", "c"]:
+            await asyncio.sleep(0.01)
+            yield chunk
+
+    async def read(chunks, started=None):
+        async for chunk in singleflight.astream("assess", ("summary", "context"), assess):
+            chunks.append(chunk)
+            if started is not None:
+                started.set()
+
+    async def run():
+        leader_chunks, follower_chunks = [], []
+        started = asyncio.Event()
+        leader = asyncio.create_task(read(leader_chunks, started))
+        await started.wait()
+        follower = asyncio.create_task(read(follower_chunks))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+        await follower
+        return leader.cancelled() and leader_chunks == ["a"] and follower_chunks == ["a", "b", "c"]
+
+    return asyncio.run(run()) and calls == ["assess"] and len(singleflight.flights) == 0
+
+def test_singleflight_async_abandoned():
+    # The generation is cancelled once no call follows it anymore
+    singleflight = SingleFlight()
+    cancelled = []
+
+    async def summarize():
+        try:
+            for chunk in ["a", "b", "c"]:
+                await asyncio.sleep(0.01)
+                yield chunk
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def read():
+        async for chunk in singleflight.astream("summarize", ("description",), summarize):
+            return chunk
+
+    async def run():
+        first = await read()
+        await asyncio.sleep(0.05)
+        return first
+
+    return asyncio.run(run()) == "a" and cancelled == [True] and len(singleflight.flights) == 0
+
+def test_normalize_input():
+    # Line breaks are significant for the line-based steps (risk parser, formatter)
+    return normalize_input("**Risk 1**  \r\n* Threat: insider\n") == normalize_input("**Risk 1**\n* Threat: insider") \
+        and normalize_input("**Risk 1** * Threat: insider") != normalize_input("**Risk 1**\n* Threat: insider")
+
+def test_singleflight_disabled():
+    singleflight = SingleFlight(enabled=False)
+    leader = singleflight.stream("summarize", ("description",), lambda: iter(["a"]))
+    next(leader)
+    return singleflight.do("summarize", ("description",), lambda: "b") == "b"
+
+def test_suite_singleflight():
+    print("test_suite_singleflight: ", end="")
+    run_test(test_singleflight_do)
+    run_test(test_singleflight_stream_replay)
+    run_test(test_singleflight_leader_closed)
+    run_test(test_singleflight_error_shared)
+    run_test(test_singleflight_keys)
+    run_test(test_singleflight_async)
+    run_test(test_singleflight_async_leader_cancelled)
+    run_test(test_singleflight_async_abandoned)
+    run_test(test_normalize_input)
+    run_test(test_singleflight_disabled)
+    print("")
@@ -0,0 +1,54 @@
+from formatter import split_risks, merge_coras_graphs
+from run_test import run_test
+
+analysis = """| Risk | Threat | Asset |
+| Risk 1 | Insider | Health data |
+
+**Risk 1: Insider Attack on Tester Computer**
+* **Threat:** Insider with access to tester computer
+* **Impacted Assets:** Health data
+
+**Risk 2: Eavesdropping on Bluetooth**
+* **Threat:** Attacker close to the patient
+* **Impacted Assets:** Health data, Wearable sensor-patch
+"""
+
+def test_split_risks():
+    risks = split_risks(analysis)
+    return [number for number, _ in risks] == ["1", "2"] \
+        and risks[0][1].startswith("**Risk 1: Insider") \
+        and "Bluetooth" not in risks[0][1]
+
+def test_split_risks_repeated_risk():
+    text = "**Risk 1: Overview**\nShort.\n**Risk 2: Other**\nShort.\n**Risk 1: Insider Attack**\nDetails."
+    risks = split_risks(text)
+    return [number for number, _ in risks] == ["2", "1"] and risks[1][1].endswith("Details.")
+
+def test_split_risks_no_risk():
+    return split_risks("No risk was identified.") == []
+
+def test_merge_coras_graphs():
+    graph = {
+        "vertices": [
+            {"id": "R1-T1", "type": "human_threat_malicious", "text": "Attacker"},
+            {"id": "R1-UI", "type": "unwanted_incident", "text": "Data leak"},
+            {"id": "health_data", "type": "asset", "text": "Health data"}
+        ],
+        "edges": [
+            {"source": "R1-T1", "target": "R1-UI", "vulnerabilities": ["CWE-89"]},
+            {"source": "R1-UI", "target": "health_data", "vulnerabilities": []}
+        ]
+    }
+    merged = merge_coras_graphs([("1", graph), ("2", graph)])
+    ids = [vertex["id"] for vertex in merged["vertices"]]
+    return ids == ["R1-T1", "R1-UI", "health_data", "R2-T1", "R2-UI"] \
+        and merged["edges"][2] == {"source": "R2-T1", "target": "R2-UI", "vulnerabilities": ["CWE-89"]} \
+        and merged["edges"][3]["target"] == "health_data"
+
+def test_suite_split_risks():
+    print("test_suite_split_risks: ", end="")
+    run_test(test_split_risks)
+    run_test(test_split_risks_repeated_risk)
+    run_test(test_split_risks_no_risk)
+    run_test(test_merge_coras_graphs)
+    print("")
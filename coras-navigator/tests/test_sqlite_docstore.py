@@ -0,0 +1,67 @@
+import os
+import sqlite3
+import tempfile
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import FAISS
+
+from docstore import SQLiteDocstore, save_faiss, load_faiss
+from run_test import run_test
+
+def create_docstore():
+    path = os.path.join(tempfile.mkdtemp(), "docstore.sqlite")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE documents (id TEXT PRIMARY KEY, page_content TEXT NOT NULL, metadata TEXT NOT NULL)")
+    connection.execute("CREATE TABLE positions (position INTEGER PRIMARY KEY, id TEXT NOT NULL)")
+    connection.execute("INSERT INTO positions (position, id) VALUES (0, 'a')")
+    connection.commit()
+    connection.close()
+    return SQLiteDocstore(path, read_only=False)
+
+def test_sqlite_docstore_add_search():
+    docstore = create_docstore()
+    docstore.add({"a": Document(page_content="[CAPEC-66]: SQL Injection", metadata={"source": "capec.txt"})})
+    document = docstore.search("a")
+    return document.page_content == "[CAPEC-66]: SQL Injection" and document.metadata == {"source": "capec.txt"}
+
+def test_sqlite_docstore_delete():
+    docstore = create_docstore()
+    docstore.add({"a": Document(page_content="[CAPEC-66]: SQL Injection")})
+    docstore.delete(["a"])
+    return isinstance(docstore.search("a"), str)
+
+def test_sqlite_docstore_index_to_docstore_id():
+    return create_docstore().get_index_to_docstore_id() == {0: "a"}
+
+class LengthEmbeddings(Embeddings):
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return [float(len(text)), 1.0]
+
+def test_load_faiss_update():
+    # The saved files are only changed by save_faiss: processes serving them keep a consistent index and docstore
+    folder = tempfile.mkdtemp()
+    embeddings = LengthEmbeddings()
+    save_faiss(FAISS.from_texts(["[CAPEC-66]: SQL Injection"], embeddings, ids=["a"]), folder)
+
+    vector_store = load_faiss(folder, embeddings, read_only=False)
+    vector_store.add_texts(["[CAPEC-63]: Cross-Site Scripting (XSS)"], ids=["b"])
+    vector_store.delete(["a"])
+    saved = SQLiteDocstore(os.path.join(folder, "docstore.sqlite"))
+    unchanged = saved.get_index_to_docstore_id() == {0: "a"} and saved.search("a").page_content == "[CAPEC-66]: SQL Injection" and isinstance(saved.search("b"), str)
+
+    save_faiss(vector_store, folder)
+    updated = load_faiss(folder, embeddings)
+    return unchanged and updated.index_to_docstore_id == {0: "b"} and updated.index.ntotal == 1 \
+        and updated.docstore.search("b").page_content == "[CAPEC-63]: Cross-Site Scripting (XSS)" and isinstance(updated.docstore.search("a"), str)
+
+def test_suite_sqlite_docstore():
+    print("test_suite_sqlite_docstore: ", end="")
+    run_test(test_sqlite_docstore_add_search)
+    run_test(test_sqlite_docstore_delete)
+    run_test(test_sqlite_docstore_index_to_docstore_id)
+    run_test(test_load_faiss_update)
+    print("")
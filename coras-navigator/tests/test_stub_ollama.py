@@ -0,0 +1,63 @@
+from stub_ollama import StubOllama, split_tokens, get_stub_embedding
+from run_test import run_test
+
+import json
+import time
+import urllib.request
+
+def post(url: str, body: dict) -> list[dict]:
+    request = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"), headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        return [json.loads(line) for line in response.read().decode("utf-8").splitlines() if line.strip() != ""]
+
+def cosine(a: list[float], b: list[float]) -> float:
+    return sum(x * y for x, y in zip(a, b))
+
+def test_split_tokens():
+    return split_tokens("The insider gains access.") == ["The ", "insider ", "gains ", "access."] \
+        and "".join(split_tokens("  Two\nlines ")) == "  Two\nlines "
+
+def test_stub_embedding():
+    query = get_stub_embedding("SQL injection in the login form", 256)
+    related = get_stub_embedding("An attacker crafts SQL queries through the login form", 256)
+    unrelated = get_stub_embedding("Bluetooth traffic of the wearable", 256)
+    return len(query) == 256 \
+        and abs(cosine(query, query) - 1.0) < 1e-9 \
+        and cosine(query, related) > cosine(query, unrelated) \
+        and get_stub_embedding("SQL injection in the login form", 256) == query
+
+def test_stub_chat_stream():
+    with StubOllama(responses=[("risk assessment", "Risk 1: SQL injection")], default_response="Summary", tokens_per_second=1000) as stub:
+        chunks = post(f"{stub.url}/api/chat", {"model": "llama3:70b-instruct", "messages": [{"role": "system", "content": "You perform a risk assessment"}]})
+        default = post(f"{stub.url}/api/generate", {"model": "llama3:8b", "prompt": "Summarize", "stream": False})
+    return "".join(chunk["message"]["content"] for chunk in chunks) == "Risk 1: SQL injection" \
+        and chunks[-1]["done"] and chunks[-1]["eval_count"] == 4 and "prompt_eval_duration" in chunks[-1] \
+        and not chunks[0]["done"] \
+        and default[0]["response"] == "Summary" and default[0]["done"] \
+        and stub.stats()["requests"] == {"llama3:70b-instruct": 1, "llama3:8b": 1}
+
+def test_stub_latency():
+    with StubOllama(default_response="one two three four", latency=0.05, tokens_per_second=100) as stub:
+        start = time.perf_counter()
+        post(f"{stub.url}/api/chat", {"model": "llama3:8b", "messages": []})
+        elapsed = time.perf_counter() - start
+    # 50ms before the first token, then 10ms per token
+    return 0.09 <= elapsed < 1.0
+
+def test_stub_embed():
+    with StubOllama(embedding_size=64, models=["nomic-embed-text:latest"]) as stub:
+        response = post(f"{stub.url}/api/embed", {"model": "nomic-embed-text:latest", "input": ["SQL injection", "Sniffing"]})[0]
+        with urllib.request.urlopen(f"{stub.url}/api/tags") as tags:
+            models = json.load(tags)["models"]
+    return len(response["embeddings"]) == 2 \
+        and len(response["embeddings"][0]) == 64 \
+        and models[0]["name"] == "nomic-embed-text:latest"
+
+def test_suite_stub_ollama():
+    print("test_suite_stub_ollama: ", end="")
+    run_test(test_split_tokens)
+    run_test(test_stub_embedding)
+    run_test(test_stub_chat_stream)
+    run_test(test_stub_latency)
+    run_test(test_stub_embed)
+    print("")